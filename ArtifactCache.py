@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import sqlite3
+import threading
+import time
+import typing
+
+
+class ArtifactCache(object):
+    """按内容存放的本地缓存, 有磁盘预算, 按 LRU 淘汰。
+    get_*/put_* 返回的对象在 unpin() 之前不会被淘汰; max_bytes <= 0 时关闭缓存。
+    """
+
+    def __init__(self, root: str, max_bytes: int):
+        self.root = os.path.abspath(root)
+        self.max_bytes = max_bytes
+        self.hits: dict[str, int] = dict()
+        self.misses: dict[str, int] = dict()
+        self.evicted_bytes = 0
+        self._pins: dict[str, int] = dict()
+        self._lock = threading.RLock()
+        self._db: typing.Optional[sqlite3.Connection] = None
+        if self.enabled:
+            os.makedirs(os.path.join(self.root, "objects"), exist_ok=True)
+            os.makedirs(os.path.join(self.root, "trees"), exist_ok=True)
+            self._db = sqlite3.connect(
+                os.path.join(self.root, "index.sqlite"), check_same_thread=False
+            )
+            self._db.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS objects (
+                    name TEXT PRIMARY KEY,
+                    is_dir INTEGER NOT NULL,
+                    size INTEGER NOT NULL,
+                    last_access REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS keys (
+                    key TEXT PRIMARY KEY,
+                    kind TEXT NOT NULL,
+                    name TEXT,
+                    sha256 TEXT,
+                    source TEXT,
+                    created REAL NOT NULL
+                );
+                """
+            )
+            self._db.commit()
+            # the budget may have shrunk since the last run
+            self.evict()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def _object_path(self, name: str, is_dir: bool) -> str:
+        if is_dir:
+            return os.path.join(self.root, "trees", name)
+        return os.path.join(self.root, "objects", name[:2], name)
+
+    def _count(self, table: dict[str, int], kind: str):
+        table[kind] = table.get(kind, 0) + 1
+
+    def _lookup(self, key: str) -> typing.Optional[tuple]:
+        return self._db.execute(
+            "SELECT keys.kind, keys.name, keys.sha256, objects.is_dir "
+            "FROM keys LEFT JOIN objects ON keys.name = objects.name "
+            "WHERE keys.key = ?",
+            (key,),
+        ).fetchone()
+
+    def _pin(self, path: str):
+        self._pins[path] = self._pins.get(path, 0) + 1
+
+    def unpin(self, path: typing.Optional[str]):
+        if path is None:
+            return
+        with self._lock:
+            count = self._pins.get(path, 0) - 1
+            if count > 0:
+                self._pins[path] = count
+            else:
+                self._pins.pop(path, None)
+
+    def has(self, key: str) -> bool:
+        """Whether an object is stored for key (no pin, not counted)."""
+        if not self.enabled:
+            return False
+        with self._lock:
+            row = self._lookup(key)
+            if row is None or row[1] is None or row[3] is None:
+                return False
+            return os.path.exists(self._object_path(row[1], bool(row[3])))
+
+    def get_digest(self, key: str, kind: str) -> typing.Optional[str]:
+        """sha256 recorded for key, without needing a stored object."""
+        if not self.enabled:
+            self._count(self.misses, kind)
+            return None
+        with self._lock:
+            row = self._lookup(key)
+            if row is None or row[2] is None:
+                self._count(self.misses, kind)
+                return None
+            self._count(self.hits, kind)
+            return row[2]
+
+    def put_digest(self, key: str, kind: str, sha256: str, source: str = ""):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO keys VALUES (?, ?, NULL, ?, ?, ?)",
+                (key, kind, sha256, source, time.time()),
+            )
+            self._db.commit()
+
+    def get(self, key: str, kind: str) -> typing.Optional[tuple[str, typing.Optional[str]]]:
+        """(path, sha256) of the object stored for key, pinned; None on miss."""
+        if not self.enabled:
+            self._count(self.misses, kind)
+            return None
+        with self._lock:
+            row = self._lookup(key)
+            if row is None or row[1] is None or row[3] is None:
+                self._count(self.misses, kind)
+                return None
+            _, name, sha256, is_dir = row
+            path = self._object_path(name, bool(is_dir))
+            if not os.path.exists(path):
+                # removed behind our back
+                self._forget(name)
+                self._count(self.misses, kind)
+                return None
+            self._db.execute(
+                "UPDATE objects SET last_access = ? WHERE name = ?", (time.time(), name)
+            )
+            self._db.commit()
+            self._pin(path)
+            self._count(self.hits, kind)
+            return path, sha256
+
+    def put_file(self, key: str, kind: str, src: str, sha256: str,
+                 source: str = "", suffix: str = "") -> str:
+        """Move src into the cache (deduplicated by sha256) and return the
+        pinned cached path. suffix keeps the file extension visible to
+        callers that dispatch on it (.zip, .tar.xz)."""
+        if not self.enabled:
+            return src
+        name = f"{sha256}{suffix}"
+        path = self._object_path(name, False)
+        with self._lock:
+            if os.path.exists(path):
+                if os.path.abspath(src) != path:
+                    os.unlink(src)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                shutil.move(src, path)
+            self._store(key, kind, name, False, os.path.getsize(path), sha256, source)
+            self._pin(path)
+            self.evict()
+        return path
+
+    def put_tree(self, key: str, kind: str, src: str, name: str, source: str = "") -> str:
+        """Move the directory src into the cache under name and return the
+        pinned cached path."""
+        if not self.enabled:
+            return src
+        path = self._object_path(name, True)
+        with self._lock:
+            if os.path.exists(path):
+                shutil.rmtree(src)
+            else:
+                shutil.move(src, path)
+            self._store(key, kind, name, True, tree_size(path), None, source)
+            self._pin(path)
+            self.evict()
+        return path
+
+    def _store(self, key: str, kind: str, name: str, is_dir: bool, size: int,
+               sha256: typing.Optional[str], source: str):
+        now = time.time()
+        self._db.execute(
+            "INSERT OR REPLACE INTO objects VALUES (?, ?, ?, ?)",
+            (name, 1 if is_dir else 0, size, now),
+        )
+        self._db.execute(
+            "INSERT OR REPLACE INTO keys VALUES (?, ?, ?, ?, ?, ?)",
+            (key, kind, name, sha256, source, now),
+        )
+        self._db.commit()
+
+    def _forget(self, name: str):
+        self._db.execute("DELETE FROM objects WHERE name = ?", (name,))
+        # digests stay valid without the object, only drop the link
+        self._db.execute("UPDATE keys SET name = NULL WHERE name = ?", (name,))
+        self._db.commit()
+
+    def total_bytes(self) -> int:
+        if not self.enabled:
+            return 0
+        with self._lock:
+            return self._db.execute("SELECT COALESCE(SUM(size), 0) FROM objects").fetchone()[0]
+
+    def evict(self):
+        """Drop least recently used, unpinned objects until the budget fits."""
+        if not self.enabled:
+            return
+        with self._lock:
+            total = self.total_bytes()
+            if total <= self.max_bytes:
+                return
+            rows = self._db.execute(
+                "SELECT name, is_dir, size FROM objects ORDER BY last_access"
+            ).fetchall()
+            for name, is_dir, size in rows:
+                if total <= self.max_bytes:
+                    break
+                path = self._object_path(name, bool(is_dir))
+                if path in self._pins:
+                    continue
+                print(f"cache evict {name} ({size} bytes)")
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+                elif os.path.exists(path):
+                    os.unlink(path)
+                self._forget(name)
+                total -= size
+                self.evicted_bytes += size
+
+    def stats(self) -> dict:
+        hits = sum(self.hits.values())
+        misses = sum(self.misses.values())
+        return {
+            "enabled": self.enabled,
+            "hits": dict(self.hits),
+            "misses": dict(self.misses),
+            "hit_ratio": hits / (hits + misses) if hits + misses > 0 else 0.0,
+            "bytes": self.total_bytes(),
+            "max_bytes": self.max_bytes,
+            "evicted_bytes": self.evicted_bytes,
+        }
+
+    def report(self):
+        stats = self.stats()
+        print(
+            f"cache hits={stats['hits']} misses={stats['misses']} "
+            f"hit_ratio={stats['hit_ratio']:.2f} "
+            f"size={stats['bytes']}/{stats['max_bytes']} "
+            f"evicted={stats['evicted_bytes']}"
+        )
+
+    def close(self):
+        if self._db is not None:
+            with self._lock:
+                self._db.close()
+                self._db = None
+
+
+def tree_size(path: str) -> int:
+    size = 0
+    for base, _, file_list in os.walk(path):
+        for name in file_list:
+            full = os.path.join(base, name)
+            if not os.path.islink(full):
+                size += os.path.getsize(full)
+    return size
@@ -1,36 +1,48 @@
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import codecs
+import fnmatch
 import hashlib
 import inspect
+import io
 import json
 import lzma
 import os
+import plistlib
 import re
 import shutil
+import sys
 import tarfile
+import threading
+import time
 import traceback
 import typing
 import zipfile
+from html.parser import HTMLParser
 from urllib.parse import urljoin, urlparse
-from typing import Optional, Tuple, Union
+from typing import Optional
 import requests
-from bs4 import BeautifulSoup
-from github import Github, GitRelease, GitReleaseAsset, Repository, PaginatedList, Tag
 
+if typing.TYPE_CHECKING:
+    # PyGithub 导入很慢, 只在真正写入 GitHub 时导入 (见 github_client)
+    from github import Github, GitRelease, GitReleaseAsset, Repository
+
+from ArtifactCache import ArtifactCache
+from FileCopy import CopyStats, copy_tree
+from GitHubApi import GitHubApi
+from Pipeline import Pipeline, PipelineStage
 from Shell import Shell
+from StateManifest import StateManifest
+import MachO
+import XzParallel
+from ZipWriter import ParallelZipWriter, ZipFanout, copy_zip_members
+import Http
+import Metrics
+import Trace
+from Trace import traced
 import logging
-import functools
-import inspect
-
-
-def DebugLineInfo(offset: int = 1) -> str:
-    # 获取当前堆栈信息
-    # stack[1] 代表调用者的帧 (Frame)
-    caller_frame = inspect.stack()[offset]
-
-    # 获取行号和函数名
-    line_number = caller_frame.lineno
-    function_name = caller_frame.function
-
-    return f"Line {line_number} in {function_name}"
 
 
 # 配置日志
@@ -40,22 +52,7 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 
-def printLine():
-    logger.info(f"-->{DebugLineInfo(2)}")
-
-
-def log_entry(func):
-    @functools.wraps(func)
-    def wrapper(*args, **kwargs):
-        logger.info(f"Entering {func.__name__} with args={args}, kwargs={kwargs}")
-        result = func(*args, **kwargs)
-        logger.info(f"Exiting {func.__name__}")
-        return result
-
-    return wrapper
-
-
-@log_entry
+@traced
 def json_load_str_safe(obj: dict, key: str, default_value: str) -> str:
     if key in obj:
         return obj[key]
@@ -63,6 +60,84 @@ def json_load_str_safe(obj: dict, key: str, default_value: str) -> str:
         return default_value
 
 
+class PackageVariant:
+    """
+    一种 xcframework zip: 按 LibraryIdentifier (slice 目录名) 的通配规则挑选 slice,
+    可以不带 dSYMs; Info.plist 只保留留下的 slice
+    """
+
+    def __init__(
+        self,
+        name: str,
+        include_slices: Optional[list[str]] = None,
+        exclude_slices: Optional[list[str]] = None,
+        dsyms: bool = True,
+    ):
+        self.name = name
+        self.include_slices = include_slices if include_slices is not None else ["*"]
+        self.exclude_slices = exclude_slices if exclude_slices is not None else []
+        self.dsyms = dsyms
+
+    def __repr__(self):
+        return f"PackageVariant({self.name})"
+
+    def is_complete(self) -> bool:
+        return (
+            self.include_slices == ["*"]
+            and len(self.exclude_slices) == 0
+            and self.dsyms
+        )
+
+    def accepts_slice(self, identifier: str) -> bool:
+        return any(
+            fnmatch.fnmatchcase(identifier, rule) for rule in self.include_slices
+        ) and not any(
+            fnmatch.fnmatchcase(identifier, rule) for rule in self.exclude_slices
+        )
+
+    def accepts(self, name: str, is_dir: bool = False) -> bool:
+        """
+        :param name: 以 MobileVLCKit.xcframework 开头的 zip 成员路径
+        """
+        parts = [part for part in name.split("/") if part != ""]
+        # 根目录和 Info.plist 等最上层文件
+        if len(parts) < 2 or (len(parts) == 2 and not is_dir):
+            return True
+        if not self.accepts_slice(parts[1]):
+            return False
+        if not self.dsyms:
+            for part in parts[2:]:
+                if part == "dSYMs" or part.endswith(".dSYM"):
+                    return False
+        return True
+
+    def rewrites(self, name: str) -> bool:
+        return not self.is_complete() and name == "MobileVLCKit.xcframework/Info.plist"
+
+    def info_plist(self, data: bytes) -> bytes:
+        """
+        :return: 去掉不要的 slice (和 dSYMs 路径) 后的 xcframework Info.plist
+        """
+        # generate_info_plist 生成的文件开头有空白
+        plist = plistlib.loads(data.lstrip())
+        libraries = []
+        for library in plist.get("AvailableLibraries", []):
+            if not self.accepts_slice(library.get("LibraryIdentifier", "")):
+                continue
+            if not self.dsyms:
+                library.pop("DebugSymbolsPath", None)
+            libraries.append(library)
+        plist["AvailableLibraries"] = libraries
+        return plistlib.dumps(plist)
+
+
+# full: 全部 slice 和 dSYMs; lite: 只有真机 slice, 没有 dSYMs
+PACKAGE_VARIANTS: dict[str, PackageVariant] = {
+    "full": PackageVariant("full"),
+    "lite": PackageVariant("lite", exclude_slices=["*-simulator"], dsyms=False),
+}
+
+
 class Configure:
     # def __init__(self):
     #     cfg_path = os.path.join(os.path.dirname(__file__), "configure.json")
@@ -102,7 +177,110 @@ class Configure:
         self.temp_path = os.environ.get("TEMP_PATH", "./temp")
         self.github_branch_name = os.environ.get("GITHUB_BRANCH", "master")
         self.lipo_path = os.environ.get("LIPO_PATH", "lipo")
-        self.cache_file_keep = os.environ.get("CACHE_FILE_KEEP", "False")
+        self.cache_file_keep = (
+            os.environ.get("CACHE_FILE_KEEP", "False").lower().strip() == "true"
+        )
+        # 本地产物缓存目录和磁盘预算 (字节), 预算为 0 (默认) 时关闭缓存;
+        # 只有缓存目录能在多次运行之间保留时才有用
+        self.cache_path = os.environ.get(
+            "CACHE_PATH", os.path.join(self.temp_path, "cache")
+        )
+        self.cache_max_bytes = int(os.environ.get("CACHE_MAX_BYTES", "0"))
+        self.artifact_cache: Optional[ArtifactCache] = None
+        # GitHub 读接口的 ETag 缓存目录 (为空时不缓存), 以及为写操作保留的 rate limit 次数
+        self.github_api_cache_path = os.environ.get(
+            "GITHUB_API_CACHE_PATH", os.path.join(self.temp_path, "github-api")
+        )
+        self.github_api_reserve = int(os.environ.get("GITHUB_API_RESERVE", "50"))
+        self.github_api: Optional[GitHubApi] = None
+        # 流水线每类资源的并发上限, 以及每个阶段前的队列长度
+        self.pipeline_network_limit = int(
+            os.environ.get("PIPELINE_NETWORK_LIMIT", "2")
+        )
+        self.pipeline_cpu_limit = int(
+            os.environ.get("PIPELINE_CPU_LIMIT", str(os.cpu_count() or 1))
+        )
+        self.pipeline_disk_limit = int(os.environ.get("PIPELINE_DISK_LIMIT", "1"))
+        self.pipeline_queue_size = int(os.environ.get("PIPELINE_QUEUE_SIZE", "1"))
+        # 下载失败 (无进展) 的重试次数, 退避基础秒数, socket 超时秒数
+        self.download_retries = int(os.environ.get("DOWNLOAD_RETRIES", "5"))
+        self.download_backoff = float(os.environ.get("DOWNLOAD_BACKOFF", "2"))
+        self.download_timeout = float(os.environ.get("DOWNLOAD_TIMEOUT", "60"))
+        # 共用 HTTP 连接池: 连接超时秒数, 每个主机的连接数上限, 等待空闲连接的秒数,
+        # 5xx 和连接中断的重试次数与退避基础秒数 (读超时使用 DOWNLOAD_TIMEOUT)
+        self.http_connect_timeout = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "10"))
+        self.http_max_per_host = int(os.environ.get("HTTP_MAX_PER_HOST", "8"))
+        self.http_pool_timeout = float(os.environ.get("HTTP_POOL_TIMEOUT", "60"))
+        self.http_retries = int(os.environ.get("HTTP_RETRIES", "3"))
+        self.http_backoff = float(os.environ.get("HTTP_BACKOFF", "1"))
+        # 多连接分段下载的连接数 (1 为单连接) 和每段最小字节数
+        self.download_segments = int(os.environ.get("DOWNLOAD_SEGMENTS", "4"))
+        self.download_min_segment_size = int(
+            os.environ.get("DOWNLOAD_MIN_SEGMENT_SIZE", str(64 * 1024 * 1024))
+        )
+        # 流式解压 tar.xz 的读缓冲大小
+        self.untar_buffer_size = int(
+            os.environ.get("UNTAR_BUFFER_SIZE", str(1024 * 1024))
+        )
+        # 多 block 的 xz 文件并行解码的进程数, 1 为不并行
+        self.xz_workers = int(os.environ.get("XZ_WORKERS", str(os.cpu_count() or 1)))
+        # xcframework zip 的 deflate 压缩级别 (0 为不压缩) 和并行压缩的线程数
+        self.zip_level = int(os.environ.get("ZIP_LEVEL", "6"))
+        self.zip_workers = int(os.environ.get("ZIP_WORKERS", str(os.cpu_count() or 1)))
+        # framework 转 xcframework 时并行生成各 slice 的线程数
+        self.slice_workers = int(
+            os.environ.get("SLICE_WORKERS", str(os.cpu_count() or 1))
+        )
+        # tar.xz 包边下载边解压 (不先落盘), 以及是否同时把原始包写入缓存
+        self.stream_extract = (
+            os.environ.get("STREAM_EXTRACT", "False").lower().strip() == "true"
+        )
+        self.stream_extract_cache = (
+            os.environ.get("STREAM_EXTRACT_CACHE", "True").lower().strip() == "true"
+        )
+        # 一次解压同时打出的包 (逗号分隔, 见 PACKAGE_VARIANTS), 第一个是本仓库
+        # 发布和打 tag 的包, 其他的作为同一 release 的附加资源上传
+        variant_names = [
+            name.strip().lower()
+            for name in os.environ.get("PACKAGE_VARIANTS", "full").split(",")
+            if len(name.strip()) > 0
+        ]
+        unknown = [name for name in variant_names if name not in PACKAGE_VARIANTS]
+        if len(unknown) > 0:
+            # 写错时不能让别的包变成打 tag 的第一个包, 整体退回 full
+            print(
+                f"unknown package variants {', '.join(unknown)} "
+                f"(valid: {', '.join(PACKAGE_VARIANTS.keys())}), use full"
+            )
+            variant_names = []
+        self.package_variants: list[PackageVariant] = [
+            PACKAGE_VARIANTS[name] for name in variant_names
+        ]
+        if len(self.package_variants) == 0:
+            self.package_variants = [PACKAGE_VARIANTS["full"]]
+        # 耗时追踪文件 (Chrome trace JSON, 为空时关闭) 和根 span 的采样比例
+        self.trace_path = os.environ.get("TRACE_PATH", "")
+        self.trace_sample_rate = float(os.environ.get("TRACE_SAMPLE_RATE", "1"))
+        # 运行指标输出路径前缀, 写出 .json 和 Prometheus textfile (.prom), 为空时关闭
+        self.metrics_path = os.environ.get(
+            "METRICS_PATH", os.path.join(self.temp_path, "metrics", "convert")
+        )
+        # 增量运行的状态清单: 本地路径, 同时保存为 release 资源时的文件名 (为空时只存本地),
+        # 以及是否忽略清单强制全量列出 tag 和 release 资源
+        self.state_path = os.environ.get(
+            "STATE_PATH", os.path.join(self.temp_path, "state", "manifest.json")
+        )
+        self.state_asset_name = os.environ.get("STATE_ASSET", "state-manifest.json")
+        self.state_full_scan = (
+            os.environ.get("STATE_FULL_SCAN", "False").lower().strip() == "true"
+        )
+        # 只检查是否有需要处理的版本: 写出计划 (JSON) 后退出, 不下载也不写 GitHub
+        self.check_only = (
+            os.environ.get("CHECK_ONLY", "False").lower().strip() == "true"
+        )
+        self.plan_path = os.environ.get(
+            "PLAN_PATH", os.path.join(self.temp_path, "plan.json")
+        )
 
     def load_attributes(self):
         attributes = inspect.getmembers(self, lambda a: not (inspect.isroutine(a)))
@@ -122,7 +300,7 @@ class Configure:
                 setattr(self, property_name, value)
 
 
-@log_entry
+@traced
 def full_href(base: str, path: str) -> str:
     if path.startswith("http://") or path.startswith("https://"):
         return path
@@ -130,89 +308,331 @@ def full_href(base: str, path: str) -> str:
         return urljoin(base, path)
 
 
-@log_entry
+class HrefExtractor(HTMLParser):
+    """
+    边读边解析, 只收集 <a href> 中匹配 regexp 的链接, 不建立 DOM
+    """
+
+    def __init__(self, base_url: str, regexp: re.Pattern[str]):
+        super().__init__(convert_charrefs=True)
+        self.base_url = base_url
+        self.regexp = regexp
+        self.links: dict[str, str] = dict()
+
+    def handle_starttag(self, tag: str, attrs: list[tuple[str, Optional[str]]]):
+        if tag != "a":
+            return
+        for name, value in attrs:
+            if name != "href" or value is None:
+                continue
+            result: list = self.regexp.findall(value)
+            if len(result) > 0:
+                # full_name = result[0][0]
+                version = result[0][1]
+                self.links[version] = full_href(self.base_url, value)
+
+
+@traced
 def analyse_tags_links(
     html: str, base_url: str, regexp: re.Pattern[str]
 ) -> dict[str, str]:
 
-    links: dict[str, str] = dict()
-    soup = BeautifulSoup(html, "html.parser")
-    tags = soup.find_all("a")
-    for link in tags:
-        href: str = f'{link.get("href")}'
-        result: list = regexp.findall(href)
-        if len(result) > 0:
-            # full_name = result[0][0]
-            version = result[0][1]
-            href = full_href(base_url, href)
-            print(f"full->{href}")
-            links[version] = href
-    return links
+    extractor = HrefExtractor(base_url, regexp)
+    extractor.feed(html)
+    extractor.close()
+    return extractor.links
+
+
+MOBILE_VLC_KIT_LINK = re.compile(
+    r"(MobileVLCKit-(\d+\.\d+\.\d+)([^\w]([\d\w\-])*){0,1}\.((tar.xz)|(zip)))"
+)
 
 
-@log_entry
-def get_mobile_vlc_kit_links(href: str) -> dict[str, str]:
-    text: str = requests.get(href).text
-    regexp = re.compile(
-        r"(MobileVLCKit-(\d+\.\d+\.\d+)([^\w]([\d\w\-])*){0,1}\.((tar.xz)|(zip)))"
+@traced
+def get_mobile_vlc_kit_links(
+    href: str,
+    manifest: Optional[StateManifest] = None,
+    configure: Optional[Configure] = None,
+) -> dict[str, str]:
+    """
+    :param manifest: 记录了上次索引的 ETag/Last-Modified 时发条件请求,
+                     没有变化 (304) 时直接使用其中记录的版本;
+                     索引有变化时检查已完成版本的源文件是否被重新发布
+    """
+    headers: dict[str, str] = dict()
+    known = (
+        manifest is not None
+        and manifest.index.get("url") == href
+        and len(manifest.links()) > 0
     )
-    return analyse_tags_links(text, href, regexp)
+    if known:
+        if manifest.index.get("etag"):
+            headers["If-None-Match"] = manifest.index["etag"]
+        if manifest.index.get("last_modified"):
+            headers["If-Modified-Since"] = manifest.index["last_modified"]
+    timeout = configure.download_timeout if configure is not None else 60
+    with Http.get(href, headers=headers, stream=True, timeout=timeout) as response:
+        if known and response.status_code == 304:
+            print(f"{href} not modified, use state manifest")
+            return manifest.links()
+        extractor = HrefExtractor(href, MOBILE_VLC_KIT_LINK)
+        decoder = codecs.getincrementaldecoder(response.encoding or "utf-8")(
+            errors="replace"
+        )
+        size = 0
+        for chunk in response.iter_content(64 * 1024):
+            size += len(chunk)
+            extractor.feed(decoder.decode(chunk))
+        extractor.feed(decoder.decode(b"", final=True))
+        extractor.close()
+    links = extractor.links
+    Trace.annotate(status=response.status_code, bytes=size, links=len(links))
+    print(f"{href} http {response.status_code}: {size} bytes, {len(links)} versions")
+    if manifest is not None and response.status_code == 200:
+        index = {
+            "url": href,
+            "etag": response.headers.get("etag"),
+            "last_modified": response.headers.get("last-modified"),
+        }
+        if index != manifest.index:
+            manifest.index = index
+            manifest.changed = True
+        if configure is not None:
+            check_republished_sources(links, manifest, configure)
+        for version, url in links.items():
+            manifest.update(version, source_url=url)
+    return links
+
+
+@traced
+def check_republished_sources(
+    links: dict[str, str], manifest: StateManifest, configure: Configure
+) -> list[str]:
+    """
+    HEAD 已记录 ETag/大小 的源文件 (并发, 只在索引变化时), 与清单不同时说明上游重新发布了同名文件
+    :return: 被重新发布的版本
+    """
+    checks: dict[str, str] = dict()
+    for version, url in links.items():
+        entry = manifest.get(version)
+        if entry is None or entry.get("source_url") != url:
+            continue
+        if entry.get("etag") is None and entry.get("size") is None:
+            continue
+        checks[version] = url
+    republished: list[str] = []
+    if len(checks) == 0:
+        return republished
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(1, configure.pipeline_network_limit) * 2
+    ) as executor:
+        metas = dict(
+            zip(
+                checks.keys(),
+                executor.map(
+                    lambda url: source_metadata(url, configure), checks.values()
+                ),
+            )
+        )
+    for version, meta in metas.items():
+        if len(meta) == 0:
+            continue
+        entry = manifest.get(version)
+        changed = [
+            key
+            for key in ("etag", "size")
+            if entry.get(key) is not None
+            and meta.get(key) is not None
+            and entry[key] != meta[key]
+        ]
+        if len(changed) > 0:
+            print(
+                f"warning: {version} republished upstream ({', '.join(changed)} changed), "
+                f"{entry.get('asset_url')} was built from the old archive"
+            )
+            manifest.update(version, republished=True, **meta)
+            republished.append(version)
+    Trace.annotate(checked=len(checks), republished=len(republished))
+    Metrics.set_gauge("republished_versions", len(republished))
+    return republished
 
 
-@log_entry
+@traced
 def get_mobile_vlc_kit_releases_assets(
     config: Configure,
     github: Optional[Github],
     repo: Optional[Repository.Repository],
     release: Optional[GitRelease.GitRelease],
+    digests: Optional[dict[str, str]] = None,
 ) -> tuple[
     dict[str, str],
     Optional[Github],
     Optional[Repository.Repository],
     Optional[GitRelease.GitRelease],
 ]:
-    github, repo, release = setup_github_if_need(github, repo, release, config)
+    """
+    :param digests: 写入 版本 -> GitHub 记录的资源 sha256 (有 digest 字段时)
+    """
     result: dict[str, str] = dict()
+    release_id = github_release_id(config)
+    if release_id is None:
+        return result, github, repo, release
     regexp = re.compile(r"MobileVLCKit-(\d+\.\d+\.\d+)\.xcframework\.zip")
-    assets: PaginatedList.PaginatedList = release.get_assets()
-    for idx in range(0, assets.totalCount):
-        asset: GitReleaseAsset.GitReleaseAsset = assets[idx]
-        # asset.browser_download_url
-        name = asset.name
+    # 按页读取 (有 ETag 缓存), 不再用 totalCount + 下标逐个请求
+    for asset in github_api(config).release_assets(
+        config.github_owner_name, config.github_repo_name, release_id
+    ):
+        name = asset.get("name")
         if name is not None:
             reg_result: list = regexp.findall(name)
             if reg_result is not None and len(reg_result) > 0:
                 version = reg_result[0]
-                result[version] = asset.browser_download_url
+                result[version] = asset["browser_download_url"]
+                digest = asset.get("digest") or ""
+                if digests is not None and digest.startswith("sha256:"):
+                    digests[version] = digest[len("sha256:"):]
         else:
             print(f"name=>{name}")
     return result, github, repo, release
 
 
-@log_entry
+@traced
 def get_mobile_vlc_kit_tags(
     config: Configure,
     github: Optional[Github],
     repo: Optional[Repository.Repository],
 ) -> tuple[dict[str, str], Optional[Github], Optional[Repository.Repository]]:
-    github, repo, _ = setup_github_if_need(github, repo, None, config)
-    tags: PaginatedList.PaginatedList = repo.get_tags()
     result: dict[str, str] = dict()
-    for idx in range(0, tags.totalCount):
-        tag: Tag.Tag = tags[idx]
-        version = tag.name
-        result[version] = tag.zipball_url
+    for tag in github_api(config).tags(config.github_owner_name, config.github_repo_name):
+        version = tag["name"]
+        result[version] = tag["zipball_url"]
     return result, github, repo
 
 
-@log_entry
+def state_asset_url(configure: Configure) -> str:
+    return (
+        f"https://github.com/{configure.github_owner_name}/{configure.github_repo_name}"
+        f"/releases/download/{configure.github_release_name}/{configure.state_asset_name}"
+    )
+
+
+@traced
+def load_state_manifest(configure: Configure) -> StateManifest:
+    """
+    先读本地的状态清单, 没有时下载 release 中保存的, 都没有时返回空清单 (全量扫描)
+    """
+    manifest = StateManifest.load(configure.state_path)
+    if manifest is not None:
+        print(f"state manifest {configure.state_path}: {len(manifest.versions)} versions")
+        return manifest
+    if len(configure.state_asset_name) > 0 and len(configure.github_repo_name) > 0:
+        url = state_asset_url(configure)
+        try:
+            response = Http.get(url, timeout=configure.download_timeout)
+            if response.status_code == 200:
+                manifest = StateManifest.from_bytes(response.content)
+            else:
+                print(f"state manifest {url}: http {response.status_code}")
+        except requests.RequestException as e:
+            print(f"state manifest {url} exception {e}")
+    if manifest is None:
+        return StateManifest()
+    print(f"state manifest {configure.state_asset_name}: {len(manifest.versions)} versions")
+    return manifest
+
+
+@traced
+def save_state_manifest(
+    manifest: StateManifest,
+    configure: Configure,
+    github: Optional[Github],
+    repo: Optional[Repository.Repository],
+    release: Optional[GitRelease.GitRelease],
+) -> tuple[
+    Optional[Github], Optional[Repository.Repository], Optional[GitRelease.GitRelease]
+]:
+    """
+    保存到本地; 版本有变化时替换 release 中的状态清单资源
+    """
+    manifest.save(configure.state_path)
+    if not manifest.changed or len(configure.state_asset_name) == 0:
+        return github, repo, release
+    github, repo, release = setup_github_if_need(github, repo, release, configure)
+    data = manifest.to_bytes()
+    # release 返回的数据中已经带有资源列表, 不需要分页列出
+    for asset in release.assets:
+        if asset.name == configure.state_asset_name:
+            asset.delete_asset()
+    release.upload_asset_from_memory(
+        io.BytesIO(data),
+        len(data),
+        configure.state_asset_name,
+        content_type="application/json",
+    )
+    manifest.changed = False
+    print(f"state manifest uploaded {len(manifest.versions)} versions")
+    return github, repo, release
+
+
+def reconcile_state_manifest(
+    manifest: StateManifest,
+    vlc_links: dict[str, str],
+    github_tags: dict[str, str],
+    github_file_links: dict[str, str],
+):
+    """
+    用全量列出的 tag 和 release 资源校正清单
+    """
+    for version, url in vlc_links.items():
+        manifest.update(
+            version,
+            source_url=url,
+            asset_url=github_file_links.get(version),
+            tagged=True if version in github_tags else None,
+        )
+
+
+@traced
+def source_metadata(url: str, configure: Configure) -> dict:
+    """
+    :return: 上游文件的 etag, last_modified, size (HEAD 请求), 失败时为空
+    """
+    try:
+        response = Http.head(
+            url, allow_redirects=True, timeout=configure.download_timeout
+        )
+    except requests.RequestException as e:
+        print(f"head {url} exception {e}")
+        return dict()
+    if response.status_code != 200:
+        return dict()
+    return response_metadata(response.headers)
+
+
+def response_metadata(headers: typing.Mapping[str, str]) -> dict:
+    """
+    :return: 完整响应 (200) 头中的 etag, last_modified, size
+    """
+    length = headers.get("content-length")
+    return {
+        "etag": headers.get("etag"),
+        "last_modified": headers.get("last-modified"),
+        "size": int(length) if length is not None else None,
+    }
+
+
+@traced
 def mkdirs(path: str):
     if not os.path.exists(path):
         mkdirs(os.path.dirname(path))
-        os.mkdir(path)
+        try:
+            os.mkdir(path)
+        except FileExistsError:
+            # 其他流水线线程同时创建了
+            pass
 
 
-@log_entry
+@traced
 def temp_do(do_func: typing.Callable[[str], bool], path: str, label: str) -> bool:
     if os.path.exists(path):
         print(f"{label} target path is exists")
@@ -244,54 +664,434 @@ def temp_do(do_func: typing.Callable[[str], bool], path: str, label: str) -> boo
     return result
 
 
-@log_entry
-def download_file(url: str, local_filename: str):
-    printLine()
-    if os.path.exists(local_filename):
-        print(f"try download {url} file exists using cache")
+@traced
+def load_download_meta(meta_path: str) -> dict:
+    if os.path.exists(meta_path):
+        try:
+            with open(meta_path) as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            pass
+    return dict()
+
+
+def parse_content_range(value: Optional[str]) -> tuple[Optional[int], Optional[int]]:
+    # 例如 bytes 1024-2047/4096
+    if value is None:
+        return None, None
+    match = re.match(r"bytes\s+(\d+)-\d+/(\d+|\*)", value.strip())
+    if match is None:
+        return None, None
+    total = match.group(2)
+    return int(match.group(1)), None if total == "*" else int(total)
+
+
+def hash_file_prefix(path: str, size: int):
+    _256 = hashlib.sha256()
+    with open(path, "rb") as fp:
+        while size > 0:
+            block = fp.read(min(size, 1024 * 1024))
+            if len(block) == 0:
+                break
+            _256.update(block)
+            size -= len(block)
+    return _256
+
+
+@traced
+def resume_download(
+    url: str, temp: str, meta_path: str, timeout: float, digest: dict
+) -> bool:
+    """
+    从 temp 已下载的位置继续下载 (Range + If-Range), 服务器文件变化时从头下载
+    :param digest: {"sha256", "size"} 跨多次尝试保存的 sha256 状态, 写入时同步更新
+    :return: temp 是否已经完整
+    """
+    meta = load_download_meta(meta_path)
+    offset = os.path.getsize(temp) if os.path.exists(temp) else 0
+    if "segments" in meta:
+        # segmented_download 预分配的文件, 大小不代表已下载的字节数
+        meta = dict()
+        offset = 0
+    validator = download_validator(meta)
+    headers = {"Accept-Encoding": "identity"}
+    if offset > 0 and validator is not None:
+        headers["Range"] = f"bytes={offset}-"
+        headers["If-Range"] = validator
+    block_size = 1024 * 1024  # 1 M bit
+    with Http.get(url, stream=True, headers=headers, timeout=timeout) as response:
+        if response.status_code == 416 and "Range" in headers:
+            # 已下载的部分就是整个文件
+            return offset == meta.get("size")
+        response.raise_for_status()
+        mode = "wb"
+        if response.status_code == 206:
+            start, total = parse_content_range(response.headers.get("content-range"))
+            if "Range" not in headers:
+                raise requests.RequestException(f"download {url} unexpected partial content")
+            if start != offset:
+                # 部分内容不能当作整个文件写入, 丢弃已下载的部分后不带 Range 重新请求
+                print(f"download {url} range starts at {start} not {offset}, restart")
+                response.close()
+                remove_path(temp)
+                remove_path(meta_path)
+                digest.clear()
+                return resume_download(url, temp, meta_path, timeout, digest)
+            mode = "ab"
+            if total is not None:
+                meta["size"] = total
+        if mode == "wb":
+            if offset > 0:
+                print(f"download {url} can not resume at {offset}, restart")
+            length = response.headers.get("content-length")
+            meta = {
+                "url": url,
+                "etag": response.headers.get("etag"),
+                "last_modified": response.headers.get("last-modified"),
+                "size": int(length) if length is not None else None,
+            }
+        else:
+            print(f"download {url} resume at {offset}")
+        with open(meta_path, "w") as fp:
+            json.dump(meta, fp)
+        if mode == "wb":
+            offset = 0
+            digest["sha256"] = hashlib.sha256()
+        elif digest.get("size") != offset:
+            # 已有的部分是之前的运行写入的
+            digest["sha256"] = hash_file_prefix(temp, offset)
+        digest["size"] = offset
+        with open(temp, mode) as file:
+            writer = HashingWriter(file, digest["sha256"], offset)
+            try:
+                for data in response.iter_content(block_size):
+                    writer.write(data)
+            finally:
+                digest["size"] = writer.position
+    size = meta.get("size")
+    return size is None or os.path.getsize(temp) == size
+
+
+def retryable_download_error(error: Exception) -> bool:
+    """
+    4xx 响应 (408, 429 除外) 重试也不会成功, 不再等待重试
+    """
+    if not isinstance(error, requests.HTTPError) or error.response is None:
         return True
+    status = error.response.status_code
+    return not (400 <= status < 500) or status in (408, 429)
+
+
+def download_validator(meta: dict) -> Optional[str]:
+    validator = meta.get("etag")
+    if validator is None or validator.startswith("W/"):
+        # 弱 etag 不能用于 If-Range
+        validator = meta.get("last_modified")
+    return validator
+
+
+def downloaded_bytes(temp: str, meta_path: str) -> int:
+    meta = load_download_meta(meta_path)
+    if "segments" in meta:
+        return sum(done for _, _, done in meta["segments"])
+    return os.path.getsize(temp) if os.path.exists(temp) else 0
+
+
+@traced
+def segmented_download(
+    url: str,
+    temp: str,
+    meta_path: str,
+    segments: int,
+    min_segment_size: int,
+    timeout: float,
+) -> Optional[bool]:
+    """
+    多连接分段下载到预分配的 temp 文件, 每段的进度记录在 meta 中以便续传
+    :return: None 表示服务器不支持 Range (或文件太小), 需要回退到单连接下载
+    """
+    with Http.head(
+        url,
+        allow_redirects=True,
+        headers={"Accept-Encoding": "identity"},
+        timeout=timeout,
+    ) as response:
+        response.raise_for_status()
+        length = response.headers.get("content-length")
+        accept_ranges = response.headers.get("accept-ranges", "").lower()
+        remote = {
+            "url": url,
+            "etag": response.headers.get("etag"),
+            "last_modified": response.headers.get("last-modified"),
+            "size": int(length) if length is not None else None,
+        }
+    size = remote["size"]
+    validator = download_validator(remote)
+    if size is None or accept_ranges != "bytes" or validator is None:
+        return None
 
-    def _download(temp: str) -> bool:
-        printLine()
-        response = requests.get(url, stream=True)
-        t = int(response.headers.get("content-length", 0))
-        block_size = 1024 * 1024  # 1 M bit
-        with open(temp, "wb") as file:
-            for data in response.iter_content(block_size):
-                file.write(data)
-        printLine()
-        if os.path.getsize(temp) == t:
+    meta = load_download_meta(meta_path)
+    same_file = (
+        meta.get("size") == size
+        and download_validator(meta) == validator
+        and os.path.exists(temp)
+    )
+    if same_file and "segments" in meta:
+        plan = meta["segments"]
+    else:
+        # 单连接下载的部分文件作为已完成的第一段
+        offset = os.path.getsize(temp) if same_file else 0
+        count = min(segments, (size - offset) // max(1, min_segment_size))
+        if count <= 1 and offset == 0:
+            return None
+        count = max(1, count)
+        step = (size - offset + count - 1) // count
+        plan = [[0, offset - 1, offset]] if offset > 0 else []
+        for start in range(offset, size, step):
+            plan.append([start, min(size, start + step) - 1, 0])
+        with open(temp, "ab") as fp:
+            fp.truncate(size)
+    meta = dict(remote)
+    meta["segments"] = plan
+    lock = threading.Lock()
+
+    def _save_meta():
+        with open(meta_path, "w") as fp:
+            json.dump(meta, fp)
+
+    _save_meta()
+
+    def _fetch(segment: list[int]) -> bool:
+        start, end, done = segment
+        if start + done > end:
             return True
-        printLine()
-        return False
+        headers = {
+            "Accept-Encoding": "identity",
+            "Range": f"bytes={start + done}-{end}",
+            "If-Range": validator,
+        }
+        with Http.get(url, stream=True, headers=headers, timeout=timeout) as r:
+            r.raise_for_status()
+            range_start, _ = parse_content_range(r.headers.get("content-range"))
+            if r.status_code != 206 or range_start != start + done:
+                print(f"download {url} segment {start}-{end} not served as range")
+                return False
+            with open(temp, "r+b") as fp:
+                fp.seek(start + done)
+                unsaved = 0
+                for data in r.iter_content(1024 * 1024):
+                    fp.write(data)
+                    with lock:
+                        segment[2] += len(data)
+                        unsaved += len(data)
+                        if unsaved >= 16 * 1024 * 1024:
+                            fp.flush()
+                            _save_meta()
+                            unsaved = 0
+        return start + segment[2] > end
+
+    print(f"download {url} with {len(plan)} segments")
+    results: list[bool] = []
+    with concurrent.futures.ThreadPoolExecutor(len(plan)) as executor:
+        futures = [executor.submit(_fetch, segment) for segment in plan]
+        for future in futures:
+            try:
+                results.append(future.result())
+            except (requests.RequestException, OSError) as e:
+                print(f"download {url} segment exception {e}")
+                results.append(False)
+    _save_meta()
+    return all(results) and os.path.getsize(temp) == size
+
+
+@traced
+def download_file(
+    url: str,
+    local_filename: str,
+    expected_sha256: Optional[str] = None,
+    retries: int = 5,
+    backoff: float = 2.0,
+    timeout: float = 60,
+    segments: int = 1,
+    min_segment_size: int = 64 * 1024 * 1024,
+    source_meta: Optional[dict] = None,
+) -> bool:
+    """
+    可续传下载, 文件完整 (大小一致, 指定 expected_sha256 时 hash 一致) 后才会重命名为 local_filename
+    :param source_meta: 下载成功时写入服务器返回的 etag, last_modified, size
+    :param retries: 没有任何进展的连续失败次数上限
+    :param backoff: 重试等待的基础秒数, 每次失败翻倍
+    :param segments: 大于 1 时按 Range 多连接并行下载, 服务器不支持时回退到单连接
+    :param min_segment_size: 每段的最小字节数
+    """
+    Trace.mark()
+    if os.path.exists(local_filename):
+        if expected_sha256 is None or file_sha256(local_filename) == expected_sha256:
+            print(f"try download {url} file exists using cache")
+            return True
+        # 旧的或不完整的文件, 删除后重新下载
+        print(f"try download {url} cached file sha256 mismatch, download again")
+        remove_path(local_filename)
+        remove_path(digest_path(local_filename))
+
+    temp = f"{local_filename}_temp"
+    meta_path = f"{temp}.json"
+    mkdirs(os.path.dirname(temp))
+    if os.path.isdir(temp):
+        shutil.rmtree(temp)
+    failures = 0
+    segmented = segments > 1
+    digest: dict = dict()
+    while True:
+        before = downloaded_bytes(temp, meta_path)
+        complete = False
+        try:
+            if segmented:
+                result = segmented_download(
+                    url, temp, meta_path, segments, min_segment_size, timeout
+                )
+                if result is None:
+                    print(f"download {url} fall back to a single stream")
+                    segmented = False
+                    continue
+                complete = result
+            else:
+                complete = resume_download(url, temp, meta_path, timeout, digest)
+        except (requests.RequestException, OSError) as e:
+            print(f"download {url} exception {e}")
+            if not retryable_download_error(e):
+                return False
+        if complete:
+            if digest.get("size") == os.path.getsize(temp):
+                sha = digest["sha256"].hexdigest()
+            else:
+                # 分段下载不是按顺序写入的
+                sha = file_sha256(temp)
+            if expected_sha256 is None or sha == expected_sha256:
+                break
+            print(f"download {url} sha256 mismatch, discard")
+            remove_path(temp)
+            remove_path(meta_path)
+            digest.clear()
+        after = downloaded_bytes(temp, meta_path)
+        if after <= before:
+            failures += 1
+        else:
+            failures = 0
+        if failures > retries:
+            print(f"download {url} fail after {retries} retries")
+            return False
+        delay = backoff * (2 ** max(0, failures - 1))
+        print(f"download {url} retry in {delay}s ({after} bytes kept)")
+        time.sleep(delay)
+    os.rename(temp, local_filename)
+    if source_meta is not None:
+        meta = load_download_meta(meta_path)
+        source_meta.update(
+            {key: meta.get(key) for key in ("etag", "last_modified", "size")}
+        )
+    remove_path(meta_path)
+    write_digest(local_filename, sha)
+    print(f"download {url} success")
+    size = os.path.getsize(local_filename)
+    Trace.annotate(bytes=size, segmented=segmented)
+    Metrics.add("bytes_in", size)
+    Metrics.add("download_bytes", size)
+    return True
+
+
+@traced
+def download_file_with_configure(
+    url: str,
+    local_filename: str,
+    configure: Configure,
+    expected_sha256: Optional[str] = None,
+    source_meta: Optional[dict] = None,
+) -> bool:
+    return download_file(
+        url,
+        local_filename,
+        expected_sha256=expected_sha256,
+        source_meta=source_meta,
+        retries=configure.download_retries,
+        backoff=configure.download_backoff,
+        timeout=configure.download_timeout,
+        segments=configure.download_segments,
+        min_segment_size=configure.download_min_segment_size,
+    )
+
 
-    printLine()
-    return temp_do(_download, local_filename, f"download {url}")
+@traced
+def untar(
+    src_file: str,
+    dest_path: str,
+    target_name: str,
+    mode: str = "r|*",
+    buffer_size: int = 1024 * 1024,
+    xz_workers: int = 1,
+    xz_index_path: Optional[str] = None,
+    accept: Optional[typing.Callable[[str, bool], bool]] = None,
+) -> Optional[dict[str, str]]:
+    """
+    以流模式 (r|xz) 顺序解压一遍, 只写出 target_name 子树中的文件;
+    其他成员只会被解码跳过, 不会写到磁盘
+    :param buffer_size: 流模式读取压缩数据的缓冲区大小
+    :param xz_workers: 大于 1 时多 block 的 xz 文件按 block 多进程并行解码
+    :param xz_index_path: 保存 成员->偏移 索引的目录, 再次解压时只解码需要的 block
+    :param accept: (从 target_name 开始的路径, 是否目录) -> 是否解压, 进一步筛选子树
+    :return: 解压出的 名字->相对路径 索引 (同时保存在 dest_path 旁), 失败返回 None
+    """
+    index: dict[str, str] = dict()
 
+    def _match(member: tarfile.TarInfo) -> bool:
+        matched = member.name.endswith(target_name) or member.path.find(target_name) >= 0
+        if matched and not accept_member(member.name, member.isdir(), target_name, accept):
+            return False
+        if matched:
+            index_member(index, member.name)
+        return matched
 
-@log_entry
-def untar(src_file: str, dest_path: str, target_name: str, mode: str = "r"):
     # base_name = os.path.basename(src_file)
     def _untar(temp_path: str) -> bool:
+        if xz_workers > 1 and mode.endswith("xz"):
+            result = XzParallel.extract_tar(
+                src_file, temp_path, _match, xz_workers, xz_index_path, buffer_size
+            )
+            if result is not None:
+                return result
+            # 只有一个 block, 不能并行解码
         found = False
-        with tarfile.open(src_file, mode) as input_fp:
-            for member in input_fp.getmembers():
-                if (
-                    member.name.endswith(target_name)
-                    or member.path.find(target_name) >= 0
-                ):
-                    mkdirs(temp_path)
+        with tarfile.open(src_file, mode, bufsize=buffer_size) as input_fp:
+            for member in input_fp:
+                if _match(member):
+                    if not found:
+                        mkdirs(temp_path)
                     input_fp.extract(member, temp_path)
                     found = True
                 # else:
                 #     print(f'{base_name}-> {member.path}:{member.name}')
         return found
 
-    temp_do(_untar, dest_path, f"untar {src_file}")
-
+    if not temp_do(_untar, dest_path, f"untar {src_file}"):
+        return None
+    Trace.annotate(members=len(index))
+    write_extract_index(dest_path, index)
+    return index
+
+
+@traced
+def unzip(
+    src_file: str,
+    dest_path: str,
+    target_name: str,
+    accept: Optional[typing.Callable[[str, bool], bool]] = None,
+) -> Optional[dict[str, str]]:
+    """
+    :param accept: (从 target_name 开始的路径, 是否目录) -> 是否解压, 进一步筛选子树
+    :return: 解压出的 名字->相对路径 索引 (同时保存在 dest_path 旁), 失败返回 None
+    """
+    index: dict[str, str] = dict()
 
-@log_entry
-def unzip(src_file: str, dest_path: str, target_name: str):
     def _unzip(temp_path: str) -> bool:
         # unzip_dir_temp = f"{unzip_dir}_temp"
         # if os.path.exists(unzip_dir_temp):
@@ -302,19 +1102,78 @@ def unzip(src_file: str, dest_path: str, target_name: str):
         input_fp = zipfile.ZipFile(src_file)
         found = False
         for member in input_fp.infolist():
-            if member.filename.find(target_name) >= 0:
+            if member.filename.find(target_name) >= 0 and accept_member(
+                member.filename, member.is_dir(), target_name, accept
+            ):
                 mkdirs(temp_path)
                 input_fp.extract(member, temp_path)
+                index_member(index, member.filename)
                 found = True
             # else:
             #     print(member.filename)
         input_fp.close()
         return found
 
-    temp_do(_unzip, dest_path, f"unzip {src_file}")
+    if not temp_do(_unzip, dest_path, f"unzip {src_file}"):
+        return None
+    write_extract_index(dest_path, index)
+    return index
+
 
+def accept_member(
+    name: str,
+    is_dir: bool,
+    target_name: str,
+    accept: Optional[typing.Callable[[str, bool], bool]],
+) -> bool:
+    parts = [part for part in name.split("/") if part != ""]
+    if accept is None or target_name not in parts:
+        return True
+    return accept("/".join(parts[parts.index(target_name) :]), is_dir)
+
+
+def index_member(index: dict[str, str], name: str):
+    """
+    记录成员路径上每一级的 名字->相对路径, 同名时保留最浅的一个
+    """
+    parts = [part for part in name.split("/") if part not in ("", ".")]
+    for position, part in enumerate(parts):
+        known = index.get(part)
+        if known is None or known.count("/") > position:
+            index[part] = "/".join(parts[: position + 1])
+
+
+def extract_index_path(dest_path: str) -> str:
+    return f"{dest_path}.index.json"
 
-@log_entry
+
+@traced
+def write_extract_index(dest_path: str, index: dict[str, str]):
+    # 解压目标已存在 (没有真的解压) 时保留原来的索引
+    if len(index) == 0:
+        return
+    with open(extract_index_path(dest_path), "w") as fp:
+        json.dump({"format": 1, "first": index}, fp)
+
+
+@traced
+def extracted_member_path(base_path: str, target_name: str) -> Optional[str]:
+    """
+    先查解压时保存的索引, 没有索引 (如缓存中的解压结果) 时再搜索目录
+    """
+    index_path = extract_index_path(base_path)
+    if os.path.exists(index_path):
+        with open(index_path) as fp:
+            index = json.load(fp)
+        relative = index.get("first", dict()).get(target_name)
+        if index.get("format") == 1 and relative is not None:
+            found = os.path.join(base_path, relative)
+            if os.path.lexists(found):
+                return found
+    return file_tree_search_first(base_path, target_name)
+
+
+@traced
 def unxz(src_file: str, dest_path: str):
     def _unxz(temp_path: str) -> bool:
         with lzma.open(src_file, "rb") as input_fp:
@@ -326,97 +1185,169 @@ def unxz(src_file: str, dest_path: str):
     return temp_do(_unxz, dest_path, f"unxz {src_file}")
 
 
-@log_entry
+@traced
 def convert_framework_to_xcframework(
     framework: str, xcframework: str, configure: Configure
 ) -> bool:
     mkdirs(xcframework)
     system_path = os.getenv("PATH")
-    if len(configure.lipo_path) == 0:
-        return False
     full_path = configure.lipo_path
-    if not os.path.exists(configure.lipo_path):
+    if len(configure.lipo_path) > 0 and not os.path.exists(configure.lipo_path):
         for path in system_path.split(":"):
             full_path = os.path.join(path, configure.lipo_path)
             if os.path.exists(full_path):
                 configure.lipo_path = full_path
+                break
+    lipo_path: Optional[str] = full_path
+    if len(full_path) == 0 or not os.path.exists(full_path):
+        # 没有 lipo (如 linux) 时用内置的 Mach-O 解析
+        print(f"lipo {configure.lipo_path} not found, use MachO")
+        lipo_path = None
 
-    if os.path.exists(full_path):
-        framework_name = os.path.basename(framework)
-        # framework_binary_name = os.path.splitext(framework_name)[0]
-        binary_archives: list[str] = lipo_info(framework, full_path)
-        parts: list[(list[str], bool)] = []
-        simulator_architecture = ["arm64", "i386", "x86_64"]
-        devices_architecture = ["arm64", "armv7", "armv7s"]
-        if len(binary_archives) > 0:
-            pick_architecture(binary_archives, devices_architecture, False, parts)
-            pick_architecture(binary_archives, simulator_architecture, True, parts)
-            info_plist = os.path.join(xcframework, "Info.plist")
-            architecture_parts: list[(str, list[str])] = generate_info_plist(
-                parts, info_plist, framework_name
-            )
-            for part in architecture_parts:
-                name, infos = part
-                generate_frameworks(
-                    framework, os.path.join(xcframework, name), infos, full_path
-                )
-    return False
+    framework_name = os.path.basename(framework)
+    # framework_binary_name = os.path.splitext(framework_name)[0]
+    binary_archives: list[str] = lipo_info(framework, lipo_path)
+    parts: list[(list[str], bool)] = []
+    simulator_architecture = ["arm64", "i386", "x86_64"]
+    devices_architecture = ["arm64", "armv7", "armv7s"]
+    if len(binary_archives) == 0:
+        print(f"convert {framework} no known architecture")
+        return False
+    pick_architecture(binary_archives, devices_architecture, False, parts)
+    pick_architecture(binary_archives, simulator_architecture, True, parts)
+    # 先写到临时文件, 所有 slice 都成功后才放到 Info.plist
+    info_plist = os.path.join(xcframework, "Info.plist")
+    info_plist_temp = f"{info_plist}_temp"
+    architecture_parts: list[(str, list[str])] = generate_info_plist(
+        parts, info_plist_temp, framework_name
+    )
+    failed: list[str] = []
+    workers = max(1, min(configure.slice_workers, len(architecture_parts)))
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        futures = {
+            executor.submit(
+                generate_frameworks,
+                framework,
+                os.path.join(xcframework, name),
+                infos,
+                lipo_path,
+            ): name
+            for name, infos in architecture_parts
+        }
+        for future in concurrent.futures.as_completed(futures):
+            name = futures[future]
+            try:
+                ok = future.result()
+            except Exception as e:
+                print(f"convert slice {name} exception {e}")
+                traceback.print_exc()
+                ok = False
+            if not ok:
+                print(f"convert slice {name} fail")
+                failed.append(name)
+    if len(failed) > 0:
+        os.unlink(info_plist_temp)
+        print(f"convert {framework} failed slices: {' '.join(sorted(failed))}")
+        return False
+    os.rename(info_plist_temp, info_plist)
+    return True
 
 
-@log_entry
-def copy_file_or_dir(src: str, new_full: str):
+@traced
+def copy_file_or_dir(
+    src: str,
+    new_full: str,
+    stats: Optional[CopyStats] = None,
+):
+    """
+    复制解压出的文件 (只读, 允许硬链接), 依次尝试 reflink / 硬链接 / copy_file_range / 普通复制
+    """
     print(f"src={src}")
-    if os.path.isdir(src):
-        shutil.copytree(src, new_full)
-    else:
-        shutil.copyfile(src, new_full)
+    copy_tree(src, new_full, hardlink=True, stats=stats)
 
 
-@log_entry
+@traced
 def generate_frameworks(
-    framework: str, xcframework: str, architectures: list[str], lipo_path: str
+    framework: str,
+    xcframework: str,
+    architectures: list[str],
+    lipo_path: Optional[str],
 ) -> bool:
+    """
+    :param lipo_path: 二进制不能被 MachO 解析时使用的 lipo, 为 None 时失败
+    """
     framework_name = os.path.basename(framework)
     framework_binary_name = os.path.splitext(framework_name)[0]
     framework_binary_path = os.path.join(framework, framework_binary_name)
     new_framework_path = os.path.join(xcframework, framework_name)
     new_framework_binary_path = os.path.join(new_framework_path, framework_binary_name)
-    mkdirs(new_framework_path)
+    stats = CopyStats()
     if len(architectures) > 1:
-        architecture_temp_path_list: list[str] = []
-        architecture_temp_path_raw_list = []
-        for architecture in architectures:
-            architecture_temp_path = f"{framework_binary_path}_{architecture}"
-            shell = Shell(
-                f'{lipo_path} -thin {architecture} "{framework_binary_path}" -output "{architecture_temp_path}"'
-            )
-            shell.run()
-            if shell.ret_code != 0:
-                return False
-            architecture_temp_path_list.append(f'"{architecture_temp_path}"')
-            architecture_temp_path_raw_list.append(architecture_temp_path)
-        temps = " ".join(architecture_temp_path_list)
-        shell = Shell(
-            f'{lipo_path} -create {temps} -output "{new_framework_binary_path}"'
+        mkdirs(new_framework_path)
+        # 各架构按偏移直接从原文件复制到新的 fat 文件, 不生成每个架构的临时文件
+        copied = MachO.extract(
+            framework_binary_path, architectures, new_framework_binary_path
         )
-        shell.run()
-        for path in architecture_temp_path_raw_list:
-            os.unlink(path)
-
-        if shell.ret_code != 0:
+        if copied is not None:
+            print(
+                f"{new_framework_binary_path} {' '.join(architectures)}: "
+                f"{copied} bytes copied, "
+                f"peak disk {os.path.getsize(new_framework_binary_path)} bytes"
+            )
+        elif lipo_path is None or not lipo_thin_create(
+            framework_binary_path,
+            architectures,
+            new_framework_binary_path,
+            lipo_path,
+        ):
             return False
         # copy other files
         for name in os.listdir(framework):
             full = os.path.join(framework, name)
             new_full = os.path.join(new_framework_path, name)
             if not os.path.exists(new_full):
-                copy_file_or_dir(full, new_full)
+                copy_file_or_dir(full, new_full, stats)
     else:
-        copy_file_or_dir(framework, new_framework_path)
+        copy_file_or_dir(framework, new_framework_path, stats=stats)
+    print(f"{new_framework_path} copy {stats}")
+    Trace.annotate(copied_bytes=stats.written_bytes, architectures=architectures)
+    return True
+
+
+@traced
+def lipo_thin_create(
+    binary_path: str, architectures: list[str], output_path: str, lipo_path: str
+) -> bool:
+    architecture_temp_path_list: list[str] = []
+    architecture_temp_path_raw_list = []
+    for architecture in architectures:
+        architecture_temp_path = f"{binary_path}_{architecture}"
+        shell = Shell(
+            f'{lipo_path} -thin {architecture} "{binary_path}" -output "{architecture_temp_path}"'
+        )
+        shell.run()
+        if shell.ret_code != 0:
+            return False
+        architecture_temp_path_list.append(f'"{architecture_temp_path}"')
+        architecture_temp_path_raw_list.append(architecture_temp_path)
+    temps = " ".join(architecture_temp_path_list)
+    shell = Shell(f'{lipo_path} -create {temps} -output "{output_path}"')
+    shell.run()
+    temp_size = 0
+    for path in architecture_temp_path_raw_list:
+        temp_size += os.path.getsize(path)
+        os.unlink(path)
+    if shell.ret_code != 0:
+        return False
+    output_size = os.path.getsize(output_path)
+    print(
+        f"{output_path} {' '.join(architectures)}: {temp_size + output_size} bytes copied, "
+        f"peak disk {temp_size + output_size} bytes"
+    )
     return True
 
 
-@log_entry
+@traced
 def pick_architecture(
     exists_architecture: list[str],
     want_architecture: list[str],
@@ -432,7 +1363,7 @@ def pick_architecture(
     return part, platform
 
 
-@log_entry
+@traced
 def generate_info_plist(
     parts: list[(list[str], bool)], plist_path: str, framework_name: str
 ) -> list[(str, list[str])]:
@@ -488,11 +1419,20 @@ def generate_info_plist(
     return result
 
 
-@log_entry
-def lipo_info(framework_path: str, lipo_path: str) -> list[str]:
+@traced
+def lipo_info(framework_path: str, lipo_path: Optional[str]) -> list[str]:
+    """
+    :param lipo_path: 为 None 时用 MachO 读取文件头
+    """
     binary_archives: list[str] = []
     framework_name = os.path.splitext(os.path.basename(framework_path))[0]
     binary_path = os.path.join(framework_path, framework_name)
+    valid_architectures = ["armv7", "armv7s", "i386", "x86_64", "arm64"]
+    if lipo_path is None:
+        for architecture in MachO.architectures(binary_path):
+            if architecture in valid_architectures:
+                binary_archives.append(architecture)
+        return binary_archives
     shell = Shell(f'{lipo_path} -info "{binary_path}"')
     shell.run()
     if shell.ret_code == 0:
@@ -500,7 +1440,6 @@ def lipo_info(framework_path: str, lipo_path: str) -> list[str]:
         # Non-fat file: MobileVLCKit_armv7 is architecture: armv7
         infos = shell.ret_info.decode("utf-8").strip()
 
-        valid_architectures = ["armv7", "armv7s", "i386", "x86_64", "arm64"]
         if infos.startswith("Architectures in the fat file"):
             key = f" are:"
             idx = infos.find(key)
@@ -520,127 +1459,737 @@ def lipo_info(framework_path: str, lipo_path: str) -> list[str]:
     return binary_archives
 
 
-@log_entry
-def download_cocoapod_archive_file(url: str, temp_path: str):
-    temp_path = os.path.join(temp_path, "cocoapods")
+_artifact_cache_lock = threading.Lock()
+
+
+@traced
+def artifact_cache(configure: Configure) -> ArtifactCache:
+    with _artifact_cache_lock:
+        if configure.artifact_cache is None:
+            configure.artifact_cache = ArtifactCache(
+                configure.cache_path, configure.cache_max_bytes
+            )
+        return configure.artifact_cache
+
+
+@traced
+def release_artifact(path: Optional[str], configure: Configure):
+    """
+    用完一个产物: 缓存中的只解除占用, 其他的按 cache_file_keep 删除
+    """
+    if path is None:
+        return
+    cache = artifact_cache(configure)
+    if cache.enabled and os.path.abspath(path).startswith(cache.root + os.sep):
+        cache.unpin(os.path.abspath(path))
+    elif not configure.cache_file_keep:
+        remove_artifact(path)
+
+
+def archive_suffix(name: str) -> str:
+    if name.endswith(".tar.xz"):
+        return ".tar.xz"
+    return os.path.splitext(name)[1]
+
+
+# 打包方式变化时修改, 使旧的 xcframework zip 缓存失效
+PACKAGE_FORMAT = 2
+
+
+def package_cache_key(
+    source_url: str, need_framewrok_convert: bool, variant: PackageVariant
+) -> str:
+    key = f"zip:{PACKAGE_FORMAT}:{need_framewrok_convert}:{source_url}"
+    if variant.name != "full":
+        key = f"{key}:{variant.name}"
+    return key
+
+
+@traced
+def download_cocoapod_archive_file(
+    url: str, configure: Configure, source_meta: Optional[dict] = None
+):
+    cache = artifact_cache(configure)
+    cached = cache.get(f"url:{url}", "archive")
+    if cached is not None:
+        print(f"cache hit {url} -> {cached[0]}")
+        return cached[0]
+    temp_path = os.path.join(configure.temp_path, "cocoapods")
     mkdirs(temp_path)
     parser_result = urlparse(url)
     file_name = os.path.basename(parser_result.path)
     download_path = os.path.join(temp_path, file_name)
-    if download_file(url, download_path):
-        return download_path
+    if download_file_with_configure(
+        url, download_path, configure, source_meta=source_meta
+    ):
+        if not cache.enabled:
+            return download_path
+        sha = artifact_sha256(download_path)
+        remove_path(digest_path(download_path))
+        return cache.put_file(
+            f"url:{url}", "archive", download_path, sha, url, archive_suffix(file_name)
+        )
     else:
         return None
 
 
-@log_entry
+@traced
 def file_tree_search_first(base_path: str, target_name: str) -> Optional[str]:
-    for path, dir_list, file_list in os.walk(base_path):
-        for name in dir_list:
-            if name == target_name:
-                return os.path.join(path, name)
-        for name in file_list:
-            if name == target_name:
-                return os.path.join(path, name)
+    """
+    按层 (浅的优先) 用 scandir 搜索, 不进入 .framework/.dSYM/.bundle 目录
+    """
+    prune_suffixes = (".framework", ".dSYM", ".bundle")
+    level = [base_path]
+    while len(level) > 0:
+        next_level: list[str] = []
+        for path in level:
+            try:
+                entries = sorted(os.scandir(path), key=lambda e: e.name)
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            for entry in entries:
+                if entry.name == target_name:
+                    return entry.path
+                if entry.is_dir(follow_symlinks=False) and not entry.name.endswith(
+                    prune_suffixes
+                ):
+                    next_level.append(entry.path)
+        level = next_level
     return None
 
 
-@log_entry
-def convert_new_release_assets(
+@traced
+def remove_path(rm_path: str):
+    if os.path.exists(rm_path):
+        if os.path.isdir(rm_path):
+            shutil.rmtree(rm_path)
+        else:
+            os.unlink(rm_path)
+
+
+@traced
+def extract_release_archive(
     path: str,
-    version: str,
-    temp_path: str,
     need_framewrok_convert: bool,
     configure: Configure,
-) -> Optional[str]:
-    if path is None or version is None or temp_path is None:
-        return None
-
+    source_url: Optional[str] = None,
+) -> tuple[Optional[str], list[str]]:
+    """
+    解压 cocoapods 包并定位 MobileVLCKit.xcframework (或 .framework)
+    :param source_url: 包的下载地址, 用作解压结果的缓存 key
+    :return: 定位到的路径, 用完后需要 release_artifact 的路径
+    """
     xcframework = "MobileVLCKit.xcframework"
     if need_framewrok_convert:
         xcframework = "MobileVLCKit.framework"
     temp_files: list[str] = []
-
-    def cleanup():
-        for rm_path in temp_files:
-            if os.path.exists(rm_path):
-                if os.path.isdir(rm_path):
-                    shutil.rmtree(rm_path)
-                else:
-                    os.unlink(rm_path)
-
+    variants = configure.package_variants
+    accept: Optional[typing.Callable[[str, bool], bool]] = None
+    variant_suffix = ""
+    if not need_framewrok_convert and not any(v.is_complete() for v in variants):
+        # 没有包需要全部内容时, 不要的 slice 和 dSYMs 不解压到磁盘
+
+        def accept_variant_member(name: str, is_dir: bool) -> bool:
+            return any(variant.accepts(name, is_dir) for variant in variants)
+
+        accept = accept_variant_member
+        variant_suffix = "-" + "-".join(variant.name for variant in variants)
+    cache = artifact_cache(configure)
+    tree_key = f"tree:{xcframework}:{source_url}"
+    if len(variant_suffix) > 0:
+        tree_key = f"{tree_key}:{variant_suffix[1:]}"
+    if source_url is not None:
+        cached = cache.get(tree_key, "tree")
+        if cached is not None:
+            print(f"cache hit {tree_key} -> {cached[0]}")
+            temp_files.append(cached[0])
+            return file_tree_search_first(cached[0], xcframework), temp_files
+
+    work_dir = os.path.join(configure.temp_path, "cocoapods")
+    base_name = os.path.basename(path)
     unarchive_path = os.path.join(
-        os.path.dirname(path), os.path.splitext(os.path.basename(path))[0]
+        work_dir,
+        base_name[: len(base_name) - len(archive_suffix(base_name))] + variant_suffix,
     )
     if path.endswith(".tar.xz"):
-        xz_dir = os.path.dirname(path)
-        unarchive_path = os.path.join(
-            xz_dir, os.path.splitext(os.path.splitext(os.path.basename(path))[0])[0]
-        )
         if not os.path.exists(unarchive_path):
             temp_files.append(unarchive_path)
-            untar(path, unarchive_path, xcframework, "r:xz")
+            temp_files.append(extract_index_path(unarchive_path))
+            untar(
+                path,
+                unarchive_path,
+                xcframework,
+                "r|xz",
+                configure.untar_buffer_size,
+                configure.xz_workers,
+                os.path.join(configure.temp_path, "xz-index"),
+                accept,
+            )
     elif path.endswith(".zip"):
         if not os.path.exists(unarchive_path):
             temp_files.append(unarchive_path)
-            unzip(path, unarchive_path, xcframework)
-
-    mobile_vlc_kit_xcframework = file_tree_search_first(unarchive_path, xcframework)
-    if mobile_vlc_kit_xcframework is None:
-        cleanup()
-        return None
-    if need_framewrok_convert:
-        mobile_vlc_kit_framework = mobile_vlc_kit_xcframework
-        mobile_vlc_kit_xcframework = (
-            f"{os.path.splitext(mobile_vlc_kit_xcframework)[0]}.xcframework"
-        )
-        convert_framework_to_xcframework(
-            mobile_vlc_kit_framework, mobile_vlc_kit_xcframework, configure
+            temp_files.append(extract_index_path(unarchive_path))
+            unzip(path, unarchive_path, xcframework, accept)
+
+    found = extracted_member_path(unarchive_path, xcframework)
+    if found is not None and source_url is not None and cache.enabled:
+        relative = os.path.relpath(found, unarchive_path)
+        cached_path = cache.put_tree(
+            tree_key, "tree", unarchive_path, string_sha(tree_key), source_url
         )
-
-    xcframework_zip_dir = os.path.join(temp_path, "xcframework-zip")
-    mkdirs(xcframework_zip_dir)
-    xcframework_zip = os.path.join(
-        xcframework_zip_dir, f"MobileVLCKit-{version}.xcframework.zip"
-    )
-    if zip_folder(mobile_vlc_kit_xcframework, xcframework_zip):
-        return xcframework_zip
-    else:
-        return None
+        # 缓存中的解压结果没有索引, 之后用目录搜索
+        remove_path(extract_index_path(unarchive_path))
+        temp_files = [cached_path]
+        found = os.path.join(cached_path, relative)
+    return found, temp_files
 
 
-@log_entry
-def zip_folder(folder_path: str, target_zip_path: str) -> bool:
-    folder_name = os.path.basename(folder_path)
+def zip_tree_prefix(names: list[str], target_name: str) -> Optional[str]:
+    """
+    :return: zip 中最上层的 target_name 目录所在的前缀 ("" 为根目录), 没有时返回 None
+    """
+    prefix: Optional[str] = None
+    for name in names:
+        parts = name.split("/")
+        if parts[0] == "__MACOSX" or target_name not in parts[:-1]:
+            continue
+        index = parts.index(target_name)
+        if prefix is None or index < prefix.count("/"):
+            prefix = "".join(f"{part}/" for part in parts[:index])
+    return prefix
 
-    def _zip(temp: str) -> bool:
-        output_fp = zipfile.ZipFile(temp, "w")
-        output_fp.write(folder_path, folder_name)
-        for path, dir_list, file_list in os.walk(folder_path):
-            sub_path = str(path)
-            if sub_path.startswith(folder_path):
-                sub_path = sub_path[len(folder_path) :]
-            if sub_path.startswith("/"):
-                sub_path = sub_path[1:]
-            sub_path = f"{folder_name}/{sub_path}"
-            for name in dir_list:
-                full_path = os.path.join(path, name)
-                zip_name_full = os.path.join(sub_path, name)
-                output_fp.write(full_path, zip_name_full)
-                print(f"path:{path} sub:{sub_path} zip:{zip_name_full}")
-            for name in file_list:
-                full_path = os.path.join(path, name)
-                zip_name_full = os.path.join(sub_path, name)
-                output_fp.write(full_path, zip_name_full)
-                print(f"path:{path} sub:{sub_path} zip:{zip_name_full}")
-
-        output_fp.close()
-        return True
 
-    return temp_do(_zip, target_zip_path, f"zip {os.path.basename(target_zip_path)}")
+def release_zip_name(version: str, variant: PackageVariant, primary: bool) -> str:
+    """
+    第一个包沿用原来的名字, 其他的包名字里带上包名
+    """
+    if primary:
+        return f"MobileVLCKit-{version}.xcframework.zip"
+    return f"MobileVLCKit-{version}-{variant.name}.xcframework.zip"
+
+
+def add_release_file(
+    output_fp: ZipFanout,
+    variants: list[PackageVariant],
+    name: str,
+    fp: typing.BinaryIO,
+    size: int,
+    mode: Optional[int],
+    mtime: Optional[float],
+):
+    """
+    写入一个文件成员, 数据只读一遍; 需要按包改写的 (Info.plist) 分别写入每个包
+    """
+    targets = output_fp.targets(name)
+    if not any(variants[index].rewrites(name) for index in targets):
+        output_fp.add_stream(name, fp, size, mode, mtime)
+        return
+    data = fp.read(size)
+    for index in targets:
+        content = data
+        if variants[index].rewrites(name):
+            content = variants[index].info_plist(data)
+        output_fp.writers[index].add_bytes(name, content, mode, mtime)
+
+
+@traced
+def write_release_zip(
+    version: str,
+    temp_path: str,
+    label: str,
+    write_func: typing.Callable[[ZipFanout], int],
+    variants: list[PackageVariant],
+    level: int = 6,
+    workers: int = 0,
+) -> dict[str, tuple[str, str]]:
+    """
+    一遍写出每个包的 xcframework zip, 写入时计算 sha256
+    :param write_func: 向 zip 写入成员 (按包的规则分发), 返回写入的成员数, 0 视为失败
+    :return: 包名 -> (xcframework zip 路径, sha256), 失败时为空
+    """
+    span = Trace.tracer().current().set("label", label).set("version", version)
+    xcframework_zip_dir = os.path.join(temp_path, "xcframework-zip")
+    mkdirs(xcframework_zip_dir)
+    paths = [
+        os.path.join(
+            xcframework_zip_dir, release_zip_name(version, variant, index == 0)
+        )
+        for index, variant in enumerate(variants)
+    ]
+    if not all(os.path.exists(path) for path in paths):
+        # 只剩下部分包时全部重新生成
+        for path in paths:
+            remove_path(path)
+    digests: list[str] = []
+
+    def _accepts(index: int, name: str, is_dir: bool) -> bool:
+        return variants[index].accepts(name, is_dir)
+
+    def _write(temp: str) -> bool:
+        temps = [temp] + [f"{path}_temp" for path in paths[1:]]
+        raw_fps = [open(path, "wb") for path in temps]
+        try:
+            hash_fps = [HashingWriter(raw_fp) for raw_fp in raw_fps]
+            output_fp = ZipFanout(
+                [ParallelZipWriter(hash_fp, level, workers) for hash_fp in hash_fps],
+                _accepts,
+            )
+            try:
+                count = write_func(output_fp)
+                output_fp.close()
+            except BaseException:
+                output_fp.abort()
+                raise
+        finally:
+            for raw_fp in raw_fps:
+                raw_fp.close()
+        for variant, writer in zip(variants, output_fp.writers):
+            print(
+                f"{label} {variant.name}: {len(writer.entries)} entries "
+                f"{writer.bytes_in} -> {writer.offset} bytes"
+            )
+            span.set(f"{variant.name}_entries", len(writer.entries))
+            span.set(f"{variant.name}_bytes_in", writer.bytes_in)
+            span.set(f"{variant.name}_bytes", writer.offset)
+            Metrics.add("bytes_out", writer.offset)
+            Metrics.add("zip_bytes", writer.offset)
+        if count == 0:
+            for path in temps[1:]:
+                remove_path(path)
+            return False
+        for path in paths[1:]:
+            os.replace(f"{path}_temp", path)
+        digests.extend(hash_fp.hexdigest() for hash_fp in hash_fps)
+        return True
+
+    try:
+        done = temp_do(_write, paths[0], label)
+    finally:
+        for path in paths[1:]:
+            remove_path(f"{path}_temp")
+    if not done:
+        return dict()
+    packages: dict[str, tuple[str, str]] = dict()
+    for index, (variant, path) in enumerate(zip(variants, paths)):
+        if len(digests) > 0:
+            write_digest(path, digests[index])
+            packages[variant.name] = (path, digests[index])
+        else:
+            packages[variant.name] = (path, artifact_sha256(path))
+    return packages
+
+
+@traced
+def remux_release_archive(
+    path: str,
+    version: str,
+    temp_path: str,
+    variants: list[PackageVariant],
+) -> dict[str, tuple[str, str]]:
+    """
+    上游已经是包含 MobileVLCKit.xcframework 的 zip 时, 直接把 xcframework 子树的压缩数据
+    复制到新的 zip 中, 只改写路径和头, 不解压也不重新压缩; 包不要的成员不会被读取
+    :return: 包名 -> (xcframework zip 路径, sha256); 不能直接复制时为空
+    """
+    xcframework = "MobileVLCKit.xcframework"
+    try:
+        with zipfile.ZipFile(path) as input_fp:
+            names = input_fp.namelist()
+    except zipfile.BadZipFile as e:
+        print(f"remux {path} bad zip {e}")
+        return dict()
+    prefix = zip_tree_prefix(names, xcframework)
+    if prefix is None:
+        return dict()
+    root = f"{prefix}{xcframework}/"
+    info_plist = f"{xcframework}/Info.plist"
+    # 要按包改写的 Info.plist 不能直接复制
+    rewrite = f"{prefix}{info_plist}" in names and any(
+        variant.rewrites(info_plist) for variant in variants
+    )
+
+    def _rename(name: str) -> Optional[str]:
+        if name.startswith(root) and not (rewrite and name == f"{prefix}{info_plist}"):
+            return name[len(prefix) :]
+        return None
+
+    def _remux(output_fp: ZipFanout) -> int:
+        if root not in names:
+            output_fp.add_directory(xcframework)
+        count = copy_zip_members(output_fp, path, _rename)
+        if rewrite:
+            with zipfile.ZipFile(path) as input_fp:
+                info = input_fp.getinfo(f"{prefix}{info_plist}")
+                with input_fp.open(info) as fp:
+                    add_release_file(
+                        output_fp,
+                        variants,
+                        info_plist,
+                        fp,
+                        info.file_size,
+                        (info.external_attr >> 16) or None,
+                        time.mktime(info.date_time + (0, 0, -1)),
+                    )
+            count += 1
+        return count
+
+    return write_release_zip(
+        version,
+        temp_path,
+        f"remux {os.path.basename(path)}",
+        _remux,
+        variants,
+        workers=1,
+    )
+
+
+def transcode_tar_members(
+    input_fp: tarfile.TarFile, output_fp: ZipFanout, variants: list[PackageVariant]
+) -> int:
+    """
+    把流模式 tar 中最上层 MobileVLCKit.xcframework 子树的成员写成 zip 成员,
+    每个成员分发给所有需要它的包; 没有包需要的成员只在流中跳过
+    :return: 写入的成员数
+    """
+    xcframework = "MobileVLCKit.xcframework"
+    count = 0
+    prefix: Optional[str] = None
+    for member in input_fp:
+        parts = member.name.split("/")
+        if prefix is None:
+            if xcframework not in parts:
+                continue
+            prefix = "".join(f"{part}/" for part in parts[: parts.index(xcframework)])
+        if member.name != f"{prefix}{xcframework}" and not member.name.startswith(
+            f"{prefix}{xcframework}/"
+        ):
+            continue
+        name = member.name[len(prefix) :]
+        if not output_fp.wants(name, member.isdir()):
+            continue
+        if member.isdir():
+            output_fp.add_directory(name, member.mode, member.mtime)
+        elif member.issym():
+            output_fp.add_symlink(name, member.linkname, member.mtime)
+        elif member.isreg():
+            add_release_file(
+                output_fp,
+                variants,
+                name,
+                input_fp.extractfile(member),
+                member.size,
+                member.mode,
+                member.mtime,
+            )
+        else:
+            # 硬链接等在流模式下无法回读, 交给解压的方式处理
+            raise ValueError(f"transcode unsupported member {member.name}")
+        count += 1
+    return count
+
+
+@traced
+def transcode_release_archive(
+    path: str,
+    version: str,
+    temp_path: str,
+    configure: Configure,
+) -> dict[str, tuple[str, str]]:
+    """
+    tar.xz 包一遍读完: 从 xz 流中读出 tar 成员, 把 MobileVLCKit.xcframework 子树
+    直接写成每个包的 zip 成员, 不落盘解压
+    :return: 包名 -> (xcframework zip 路径, sha256); 没有 xcframework 时为空
+    """
+    variants = configure.package_variants
+
+    def _transcode(output_fp: ZipFanout) -> int:
+        with XzParallel.open_tar(
+            path, configure.xz_workers, configure.untar_buffer_size
+        ) as input_fp:
+            return transcode_tar_members(input_fp, output_fp, variants)
+
+    return write_release_zip(
+        version,
+        temp_path,
+        f"transcode {os.path.basename(path)}",
+        _transcode,
+        variants,
+        configure.zip_level,
+        configure.zip_workers,
+    )
+
+
+def can_repackage_release_archive(
+    path: Optional[str], need_framewrok_convert: bool
+) -> bool:
+    return (
+        not need_framewrok_convert
+        and path is not None
+        and (path.endswith(".zip") or path.endswith(".tar.xz"))
+    )
+
+
+@traced
+def repackage_release_archive(
+    path: Optional[str],
+    version: str,
+    temp_path: str,
+    need_framewrok_convert: bool,
+    configure: Configure,
+) -> dict[str, tuple[str, str]]:
+    """
+    不经过解压目录, 直接把 cocoapods 包转成 xcframework zip (zip 直接复制, tar.xz 边解压边压缩)
+    :return: 包名 -> (xcframework zip 路径, sha256); 不适用或失败时为空, 需要走解压再打包
+    """
+    if not can_repackage_release_archive(path, need_framewrok_convert):
+        return dict()
+    if path.endswith(".zip"):
+        return remux_release_archive(
+            path, version, temp_path, configure.package_variants
+        )
+    if path.endswith(".tar.xz"):
+        return transcode_release_archive(path, version, temp_path, configure)
+    return dict()
+
+
+@traced
+def stream_release_archive(
+    url: str,
+    version: str,
+    need_framewrok_convert: bool,
+    configure: Configure,
+    source_meta: Optional[dict] = None,
+) -> dict[str, tuple[str, str]]:
+    """
+    STREAM_EXTRACT 模式: http 响应直接送入 xz/tar 解码并写成 xcframework zip,
+    下载和解压同时进行; STREAM_EXTRACT_CACHE 时原始包同时写入缓存
+    :param source_meta: 成功时写入响应头中的 etag, last_modified, size
+    :return: 包名 -> (xcframework zip 路径, sha256); 不适用或失败时为空, 需要先下载再处理
+    """
+    if (
+        not configure.stream_extract
+        or need_framewrok_convert
+        or not urlparse(url).path.endswith(".tar.xz")
+    ):
+        return dict()
+    cache = artifact_cache(configure)
+    archive_key = f"url:{url}"
+    if cache.has(archive_key):
+        # 已经下载过, 从本地文件读更快
+        return dict()
+    file_name = os.path.basename(urlparse(url).path)
+    tee_path: Optional[str] = None
+    if cache.enabled and configure.stream_extract_cache:
+        tee_dir = os.path.join(configure.temp_path, "cocoapods")
+        mkdirs(tee_dir)
+        tee_path = os.path.join(tee_dir, f"{file_name}_stream")
+    archive_digest: list[str] = []
+    block_size = 1024 * 1024
+    span = Trace.tracer().current()
+
+    def _transcode(output_fp: ZipFanout) -> int:
+        tee_fp = open(tee_path, "wb") if tee_path is not None else None
+        try:
+            with Http.get(
+                url,
+                stream=True,
+                headers={"Accept-Encoding": "identity"},
+                timeout=configure.download_timeout,
+            ) as response:
+                response.raise_for_status()
+                response.raw.decode_content = True
+                reader = TeeReader(response.raw, tee_fp)
+                with tarfile.open(
+                    fileobj=reader, mode="r|xz", bufsize=configure.untar_buffer_size
+                ) as input_fp:
+                    count = transcode_tar_members(
+                        input_fp, output_fp, configure.package_variants
+                    )
+                # tar 结束块之后还有数据, 读完才是完整的原始包
+                while len(reader.read(block_size)) > 0:
+                    pass
+                length = response.headers.get("content-length")
+                if length is not None and int(length) != reader.position:
+                    raise IOError(
+                        f"stream {url} got {reader.position} of {length} bytes"
+                    )
+                archive_digest.append(reader.hexdigest())
+                if source_meta is not None:
+                    source_meta.update(response_metadata(response.headers))
+                span.set("archive_bytes", reader.position)
+                Metrics.add("bytes_in", reader.position)
+                Metrics.add("download_bytes", reader.position)
+        finally:
+            if tee_fp is not None:
+                tee_fp.close()
+        return count
+
+    packages = write_release_zip(
+        version,
+        configure.temp_path,
+        f"stream {file_name}",
+        _transcode,
+        configure.package_variants,
+        configure.zip_level,
+        configure.zip_workers,
+    )
+    if tee_path is not None:
+        if len(packages) > 0 and len(archive_digest) > 0:
+            cached_path = cache.put_file(
+                archive_key,
+                "archive",
+                tee_path,
+                archive_digest[0],
+                url,
+                archive_suffix(file_name),
+            )
+            cache.unpin(cached_path)
+        else:
+            remove_path(tee_path)
+    return packages
+
+
+@traced
+def package_release_assets(
+    mobile_vlc_kit_xcframework: str,
+    version: str,
+    temp_path: str,
+    need_framewrok_convert: bool,
+    configure: Configure,
+) -> dict[str, tuple[str, str]]:
+    """
+    :return: 包名 -> (xcframework zip 路径, sha256), 失败时为空
+    """
+    convert_dir: Optional[str] = None
+    if need_framewrok_convert:
+        # 不写在解压目录里, 解压目录可能是缓存
+        mobile_vlc_kit_framework = mobile_vlc_kit_xcframework
+        convert_dir = os.path.join(temp_path, "xcframework-convert", version)
+        remove_path(convert_dir)
+        mobile_vlc_kit_xcframework = os.path.join(
+            convert_dir,
+            f"{os.path.splitext(os.path.basename(mobile_vlc_kit_framework))[0]}.xcframework",
+        )
+        if not convert_framework_to_xcframework(
+            mobile_vlc_kit_framework, mobile_vlc_kit_xcframework, configure
+        ):
+            remove_path(convert_dir)
+            return dict()
+
+    variants = configure.package_variants
+
+    def _zip(output_fp: ZipFanout) -> int:
+        return zip_folder(mobile_vlc_kit_xcframework, output_fp, variants)
+
+    packages = write_release_zip(
+        version,
+        temp_path,
+        f"zip {os.path.basename(mobile_vlc_kit_xcframework.rstrip('/'))}",
+        _zip,
+        variants,
+        configure.zip_level,
+        configure.zip_workers,
+    )
+    if convert_dir is not None:
+        remove_path(convert_dir)
+    return packages
+
+
+@traced
+def convert_new_release_assets(
+    path: str,
+    version: str,
+    temp_path: str,
+    need_framewrok_convert: bool,
+    configure: Configure,
+    source_url: Optional[str] = None,
+) -> dict[str, tuple[str, str]]:
+    """
+    一次解压 (或一遍读包) 同时打出 configure.package_variants 的每个包
+    :return: 包名 -> (xcframework zip 路径, sha256), 失败时为空
+    """
+    if path is None or version is None or temp_path is None:
+        return dict()
+
+    packages = repackage_release_archive(
+        path, version, temp_path, need_framewrok_convert, configure
+    )
+    if len(packages) > 0:
+        return packages
+    mobile_vlc_kit_xcframework, temp_files = extract_release_archive(
+        path, need_framewrok_convert, configure, source_url
+    )
+    if mobile_vlc_kit_xcframework is None:
+        for rm_path in temp_files:
+            release_artifact(rm_path, configure)
+        return dict()
+    packages = package_release_assets(
+        mobile_vlc_kit_xcframework,
+        version,
+        temp_path,
+        need_framewrok_convert,
+        configure,
+    )
+    for rm_path in temp_files:
+        release_artifact(rm_path, configure)
+    return packages
+
 
+def zip_folder(
+    folder_path: str, output_fp: ZipFanout, variants: list[PackageVariant]
+) -> int:
+    """
+    按固定顺序把目录写入 zip, 没有包需要的目录不会进入
+    :return: 写入的成员数
+    """
+    folder_path = folder_path.rstrip("/")
+    folder_name = os.path.basename(folder_path)
+    folder_stat = os.stat(folder_path)
+    output_fp.add_directory(folder_name, folder_stat.st_mode, folder_stat.st_mtime)
+    count = 1
+    for path, dir_list, file_list in os.walk(folder_path):
+        sub_path = os.path.relpath(path, folder_path)
+        if sub_path == ".":
+            sub_path = folder_name
+        else:
+            sub_path = f"{folder_name}/{sub_path}"
+        # 固定顺序, 相同的输入得到相同的压缩包
+        dir_list[:] = sorted(
+            name
+            for name in dir_list
+            if os.path.islink(os.path.join(path, name))
+            or output_fp.wants(f"{sub_path}/{name}", True)
+        )
+        for name in dir_list + sorted(file_list):
+            full_path = os.path.join(path, name)
+            zip_name_full = f"{sub_path}/{name}"
+            entry_stat = os.lstat(full_path)
+            if os.path.islink(full_path):
+                output_fp.add_symlink(
+                    zip_name_full, os.readlink(full_path), entry_stat.st_mtime
+                )
+            elif name in dir_list:
+                output_fp.add_directory(
+                    zip_name_full, entry_stat.st_mode, entry_stat.st_mtime
+                )
+            elif output_fp.wants(zip_name_full):
+                with open(full_path, "rb") as fp:
+                    add_release_file(
+                        output_fp,
+                        variants,
+                        zip_name_full,
+                        fp,
+                        entry_stat.st_size,
+                        entry_stat.st_mode,
+                        entry_stat.st_mtime,
+                    )
+            else:
+                continue
+            count += 1
+    return count
 
-@log_entry
+
+@traced
 def setup_github_if_need(
     github: Optional[Github],
     repo: Optional[Repository.Repository],
@@ -651,26 +2200,65 @@ def setup_github_if_need(
 ]:
 
     if github is None:
-        github = Github(configure.github_token)
+        github = github_client(configure)
     if repo is None:
+        # lazy: 不为仓库信息单独请求一次
         repo = github.get_repo(
-            f"{configure.github_owner_name}/{configure.github_repo_name}"
+            f"{configure.github_owner_name}/{configure.github_repo_name}", lazy=True
         )
+    if release is not None:
+        return github, repo, release
+    release_id = github_release_id(configure)
+    if release_id is None:
+        return github, repo, release
+    release = repo.get_release(release_id)
+    return github, repo, release
+
+
+def github_client(configure: Configure) -> Github:
+    from github import Github
+
+    return Github(configure.github_token)
+
+
+@traced
+def github_release_id(configure: Configure) -> Optional[int]:
+    """
+    按 tag 名一次请求找到 release (有 ETag 缓存), 只有找不到 (draft release) 时才遍历 release 列表
+    """
     if len(configure.github_release_id) == 0:
         if len(configure.github_release_name) == 0:
             print("github_release_id and github_release_name is null , fail")
-            return github, repo, release
-        releases = repo.get_releases()
-        for release in releases:
-            if release.tag_name == configure.github_release_name:
-                configure.github_release_id = str(release.id)
-                break
+            return None
+        found = github_api(configure).release_by_tag(
+            configure.github_owner_name,
+            configure.github_repo_name,
+            configure.github_release_name,
+        )
+        if found is None:
+            print(f"release {configure.github_release_name} not found")
+            return None
+        configure.github_release_id = str(found["id"])
+    return int(configure.github_release_id)
 
-    release = repo.get_release(int(configure.github_release_id))
-    return github, repo, release
+
+_github_api_lock = threading.Lock()
 
 
-@log_entry
+@traced
+def github_api(configure: Configure) -> GitHubApi:
+    with _github_api_lock:
+        if configure.github_api is None:
+            configure.github_api = GitHubApi(
+                configure.github_token,
+                configure.github_api_cache_path,
+                reserve=configure.github_api_reserve,
+                session=Http.client(),
+            )
+        return configure.github_api
+
+
+@traced
 def do_convert(
     version: str,
     file_url: str,
@@ -697,31 +2285,162 @@ def do_convert(
     :param release:   release 对象复用
     :return:  url,sha256,github,release
     """
-    printLine()
-    local_path = download_cocoapod_archive_file(file_url, configure.temp_path)
-    release_path = convert_new_release_assets(
-        local_path, version, configure.temp_path, need_framewrok_convert, configure
-    )
-    printLine()
-    if release_path is None:
+    Trace.mark()
+    packages = cached_release_packages(file_url, need_framewrok_convert, configure)
+    if len(packages) == 0:
+        packages = stream_release_archive(
+            file_url, version, need_framewrok_convert, configure
+        )
+        if len(packages) > 0:
+            packages = store_release_packages(
+                packages, file_url, need_framewrok_convert, configure
+            )
+    if len(packages) == 0:
+        local_path = download_cocoapod_archive_file(file_url, configure)
+        packages = convert_new_release_assets(
+            local_path,
+            version,
+            configure.temp_path,
+            need_framewrok_convert,
+            configure,
+            file_url,
+        )
+        release_artifact(local_path, configure)
+        packages = store_release_packages(
+            packages, file_url, need_framewrok_convert, configure
+        )
+    Trace.mark()
+    if len(packages) == 0:
         return None, None, github, repo, release
-    printLine()
+    Trace.mark()
     github, repo, release = setup_github_if_need(github, repo, release, configure)
-    printLine()
-    # sha256 = sha356(release_path)
-    release_name = f"MobileVLCKit-{version}.xcframework.zip"
-    print(f"upload file to release {release_path} ->{release_name}")
-    asset: GitReleaseAsset = release.upload_asset(release_path, release_name)
-    print(f"calculate file sha256 {release_path}")
-    sha = file_sha256(release_path)
-    print(f"calculate file sha256 {release_path} -> {sha}")
-    if not configure.cache_file_keep:
-        os.unlink(release_path)
+    Trace.mark()
+    url, sha = publish_release_packages(packages, version, release, configure)
     print("will return on do_convert")
-    return asset.browser_download_url, sha, github, repo, release
+    return url, sha, github, repo, release
+
+
+@traced
+def publish_release_asset(
+    release_path: str,
+    release_sha: Optional[str],
+    version: str,
+    release: GitRelease.GitRelease,
+    configure: Configure,
+    release_name: Optional[str] = None,
+) -> tuple[str, str]:
+    """
+    上传 release_path, release_sha 为空时使用记录的 (或重新计算) sha256
+    :param release_name: release 资源名, 默认为第一个包的名字
+    """
+    if release_name is None:
+        release_name = release_zip_name(version, configure.package_variants[0], True)
+    print(f"upload file to release {release_path} ->{release_name}")
+    file_size = os.path.getsize(release_path)
+    Trace.annotate(name=release_name, bytes=file_size)
+    Metrics.add("bytes_out", file_size)
+    Metrics.add("upload_bytes", file_size)
+    # 传文件路径: 请求体可以 seek, 有 Content-Length, 重试时能从头再读
+    asset: GitReleaseAsset = release.upload_asset(
+        release_path, content_type="application/zip", name=release_name
+    )
+    sha = release_sha
+    if sha is None:
+        # 写 zip 时没有记录 sha256 的才重新读一遍
+        sha = artifact_sha256(release_path)
+    print(f"file sha256 {release_path} -> {sha}")
+    artifact_cache(configure).put_digest(
+        f"release:{asset.browser_download_url}", "release", sha, release_path
+    )
+    release_artifact(release_path, configure)
+    return asset.browser_download_url, sha
+
+
+@traced
+def publish_release_packages(
+    packages: dict[str, tuple[str, str]],
+    version: str,
+    release: GitRelease.GitRelease,
+    configure: Configure,
+) -> tuple[Optional[str], Optional[str]]:
+    """
+    上传每个包
+    :return: 第一个包 (打 tag 用) 的 url, sha256
+    """
+    result: tuple[Optional[str], Optional[str]] = (None, None)
+    for index, variant in enumerate(configure.package_variants):
+        release_path, release_sha = packages[variant.name]
+        url, sha = publish_release_asset(
+            release_path,
+            release_sha,
+            version,
+            release,
+            configure,
+            release_zip_name(version, variant, index == 0),
+        )
+        if index == 0:
+            result = (url, sha)
+        else:
+            print(f"package {variant.name} {version} -> {url} sha256 {sha}")
+    return result
 
 
-@log_entry
+@traced
+def cached_release_packages(
+    source_url: str, need_framewrok_convert: bool, configure: Configure
+) -> dict[str, tuple[str, str]]:
+    """
+    :return: 包名 -> (缓存中的 zip 路径, sha256); 缺少任何一个包时为空, 全部重新生成
+    """
+    cache = artifact_cache(configure)
+    packages: dict[str, tuple[str, str]] = dict()
+    for variant in configure.package_variants:
+        cached = cache.get(
+            package_cache_key(source_url, need_framewrok_convert, variant), "zip"
+        )
+        if cached is None:
+            for cached_path, _ in packages.values():
+                release_artifact(cached_path, configure)
+            return dict()
+        print(f"cache hit package {variant.name} {source_url} -> {cached[0]}")
+        packages[variant.name] = cached
+    return packages
+
+
+@traced
+def store_release_packages(
+    packages: dict[str, tuple[str, str]],
+    source_url: str,
+    need_framewrok_convert: bool,
+    configure: Configure,
+) -> dict[str, tuple[str, str]]:
+    """
+    :return: 包名 -> (缓存中的 zip 路径, sha256), 缓存关闭时原样返回
+    """
+    cache = artifact_cache(configure)
+    if not cache.enabled:
+        return packages
+    stored: dict[str, tuple[str, str]] = dict()
+    for variant in configure.package_variants:
+        if variant.name not in packages:
+            continue
+        release_path, release_sha = packages[variant.name]
+        remove_path(digest_path(release_path))
+        stored[variant.name] = (
+            cache.put_file(
+                package_cache_key(source_url, need_framewrok_convert, variant),
+                "zip",
+                release_path,
+                release_sha,
+                source_url,
+                ".zip",
+            ),
+            release_sha,
+        )
+    return stored
+
+
+@traced
 def file_sha256(release_path: str):
     _256 = hashlib.sha256()
     current_position = 0
@@ -737,24 +2456,134 @@ def file_sha256(release_path: str):
                 print(f"calcuate sha256:{release_path} {current_position}")
                 last_print_position = current_position
     sha = _256.hexdigest()
+    Trace.annotate(bytes=current_position)
+    Metrics.add("hash_bytes", current_position)
     return sha
 
 
-@log_entry
+@traced
 def string_sha(url: str) -> str:
     _sha256 = hashlib.sha256()
     _sha256.update(url.encode("utf-8"))
     return _sha256.hexdigest()
 
 
-@log_entry
+@traced
 def bytes_sha(data: bytes) -> str:
     _sha256 = hashlib.sha256()
     _sha256.update(data)
     return _sha256.hexdigest()
 
 
-@log_entry
+class HashingWriter(io.RawIOBase):
+    """
+    只能顺序写入的文件包装, 写入的同时计算 sha256.
+    不支持 seek, 所以压缩包写入时使用 data descriptor 而不会回头改写 local header.
+    传入 sha256/position 可以接着一个已经 hash 过的前缀继续写.
+    """
+
+    def __init__(self, fp: typing.BinaryIO, sha256=None, position: int = 0):
+        super().__init__()
+        self._fp = fp
+        self.sha256 = sha256 if sha256 is not None else hashlib.sha256()
+        self.position = position
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._fp.write(data)
+        self.sha256.update(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self):
+        if not self._fp.closed:
+            self._fp.flush()
+
+    def hexdigest(self) -> str:
+        return self.sha256.hexdigest()
+
+
+class HashingReader(io.RawIOBase):
+    """顺序读取的文件包装, 读取的同时计算 sha256"""
+
+    def __init__(self, fp: typing.BinaryIO):
+        super().__init__()
+        self._fp = fp
+        self.sha256 = hashlib.sha256()
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        data = self._fp.read(size)
+        self.sha256.update(data)
+        self.position += len(data)
+        return data
+
+    def readinto(self, buffer) -> int:
+        data = self.read(len(buffer))
+        buffer[: len(data)] = data
+        return len(data)
+
+    def hexdigest(self) -> str:
+        return self.sha256.hexdigest()
+
+
+class TeeReader(HashingReader):
+    """读取的同时把数据原样写入 output (为 None 时只计算 sha256)"""
+
+    def __init__(self, fp: typing.BinaryIO, output: Optional[typing.BinaryIO] = None):
+        super().__init__(fp)
+        self._output = output
+
+    def read(self, size: int = -1) -> bytes:
+        data = super().read(size)
+        if self._output is not None and len(data) > 0:
+            self._output.write(data)
+        return data
+
+
+def digest_path(path: str) -> str:
+    return f"{path}.sha256"
+
+
+@traced
+def write_digest(path: str, sha: str):
+    with open(digest_path(path), "w") as fp:
+        fp.write(sha)
+
+
+@traced
+def artifact_sha256(path: str) -> str:
+    """
+    优先使用生成文件时顺带记录的 sha256, 没有 (或比文件旧) 时才重新读一遍文件
+    """
+    sidecar = digest_path(path)
+    if os.path.exists(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(
+        path
+    ):
+        with open(sidecar) as fp:
+            sha = fp.read().strip()
+        if len(sha) == 64:
+            return sha
+    sha = file_sha256(path)
+    write_digest(path, sha)
+    return sha
+
+
+@traced
+def remove_artifact(path: str):
+    remove_path(path)
+    remove_path(digest_path(path))
+
+
+@traced
 def add_tag(
     release_url: str,
     file_hash: str,
@@ -765,7 +2594,7 @@ def add_tag(
 ) -> tuple[Github, Repository]:
     if repo is None:
         if github is None:
-            github = Github(configure.github_token)
+            github = github_client(configure)
 
         repo = github.get_repo(
             f"{configure.github_owner_name}/{configure.github_repo_name}"
@@ -819,7 +2648,7 @@ def add_tag(
     return github, repo
 
 
-@log_entry
+@traced
 def cleanup_mini(configure: Configure):
     cocoapods = os.path.join(configure.temp_path, "cocoapods")
     if os.path.exists(cocoapods):
@@ -833,7 +2662,7 @@ def cleanup_mini(configure: Configure):
                 os.unlink(full)
 
 
-@log_entry
+@traced
 def version_to_long(version: str) -> int:
     version_long = 0
     comps = version.split(".")
@@ -842,90 +2671,426 @@ def version_to_long(version: str) -> int:
     return version_long
 
 
-@log_entry
-def get_release_hash(url: str, configure: Configure) -> str:
+@traced
+def get_release_hash(
+    url: str, configure: Configure, expected_sha256: Optional[str] = None
+) -> Optional[str]:
+    """
+    :param expected_sha256: 已知的资源 sha256 (GitHub 的 digest), 下载的文件 (包括已存在的) 必须一致
+    """
+    cache = artifact_cache(configure)
+    sha_value = cache.get_digest(f"release:{url}", "release")
+    if sha_value is not None and expected_sha256 in (None, sha_value):
+        print(f"cache hit release hash {url} -> {sha_value}")
+        return sha_value
     download_path = os.path.join(configure.temp_path, string_sha(url))
-    download_file(url, download_path)
-    sha_value = file_sha256(download_path)
+    if not download_file_with_configure(
+        url, download_path, configure, expected_sha256=expected_sha256
+    ):
+        return None
+    sha_value = artifact_sha256(download_path)
+    cache.put_digest(f"release:{url}", "release", sha_value, url)
     if not configure.cache_file_keep:
-        os.unlink(download_path)
+        remove_artifact(download_path)
     return sha_value
 
 
-@log_entry
+class ConvertJob:
+    def __init__(
+        self,
+        version: str,
+        file_url: str,
+        release_url: Optional[str],
+        need_framewrok_convert: bool,
+        release_sha256: Optional[str] = None,
+    ):
+        self.version = version
+        self.file_url = file_url
+        # 已经上传过的版本只需要计算 hash
+        self.release_url = release_url
+        # GitHub 记录的已上传资源的 sha256, 下载时用来校验
+        self.release_sha256 = release_sha256
+        self.need_framewrok_convert = need_framewrok_convert
+        self.local_path: Optional[str] = None
+        self.framework_path: Optional[str] = None
+        # 包名 -> (xcframework zip 路径, sha256)
+        self.packages: dict[str, tuple[str, str]] = dict()
+        self.file_hash: Optional[str] = None
+        self.temp_files: list[str] = []
+        # 下载时服务器返回的 etag, last_modified, size (记入状态清单), 用缓存时为空
+        self.source_meta: dict = dict()
+
+    def __repr__(self):
+        return f"ConvertJob({self.version})"
+
+    def packaged(self) -> bool:
+        return self.release_url is not None or len(self.packages) > 0
+
+
+@traced
+def cleanup_convert_job(job: ConvertJob, configure: Configure):
+    for rm_path in job.temp_files:
+        release_artifact(rm_path, configure)
+    job.temp_files = []
+    release_artifact(job.local_path, configure)
+    job.local_path = None
+
+
+@traced
+def run_convert_pipeline(
+    jobs: list[ConvertJob],
+    configure: Configure,
+    github: Github,
+    repo: Repository.Repository,
+    release: GitRelease.GitRelease,
+    manifest: Optional[StateManifest] = None,
+) -> int:
+    """
+    下载/解压/打包/上传 按阶段并行, 打 tag 仍按版本顺序执行
+    :param manifest: 打 tag 成功的版本记录到状态清单中
+    :return: 成功打 tag 的版本数
+    """
+
+    def _download(job: ConvertJob) -> bool:
+        if job.release_url is None:
+            job.packages = cached_release_packages(
+                job.file_url, job.need_framewrok_convert, configure
+            )
+        if job.packaged():
+            return True
+        job.packages = stream_release_archive(
+            job.file_url,
+            job.version,
+            job.need_framewrok_convert,
+            configure,
+            job.source_meta,
+        )
+        if len(job.packages) > 0:
+            job.packages = store_release_packages(
+                job.packages, job.file_url, job.need_framewrok_convert, configure
+            )
+            return len(job.packages) > 0
+        job.local_path = download_cocoapod_archive_file(
+            job.file_url, configure, job.source_meta
+        )
+        return job.local_path is not None
+
+    def _unpack(job: ConvertJob) -> bool:
+        job.framework_path, job.temp_files = extract_release_archive(
+            job.local_path, job.need_framewrok_convert, configure, job.file_url
+        )
+        if job.framework_path is None:
+            cleanup_convert_job(job, configure)
+            return False
+        return True
+
+    def _extract(job: ConvertJob) -> bool:
+        if job.packaged():
+            return True
+        if can_repackage_release_archive(job.local_path, job.need_framewrok_convert):
+            # 直接转码 (xz 解码 + deflate) 是 cpu 密集的, 放到 package 阶段, 不占磁盘并发
+            return True
+        return _unpack(job)
+
+    def _package(job: ConvertJob) -> bool:
+        if job.packaged():
+            return True
+        if job.framework_path is None:
+            job.packages = repackage_release_archive(
+                job.local_path,
+                job.version,
+                configure.temp_path,
+                job.need_framewrok_convert,
+                configure,
+            )
+            if len(job.packages) > 0:
+                cleanup_convert_job(job, configure)
+                job.packages = store_release_packages(
+                    job.packages, job.file_url, job.need_framewrok_convert, configure
+                )
+                return len(job.packages) > 0
+            # 不能直接转码时退回 解压再打包
+            if not _unpack(job):
+                return False
+        try:
+            job.packages = package_release_assets(
+                job.framework_path,
+                job.version,
+                configure.temp_path,
+                job.need_framewrok_convert,
+                configure,
+            )
+        finally:
+            cleanup_convert_job(job, configure)
+        job.packages = store_release_packages(
+            job.packages, job.file_url, job.need_framewrok_convert, configure
+        )
+        return len(job.packages) > 0
+
+    def _publish(job: ConvertJob) -> bool:
+        if job.release_url is not None:
+            job.file_hash = get_release_hash(
+                job.release_url, configure, job.release_sha256
+            )
+        else:
+            job.release_url, job.file_hash = publish_release_packages(
+                job.packages, job.version, release, configure
+            )
+        return job.release_url is not None and job.file_hash is not None
+
+    def _measured(
+        name: str, func: typing.Callable[[ConvertJob], bool]
+    ) -> typing.Callable[[ConvertJob], bool]:
+        def _run(job: ConvertJob) -> bool:
+            with Metrics.stage(name, job.version) as record:
+                record.ok = func(job)
+                return record.ok
+
+        return _run
+
+    tagged = [0, github, repo]
+
+    def _tag(job: ConvertJob, ok: bool, failed_stage: Optional[str]):
+        if not ok:
+            print(f"skip tag {job.version}, failed at {failed_stage}")
+            return
+        with Metrics.stage("tag", job.version):
+            g, r = add_tag(
+                job.release_url,
+                job.file_hash,
+                job.version,
+                configure=configure,
+                github=tagged[1],
+                repo=tagged[2],
+            )
+        tagged[0] += 1
+        tagged[1] = g
+        tagged[2] = r
+        if manifest is not None:
+            manifest.update(
+                job.version,
+                source_url=job.file_url,
+                asset_url=job.release_url,
+                sha256=job.file_hash,
+                tagged=True,
+                **job.source_meta,
+            )
+
+    pipeline = Pipeline(
+        [
+            PipelineStage("download", _measured("download", _download), "network"),
+            PipelineStage("extract", _measured("extract", _extract), "disk"),
+            PipelineStage("package", _measured("package", _package), "cpu"),
+            PipelineStage("publish", _measured("publish", _publish), "network"),
+        ],
+        {
+            "network": configure.pipeline_network_limit,
+            "cpu": configure.pipeline_cpu_limit,
+            "disk": configure.pipeline_disk_limit,
+        },
+        configure.pipeline_queue_size,
+    )
+    pipeline.run(jobs, _tag)
+    return tagged[0]
+
+
+async def discover_releases(
+    configure: Configure, manifest: StateManifest
+) -> tuple[
+    dict[str, str],
+    Optional[tuple[dict[str, str], dict[str, str], dict[str, str]]],
+    list[str],
+]:
+    """
+    VLC 索引, release 资源, tag 三个来源并发获取 (各自在线程中用连接池请求).
+    没有清单或要求全量扫描时 release 资源和 tag 与索引同时开始;
+    否则先看索引, 有未完成的版本时才列出 (两者并发)
+    :return: vlc_links, (github_file_links, github_tags, github_file_digests) 未列出时为 None,
+             未完成的版本
+    """
+    github_file_digests: dict[str, str] = dict()
+
+    def _listings() -> asyncio.Future:
+        return asyncio.gather(
+            asyncio.to_thread(
+                lambda: get_mobile_vlc_kit_releases_assets(
+                    configure, None, None, None, github_file_digests
+                )[0]
+            ),
+            asyncio.to_thread(lambda: get_mobile_vlc_kit_tags(configure, None, None)[0]),
+        )
+
+    listings: Optional[asyncio.Future] = None
+    if configure.state_full_scan or len(manifest.versions) == 0:
+        listings = _listings()
+    vlc_links: dict[str, str] = await asyncio.to_thread(
+        get_mobile_vlc_kit_links, configure.vlc_cocoapods_prod_url, manifest, configure
+    )
+    pending = manifest.pending(vlc_links)
+    if listings is None and len(pending) > 0:
+        listings = _listings()
+    if listings is None:
+        return vlc_links, None, pending
+    github_file_links, github_tags = await listings
+    return vlc_links, (github_file_links, github_tags, github_file_digests), pending
+
+
+def release_plan(
+    jobs: list[ConvertJob], skipped: list[str], manifest: StateManifest
+) -> dict:
+    """
+    :return: 本次要处理的版本: convert 需要转换上传, retag 已有 release 资源只需打 tag,
+             skip 不支持的旧版本, republished 上游重新发布过的已完成版本
+    """
+    convert = [job.version for job in jobs if job.release_url is None]
+    retag = [job.version for job in jobs if job.release_url is not None]
+    republished = sorted(
+        (
+            version
+            for version, entry in manifest.versions.items()
+            if entry.get("republished")
+        ),
+        key=version_to_long,
+    )
+    return {
+        "has_work": len(jobs) > 0,
+        "convert": convert,
+        "retag": retag,
+        "skip": skipped,
+        "republished": republished,
+    }
+
+
+@traced
+def write_release_plan(plan: dict, configure: Configure):
+    """
+    写出计划, 在 GitHub Actions 中同时写入 step 输出 has_work / convert_count
+    """
+    mkdirs(os.path.dirname(os.path.abspath(configure.plan_path)))
+    temp_path = f"{configure.plan_path}_temp"
+    with open(temp_path, "w") as fp:
+        json.dump(plan, fp, indent=1)
+    os.replace(temp_path, configure.plan_path)
+    print(
+        f"plan has_work={plan['has_work']} convert={plan['convert']} "
+        f"retag={plan['retag']} skip={plan['skip']} -> {configure.plan_path}"
+    )
+    output = os.environ.get("GITHUB_OUTPUT")
+    if output:
+        with open(output, "a") as fp:
+            fp.write(f"has_work={'true' if plan['has_work'] else 'false'}\n")
+            fp.write(f"convert_count={len(plan['convert']) + len(plan['retag'])}\n")
+
+
+@traced
 def do_main():
-    printLine()
     configure = Configure()
-    printLine()
+    Trace.setup(configure.trace_path, configure.trace_sample_rate)
+    Metrics.setup(configure.metrics_path, configure.temp_path, "mobilevlckit")
+    Http.setup(
+        connect_timeout=configure.http_connect_timeout,
+        read_timeout=configure.download_timeout,
+        retries=configure.http_retries,
+        backoff=configure.http_backoff,
+        max_per_host=configure.http_max_per_host,
+        pool_timeout=configure.http_pool_timeout,
+    )
+    Trace.mark()
     github: Optional[Github] = None
     git_release: Optional[GitRelease.GitRelease] = None
     git_repo: Optional[Repository.Repository] = None
-    printLine()
-    github_file_links, github, git_repo, git_release = (
-        get_mobile_vlc_kit_releases_assets(configure, github, git_repo, git_release)
-    )
-    printLine()
-    github_tags, github, git_repo = get_mobile_vlc_kit_tags(configure, github, git_repo)
-    printLine()
-    print(f"github_tags=>{json.dumps(github_tags,indent='\t')}")
-
-    vlc_links: dict[str, str] = get_mobile_vlc_kit_links(
-        configure.vlc_cocoapods_prod_url
-    )
-    printLine()
+    Trace.mark()
+    manifest = load_state_manifest(configure)
+    github_file_links: dict[str, str] = dict()
+    github_file_digests: dict[str, str] = dict()
     convert_list: dict[str, str] = dict()
-    for version in vlc_links.keys():
-        href = vlc_links[version]
-        if version not in github_tags:
-            convert_list[version] = href
-    printLine()
-    for version in convert_list.keys():
+    with Metrics.stage("discover"):
+        vlc_links, listings, pending = asyncio.run(
+            discover_releases(configure, manifest)
+        )
+        Trace.mark()
+        if listings is not None:
+            github_file_links, github_tags, github_file_digests = listings
+            print(f"github_tags=>{json.dumps(github_tags,indent='\t')}")
+            reconcile_state_manifest(
+                manifest, vlc_links, github_tags, github_file_links
+            )
+            for version in vlc_links.keys():
+                href = vlc_links[version]
+                if version not in github_tags:
+                    convert_list[version] = href
+        else:
+            print(f"state manifest: {len(vlc_links)} versions done, skip github listings")
+    Metrics.set_gauge("manifest_pending_versions", len(pending))
+    Trace.mark()
+    jobs: list[ConvertJob] = []
+    skipped: list[str] = []
+    for version in sorted(convert_list.keys(), key=version_to_long):
         long_version = version_to_long(version)
         need_framewrok_convert = False
         if long_version <= 3006001:
+            manifest.update(version, skipped=True)
+            skipped.append(version)
             continue
         if long_version < 3003016:
             need_framewrok_convert = True
-        printLine()
-        # release_url: str = ""
-        # file_hash: str = ""
-        if version in github_file_links:
-            release_url: str = github_file_links[version]
-            file_hash: str = get_release_hash(release_url, configure)
-        else:
-            release_url, file_hash, g, repo, release = do_convert(
-                version=version,
-                file_url=convert_list[version],
-                configure=configure,
-                github=github,
-                repo=git_repo,
-                release=git_release,
-                need_framewrok_convert=need_framewrok_convert,
-            )
-            github = g
-            git_release = release
-            git_repo = repo
-        printLine()
-        if release_url is not None and file_hash is not None:
-            g, r = add_tag(
-                release_url,
-                file_hash,
+        jobs.append(
+            ConvertJob(
                 version,
-                configure=configure,
-                github=github,
-                repo=git_repo,
+                convert_list[version],
+                github_file_links.get(version),
+                need_framewrok_convert,
+                github_file_digests.get(version),
             )
-            github = g
-            git_repo = r
-        printLine()
-        cleanup_mini(configure)
-        printLine()
+        )
+    Trace.mark()
+    plan = release_plan(jobs, skipped, manifest)
+    write_release_plan(plan, configure)
+    if configure.check_only:
+        # 检查模式只更新本地状态清单, 不导入 PyGithub
+        manifest.save(configure.state_path)
+        return
+    if len(jobs) > 0:
+        github, git_repo, git_release = setup_github_if_need(
+            github, git_repo, git_release, configure
+        )
+        tagged = run_convert_pipeline(
+            jobs, configure, github, git_repo, git_release, manifest
+        )
+        Metrics.set_gauge("tagged_versions", tagged)
+    Metrics.set_gauge("pending_versions", len(jobs))
+    Trace.mark()
+    github, git_repo, git_release = save_state_manifest(
+        manifest, configure, github, git_repo, git_release
+    )
+    Trace.mark()
+    cleanup_mini(configure)
+    cache_stats = artifact_cache(configure).stats()
+    Metrics.set_gauge("cache_hits", sum(cache_stats["hits"].values()))
+    Metrics.set_gauge("cache_misses", sum(cache_stats["misses"].values()))
+    Metrics.set_gauge("cache_hit_ratio", cache_stats["hit_ratio"])
+    Metrics.set_gauge("cache_bytes", cache_stats["bytes"])
+    Metrics.set_gauge("cache_evicted_bytes", cache_stats["evicted_bytes"])
+    artifact_cache(configure).report()
+    artifact_cache(configure).close()
+    if configure.github_api is not None:
+        Metrics.set_gauge("github_api_calls", configure.github_api.calls)
+        Metrics.set_gauge("github_api_not_modified", configure.github_api.not_modified)
+        configure.github_api.report()
+    Trace.mark()
 
 
 if __name__ == "__main__":
-    printLine()
+    exit_code = 0
     try:
         do_main()
     except Exception as e:
         logger.error(f"捕获到异常: {e}", exc_info=True)
-    printLine()
+        # 非 0 退出, workflow 才不会把失败 (例如检查步骤没有写出 has_work) 当作成功
+        exit_code = 1
+    finally:
+        Http.report()
+        Trace.report()
+        Trace.write()
+        Metrics.finish()
+    sys.exit(exit_code)
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+"""尽量不经过用户空间的文件和目录复制。
+依次尝试 reflink (Linux FICLONE, macOS clonefile), 硬链接, copy_file_range, 普通复制。
+"""
+import ctypes
+import errno
+import mmap
+import os
+import shutil
+import sys
+import threading
+import typing
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# _IOW(0x94, 9, int) from linux/fs.h
+FICLONE = 0x40049409
+# sys/clonefile.h
+CLONE_NOFOLLOW = 0x0001
+_COPY_BLOCK_SIZE = 4 * 1024 * 1024
+# errors that mean "this method is not available here", not "the copy failed"
+_UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP,
+                errno.ENOTTY, errno.EPERM, errno.EBADF, errno.ENOTSUP)
+
+
+class CopyStats(object):
+    """Files and bytes per copy method; shared by concurrent copies."""
+
+    METHODS = ("reflink", "hardlink", "copy_file_range", "copy", "symlink", "skip")
+
+    def __init__(self):
+        self.files = dict.fromkeys(self.METHODS, 0)
+        self.bytes = dict.fromkeys(self.METHODS, 0)
+        self._lock = threading.Lock()
+
+    def add(self, method: str, size: int):
+        with self._lock:
+            self.files[method] += 1
+            self.bytes[method] += size
+
+    @property
+    def written_bytes(self) -> int:
+        """Bytes that really had to be written as new data."""
+        return self.bytes["copy_file_range"] + self.bytes["copy"]
+
+    def __str__(self):
+        used = [f"{method}={self.files[method]}/{self.bytes[method]}"
+                for method in self.METHODS if self.files[method] > 0]
+        return " ".join(used) if len(used) > 0 else "nothing"
+
+
+def _load_clonefile() -> typing.Optional[typing.Callable]:
+    if sys.platform != "darwin":
+        return None
+    try:
+        clonefile = ctypes.CDLL(None, use_errno=True).clonefile
+    except (OSError, AttributeError):
+        # before macOS 10.12
+        return None
+    clonefile.argtypes = (ctypes.c_char_p, ctypes.c_char_p, ctypes.c_uint32)
+    clonefile.restype = ctypes.c_int
+    return clonefile
+
+
+_clonefile = _load_clonefile()
+
+
+def _reflink(src: str, dest: str) -> bool:
+    if _clonefile is not None:
+        # creates dest itself, which must not exist
+        if _clonefile(os.fsencode(src), os.fsencode(dest), CLONE_NOFOLLOW) == 0:
+            return True
+        error = ctypes.get_errno()
+        if error not in _UNSUPPORTED:
+            raise OSError(error, os.strerror(error), dest)
+        return False
+    if fcntl is None or not sys.platform.startswith("linux"):
+        return False
+    with open(src, "rb") as src_fp:
+        with open(dest, "wb") as dest_fp:
+            try:
+                fcntl.ioctl(dest_fp.fileno(), FICLONE, src_fp.fileno())
+                return True
+            except OSError as e:
+                if e.errno not in _UNSUPPORTED:
+                    raise
+    os.unlink(dest)
+    return False
+
+
+def _hardlink(src: str, dest: str) -> bool:
+    try:
+        os.link(src, dest)
+        return True
+    except OSError as e:
+        if e.errno not in _UNSUPPORTED and e.errno != errno.EMLINK:
+            raise
+        return False
+
+
+def _copy_file_range_at(src_fd: int, dest_fd: int, offset: int, dest_offset: int,
+                        size: int) -> int:
+    copied = 0
+    try:
+        while copied < size:
+            count = os.copy_file_range(
+                src_fd, dest_fd, size - copied, offset + copied, dest_offset + copied)
+            if count == 0:
+                break
+            copied += count
+    except OSError as e:
+        # other file system, old kernel, unsupported file: copy the rest another way
+        if e.errno not in _UNSUPPORTED:
+            raise
+    return copied
+
+
+def _sendfile_at(src_fd: int, dest_fd: int, offset: int, dest_offset: int, size: int) -> int:
+    copied = 0
+    os.lseek(dest_fd, dest_offset, os.SEEK_SET)
+    try:
+        while copied < size:
+            count = os.sendfile(dest_fd, src_fd, offset + copied, size - copied)
+            if count == 0:
+                break
+            copied += count
+    except OSError as e:
+        # macOS only sends to sockets
+        if e.errno not in _UNSUPPORTED and e.errno != errno.ENOTSOCK:
+            raise
+    return copied
+
+
+def copy_range(src_fp: typing.BinaryIO, dest_fp: typing.BinaryIO, offset: int, size: int) -> int:
+    """Copy size bytes at offset of src_fp to the current position of dest_fp
+    without going through Python buffers: copy_file_range (reflinks or in
+    kernel copies), then sendfile, then a mmap of the source."""
+    dest_fp.flush()
+    src_fd = src_fp.fileno()
+    dest_fd = dest_fp.fileno()
+    dest_offset = dest_fp.tell()
+    copied = 0
+    if hasattr(os, "copy_file_range"):
+        copied = _copy_file_range_at(src_fd, dest_fd, offset, dest_offset, size)
+    if copied < size and hasattr(os, "sendfile"):
+        copied += _sendfile_at(
+            src_fd, dest_fd, offset + copied, dest_offset + copied, size - copied)
+    if copied < size:
+        with mmap.mmap(src_fd, 0, access=mmap.ACCESS_READ) as mapped:
+            if offset + size > len(mapped):
+                raise EOFError(f"copy: source is shorter than {offset + size} bytes")
+            view = memoryview(mapped)
+            try:
+                os.lseek(dest_fd, dest_offset + copied, os.SEEK_SET)
+                while copied < size:
+                    end = min(size, copied + _COPY_BLOCK_SIZE)
+                    copied += os.write(dest_fd, view[offset + copied: offset + end])
+            finally:
+                view.release()
+    dest_fp.seek(dest_offset + size)
+    return copied
+
+
+def _copy_file_range(src: str, dest: str, size: int) -> bool:
+    if not hasattr(os, "copy_file_range"):
+        return False
+    with open(src, "rb") as src_fp:
+        with open(dest, "wb") as dest_fp:
+            copied = _copy_file_range_at(src_fp.fileno(), dest_fp.fileno(), 0, 0, size)
+            if copied == size:
+                return True
+    os.unlink(dest)
+    return False
+
+
+def copy_file(src: str, dest: str, hardlink: bool = False,
+              stats: typing.Optional[CopyStats] = None) -> str:
+    """Copy the regular file src to dest (which must not exist) and return the
+    method used. hardlink allows sharing the inode: only pass it when neither
+    side will ever be modified in place."""
+    size = os.path.getsize(src)
+    if _reflink(src, dest):
+        method = "reflink"
+    elif hardlink and _hardlink(src, dest):
+        method = "hardlink"
+    elif _copy_file_range(src, dest, size):
+        method = "copy_file_range"
+    else:
+        shutil.copyfile(src, dest)
+        method = "copy"
+    if method != "hardlink":
+        shutil.copystat(src, dest)
+    if stats is not None:
+        stats.add(method, size)
+    return method
+
+
+def copy_tree(src: str, dest: str, hardlink: bool = False,
+              skip: typing.Optional[typing.Collection[str]] = None,
+              stats: typing.Optional[CopyStats] = None):
+    """Copy the file or directory src to dest, recreating symlinks. Paths in
+    skip (under src) are left out, for files the caller regenerates."""
+    skip = set(os.path.abspath(path) for path in skip) if skip is not None else set()
+    if os.path.islink(src):
+        os.symlink(os.readlink(src), dest)
+        if stats is not None:
+            stats.add("symlink", 0)
+        return
+    if not os.path.isdir(src):
+        if os.path.abspath(src) in skip:
+            if stats is not None:
+                stats.add("skip", os.path.getsize(src))
+            return
+        copy_file(src, dest, hardlink, stats)
+        return
+    for path, dir_list, file_list in os.walk(src):
+        target = os.path.join(dest, os.path.relpath(path, src))
+        os.makedirs(target, exist_ok=True)
+        for name in dir_list + file_list:
+            full = os.path.join(path, name)
+            new_full = os.path.join(target, name)
+            if os.path.islink(full):
+                # os.walk does not descend into symlinked directories
+                os.symlink(os.readlink(full), new_full)
+                if stats is not None:
+                    stats.add("symlink", 0)
+            elif name in file_list:
+                if os.path.abspath(full) in skip:
+                    if stats is not None:
+                        stats.add("skip", os.path.getsize(full))
+                    continue
+                copy_file(full, new_full, hardlink, stats)
+    # after the files, or copying them would touch the directory mtimes again
+    for path, dir_list, _ in os.walk(src):
+        shutil.copystat(path, os.path.join(dest, os.path.relpath(path, src)))
@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""GitHub REST 只读请求, 带磁盘 ETag 缓存和 rate limit 等待。
+写操作仍然使用 PyGithub。
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+import typing
+from urllib.parse import urlencode
+
+import requests
+
+
+class GitHubApiError(Exception):
+
+    def __init__(self, status: int, url: str, message: str = ""):
+        super().__init__(f"github api {status} {url} {message}".strip())
+        self.status = status
+        self.url = url
+
+
+class RateLimit(object):
+    """Budget of the last response."""
+
+    def __init__(self):
+        self.limit: typing.Optional[int] = None
+        self.remaining: typing.Optional[int] = None
+        self.reset: float = 0.0
+        self.resource = ""
+
+    def update(self, headers: typing.Mapping[str, str]):
+        if "X-RateLimit-Remaining" not in headers:
+            return
+        self.remaining = int(headers["X-RateLimit-Remaining"])
+        self.limit = int(headers.get("X-RateLimit-Limit", self.remaining))
+        self.reset = float(headers.get("X-RateLimit-Reset", 0))
+        self.resource = headers.get("X-RateLimit-Resource", "")
+
+    def wait_seconds(self, calls: int, reserve: int, now: float) -> float:
+        """How long to wait before calls more calls leave reserve untouched."""
+        if self.limit is not None:
+            # a small budget (unauthenticated) keeps a tenth of it
+            reserve = min(reserve, self.limit // 10)
+        if self.remaining is None or self.remaining - calls >= reserve:
+            return 0.0
+        if self.limit is not None and calls + reserve > self.limit:
+            # more than a whole window: only wait when the window is used up
+            if self.remaining > 0:
+                return 0.0
+        return max(0.0, self.reset - now + 1)
+
+
+class GitHubApi(object):
+
+    def __init__(self, token: typing.Optional[str], cache_dir: typing.Optional[str],
+                 base_url: str = "https://api.github.com", reserve: int = 50,
+                 max_wait: float = 3600, timeout: float = 30,
+                 session: typing.Any = None):
+        """
+        :param session: anything with get(url, headers=, timeout=), e.g. a
+                        shared pooled client; the GitHub headers are sent
+                        per request and never set on it
+        """
+        self.base_url = base_url.rstrip("/")
+        self.cache_dir = cache_dir if cache_dir is not None and len(cache_dir) > 0 else None
+        self.reserve = reserve
+        self.max_wait = max_wait
+        self.timeout = timeout
+        self.rate = RateLimit()
+        self.session = session if session is not None else requests.Session()
+        self.headers = {
+            "Accept": "application/vnd.github+json",
+            "X-GitHub-Api-Version": "2022-11-28",
+        }
+        if token:
+            self.headers["Authorization"] = f"Bearer {token}"
+        self.calls = 0
+        self.not_modified = 0
+        self.waited = 0.0
+        self._lock = threading.Lock()
+        if self.cache_dir is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def url(self, path: str, params: typing.Optional[dict] = None) -> str:
+        url = path if path.startswith("http") else f"{self.base_url}/{path.lstrip('/')}"
+        if params:
+            url = f"{url}{'&' if '?' in url else '?'}{urlencode(sorted(params.items()))}"
+        return url
+
+    def _cache_path(self, url: str) -> typing.Optional[str]:
+        if self.cache_dir is None:
+            return None
+        return os.path.join(self.cache_dir, hashlib.sha256(url.encode("utf-8")).hexdigest() + ".json")
+
+    def _load(self, url: str) -> typing.Optional[dict]:
+        path = self._cache_path(url)
+        if path is None or not os.path.exists(path):
+            return None
+        try:
+            with open(path, "r") as fp:
+                entry = json.load(fp)
+        except (OSError, ValueError):
+            return None
+        return entry if entry.get("url") == url else None
+
+    def _store(self, url: str, entry: dict):
+        path = self._cache_path(url)
+        if path is None:
+            return
+        temp = f"{path}_temp_{threading.get_ident()}"
+        with open(temp, "w") as fp:
+            json.dump(entry, fp)
+        os.replace(temp, path)
+
+    def wait(self, calls: int = 1):
+        """Sleep until calls can be made without going below the reserve."""
+        with self._lock:
+            seconds = self.rate.wait_seconds(calls, self.reserve, time.time())
+        if seconds <= 0:
+            return
+        if seconds > self.max_wait:
+            raise GitHubApiError(403, self.rate.resource,
+                                 f"rate limit resets in {seconds:.0f}s")
+        print(f"github api: {self.rate.remaining} calls left, wait {seconds:.0f}s for the reset")
+        time.sleep(seconds)
+        with self._lock:
+            self.waited += seconds
+            # the window is new; the next response tells the real budget
+            self.rate.remaining = None
+
+    def _retry_after(self, response: requests.Response) -> typing.Optional[float]:
+        if response.status_code not in (403, 429):
+            return None
+        if "Retry-After" in response.headers:
+            return float(response.headers["Retry-After"])
+        if response.headers.get("X-RateLimit-Remaining") == "0":
+            return max(0.0, float(response.headers.get("X-RateLimit-Reset", 0)) - time.time() + 1)
+        return None
+
+    def get(self, path: str, params: typing.Optional[dict] = None,
+            retries: int = 3) -> tuple[typing.Any, dict]:
+        """GET a resource; the cached body when unchanged.
+        :return: (json body, {"link": ..., "cached": bool})"""
+        url = self.url(path, params)
+        cached = self._load(url)
+        headers = dict(self.headers)
+        if cached is not None:
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+            if cached.get("last_modified"):
+                headers["If-Modified-Since"] = cached["last_modified"]
+        for attempt in range(retries + 1):
+            self.wait()
+            response = self.session.get(url, headers=headers, timeout=self.timeout)
+            with self._lock:
+                self.calls += 1
+                self.rate.update(response.headers)
+            delay = self._retry_after(response)
+            if delay is None or attempt == retries:
+                break
+            if delay > self.max_wait:
+                break
+            print(f"github api: rate limited, retry {url} in {delay:.0f}s")
+            time.sleep(delay)
+            with self._lock:
+                self.waited += delay
+        if response.status_code == 304 and cached is not None:
+            with self._lock:
+                self.not_modified += 1
+            return cached["body"], {"link": cached.get("link"), "cached": True}
+        if response.status_code == 404:
+            return None, {"link": None, "cached": False}
+        if response.status_code != 200:
+            raise GitHubApiError(response.status_code, url, response.text[:200])
+        body = response.json()
+        link = response.headers.get("Link")
+        if "ETag" in response.headers or "Last-Modified" in response.headers:
+            self._store(url, {
+                "url": url, "etag": response.headers.get("ETag"),
+                "last_modified": response.headers.get("Last-Modified"),
+                "link": link, "body": body,
+            })
+        return body, {"link": link, "cached": False}
+
+    def pages(self, path: str, params: typing.Optional[dict] = None,
+              per_page: int = 100) -> typing.Iterator[typing.Any]:
+        """Items of a list endpoint, one request per page."""
+        params = dict(params) if params is not None else dict()
+        params["per_page"] = per_page
+        url: typing.Optional[str] = self.url(path, params)
+        while url is not None:
+            body, meta = self.get(url)
+            if body is None:
+                return
+            yield from body
+            url = _next_link(meta["link"])
+
+    def release_by_tag(self, owner: str, repo: str, tag: str) -> typing.Optional[dict]:
+        """releases/tags/{tag} never answers drafts; those are found in the list."""
+        body, _ = self.get(f"repos/{owner}/{repo}/releases/tags/{tag}")
+        if body is not None:
+            return body
+        for release in self.pages(f"repos/{owner}/{repo}/releases"):
+            if release.get("tag_name") == tag:
+                return release
+        return None
+
+    def release_assets(self, owner: str, repo: str, release_id: int) -> typing.Iterator[dict]:
+        return self.pages(f"repos/{owner}/{repo}/releases/{release_id}/assets")
+
+    def tags(self, owner: str, repo: str) -> typing.Iterator[dict]:
+        return self.pages(f"repos/{owner}/{repo}/tags")
+
+    def report(self):
+        print(f"github api calls={self.calls} not_modified={self.not_modified} "
+              f"remaining={self.rate.remaining}/{self.rate.limit} waited={self.waited:.0f}s")
+
+
+def _next_link(link: typing.Optional[str]) -> typing.Optional[str]:
+    if not link:
+        return None
+    for part in link.split(","):
+        section = part.split(";")
+        if len(section) < 2:
+            continue
+        if any(value.strip() == 'rel="next"' for value in section[1:]):
+            return section[0].strip()[1:-1]
+    return None
@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+"""所有下载和列表请求共用的 HTTP 连接池。
+每个请求都有连接/读取超时, GET/HEAD 在连接错误, 超时和 5xx 时退避重试, 按 host 统计耗时。
+"""
+import functools
+import random
+import threading
+import time
+import typing
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import EmptyPoolError
+
+import Metrics
+import Trace
+
+RETRY_METHODS = frozenset(("GET", "HEAD", "OPTIONS"))
+RETRY_STATUS = frozenset((500, 502, 503, 504))
+
+
+class _PoolTimeout(object):
+    """Connection pool that waits at most pool_timeout for a free connection
+    (urllib3 waits forever when a blocking pool is full)."""
+
+    def __init__(self, *args, pool_timeout: typing.Optional[float] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool_timeout = pool_timeout
+
+    def _get_conn(self, timeout=None):
+        return super()._get_conn(timeout if timeout is not None else self.pool_timeout)
+
+
+class _HTTPPool(_PoolTimeout, HTTPConnectionPool):
+    pass
+
+
+class _HTTPSPool(_PoolTimeout, HTTPSConnectionPool):
+    pass
+
+
+class HostStats(object):
+
+    def __init__(self):
+        self.requests = 0
+        self.retries = 0
+        self.errors = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "requests": self.requests, "retries": self.retries, "errors": self.errors,
+            "seconds": round(self.seconds, 6), "max_seconds": round(self.max_seconds, 6),
+        }
+
+
+class HttpClient(object):
+
+    def __init__(self, connect_timeout: float = 10, read_timeout: float = 60,
+                 retries: int = 3, backoff: float = 1.0, max_backoff: float = 30,
+                 max_per_host: int = 8, max_hosts: int = 16, pool_timeout: float = 60,
+                 user_agent: typing.Optional[str] = None):
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.session = requests.Session()
+        # retries are done here, with backoff and timing, not by urllib3
+        adapter = HTTPAdapter(pool_connections=max_hosts, pool_maxsize=max_per_host,
+                              max_retries=0, pool_block=True)
+        adapter.poolmanager.pool_classes_by_scheme = {
+            "http": functools.partial(_HTTPPool, pool_timeout=pool_timeout),
+            "https": functools.partial(_HTTPSPool, pool_timeout=pool_timeout),
+        }
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        if user_agent is not None:
+            self.session.headers["User-Agent"] = user_agent
+        self.hosts: dict[str, HostStats] = dict()
+        self._lock = threading.Lock()
+
+    def _timeout(self, timeout: typing.Any) -> typing.Any:
+        if timeout is None:
+            return self.connect_timeout, self.read_timeout
+        if isinstance(timeout, (int, float)):
+            # a single number is the read timeout, as for the download paths
+            return min(self.connect_timeout, timeout), timeout
+        return timeout
+
+    def _delay(self, attempt: int, response: typing.Optional[requests.Response]) -> float:
+        delay = random.uniform(0, min(self.max_backoff, self.backoff * (2 ** attempt)))
+        if response is not None:
+            retry_after = response.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                delay = max(delay, min(self.max_backoff, float(retry_after)))
+        return delay
+
+    def _record(self, host: str, seconds: float, retry: bool, error: bool):
+        with self._lock:
+            stats = self.hosts.get(host)
+            if stats is None:
+                stats = HostStats()
+                self.hosts[host] = stats
+            stats.requests += 1
+            stats.retries += 1 if retry else 0
+            stats.errors += 1 if error else 0
+            stats.seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+        Metrics.add("http_requests", 1)
+        Metrics.add("http_seconds", seconds)
+        if retry:
+            Metrics.add("http_retries", 1)
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        """Session.request with the client's timeouts and retries. Raises the
+        last exception, or returns the last 5xx answer, when retries run out."""
+        method = method.upper()
+        kwargs["timeout"] = self._timeout(kwargs.get("timeout"))
+        retries = self.retries if method in RETRY_METHODS else 0
+        host = urlparse(url).netloc
+        attempt = 0
+        while True:
+            start = time.perf_counter()
+            with Trace.span(f"http {method}", "http", host=host, attempt=attempt) as span:
+                try:
+                    try:
+                        response = self.session.request(method, url, **kwargs)
+                    except EmptyPoolError as e:
+                        # requests passes it through as is
+                        raise requests.ConnectionError(
+                            f"no free connection to {host} in {e.pool.pool_timeout}s"
+                        ) from e
+                except (requests.ConnectionError, requests.Timeout) as e:
+                    seconds = time.perf_counter() - start
+                    retry = attempt < retries
+                    self._record(host, seconds, attempt > 0, True)
+                    if not retry:
+                        raise
+                    span.set("error", type(e).__name__)
+                    response = None
+                else:
+                    seconds = time.perf_counter() - start
+                    span.set("status", response.status_code)
+                    retry = response.status_code in RETRY_STATUS and attempt < retries
+                    self._record(host, seconds, attempt > 0, response.status_code >= 500)
+                    if not retry:
+                        return response
+                    response.close()
+            delay = self._delay(attempt, response)
+            print(f"http {method} {url} "
+                  f"{response.status_code if response is not None else 'failed'}, "
+                  f"retry in {delay:.1f}s")
+            time.sleep(delay)
+            attempt += 1
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url: str, **kwargs) -> requests.Response:
+        return self.request("HEAD", url, **kwargs)
+
+    def stats(self) -> dict[str, dict]:
+        with self._lock:
+            return {host: stats.to_dict() for host, stats in self.hosts.items()}
+
+    def report(self):
+        for host, stats in sorted(self.stats().items(), key=lambda item: -item[1]["seconds"]):
+            average = stats["seconds"] / max(1, stats["requests"])
+            print(f"http {host} requests={stats['requests']} retries={stats['retries']} "
+                  f"errors={stats['errors']} avg={average:.3f}s max={stats['max_seconds']:.3f}s")
+
+    def close(self):
+        self.session.close()
+
+
+_client: typing.Optional[HttpClient] = None
+_client_lock = threading.Lock()
+
+
+def setup(**options) -> HttpClient:
+    """Replace the process wide client (options of HttpClient)."""
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+        _client = HttpClient(**options)
+        return _client
+
+
+def client() -> HttpClient:
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = HttpClient()
+        return _client
+
+
+def get(url: str, **kwargs) -> requests.Response:
+    return client().get(url, **kwargs)
+
+
+def head(url: str, **kwargs) -> requests.Response:
+    return client().head(url, **kwargs)
+
+
+def report():
+    if _client is not None:
+        _client.report()
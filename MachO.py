@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+"""Mach-O 通用 (fat) 二进制的读写, 不需要 lipo。"""
+import os
+import shutil
+import struct
+import typing
+
+from FileCopy import copy_range
+
+FAT_MAGIC = 0xCAFEBABE
+FAT_MAGIC_64 = 0xCAFEBABF
+MH_MAGIC = 0xFEEDFACE
+MH_MAGIC_64 = 0xFEEDFACF
+
+CPU_ARCH_ABI64 = 0x01000000
+CPU_ARCH_ABI64_32 = 0x02000000
+CPU_TYPE_X86 = 7
+CPU_TYPE_X86_64 = CPU_TYPE_X86 | CPU_ARCH_ABI64
+CPU_TYPE_ARM = 12
+CPU_TYPE_ARM64 = CPU_TYPE_ARM | CPU_ARCH_ABI64
+CPU_TYPE_ARM64_32 = CPU_TYPE_ARM | CPU_ARCH_ABI64_32
+CPU_SUBTYPE_MASK = 0xFF000000
+
+# (cputype, cpusubtype) -> name used by lipo
+ARCHITECTURES: dict[tuple[int, int], str] = {
+    (CPU_TYPE_X86, 3): "i386",
+    (CPU_TYPE_X86_64, 3): "x86_64",
+    (CPU_TYPE_X86_64, 8): "x86_64h",
+    (CPU_TYPE_ARM, 6): "armv6",
+    (CPU_TYPE_ARM, 9): "armv7",
+    (CPU_TYPE_ARM, 11): "armv7s",
+    (CPU_TYPE_ARM, 12): "armv7k",
+    (CPU_TYPE_ARM64, 0): "arm64",
+    (CPU_TYPE_ARM64, 2): "arm64e",
+    (CPU_TYPE_ARM64_32, 1): "arm64_32",
+}
+
+# lipo refuses more, and it tells fat files apart from java class files
+_MAX_FAT_ARCHS = 64
+_FAT_HEADER = struct.Struct(">II")
+_FAT_ARCH = struct.Struct(">iIIII")
+_FAT_ARCH_64 = struct.Struct(">iIQQII")
+
+
+class MachOSlice(typing.NamedTuple):
+    cputype: int
+    cpusubtype: int
+    offset: int
+    size: int
+    # power of two
+    align: int
+
+    @property
+    def arch(self) -> str:
+        key = (self.cputype, self.cpusubtype & ~CPU_SUBTYPE_MASK)
+        return ARCHITECTURES.get(key, f"cputype{self.cputype}:{key[1]}")
+
+
+def _default_align(cputype: int) -> int:
+    # what lipo uses for thin inputs: 16 KiB pages on arm, 4 KiB elsewhere
+    if cputype & ~CPU_ARCH_ABI64 & ~CPU_ARCH_ABI64_32 == CPU_TYPE_ARM:
+        return 14
+    return 12
+
+
+def read_slices(path: str) -> typing.Optional[list[MachOSlice]]:
+    """Slices of the fat or thin Mach-O file path; None when it is neither."""
+    size = os.path.getsize(path)
+    with open(path, "rb") as fp:
+        header = fp.read(_FAT_HEADER.size)
+        if len(header) < _FAT_HEADER.size:
+            return None
+        magic, count = _FAT_HEADER.unpack(header)
+        if magic in (FAT_MAGIC, FAT_MAGIC_64):
+            if count == 0 or count > _MAX_FAT_ARCHS:
+                return None
+            slices: list[MachOSlice] = []
+            for _ in range(count):
+                if magic == FAT_MAGIC:
+                    cputype, cpusubtype, offset, length, align = _FAT_ARCH.unpack(
+                        fp.read(_FAT_ARCH.size))
+                else:
+                    cputype, cpusubtype, offset, length, align, _ = _FAT_ARCH_64.unpack(
+                        fp.read(_FAT_ARCH_64.size))
+                if offset + length > size:
+                    raise ValueError(f"mach-o: slice at {offset} runs past the end of {path}")
+                slices.append(MachOSlice(cputype, cpusubtype, offset, length, align))
+            return slices
+        fp.seek(0)
+        thin = fp.read(12)
+    for order in ("<", ">"):
+        magic, cputype, cpusubtype = struct.unpack(f"{order}IiI", thin)
+        if magic in (MH_MAGIC, MH_MAGIC_64):
+            return [MachOSlice(cputype, cpusubtype, 0, size, _default_align(cputype))]
+    return None
+
+
+def architectures(path: str) -> list[str]:
+    slices = read_slices(path)
+    if slices is None:
+        return []
+    return [item.arch for item in slices]
+
+
+def find_slice(slices: list[MachOSlice], arch: str) -> typing.Optional[MachOSlice]:
+    for item in slices:
+        if item.arch == arch:
+            return item
+    return None
+
+
+def thin(path: str, arch: str, output: str) -> typing.Optional[int]:
+    """Write the arch slice of path to output as a thin file.
+    Returns the number of bytes copied, None when path has no such slice."""
+    slices = read_slices(path)
+    item = find_slice(slices, arch) if slices is not None else None
+    if item is None:
+        return None
+    if item.offset == 0 and item.size == os.path.getsize(path):
+        shutil.copyfile(path, output)
+        return item.size
+    with open(path, "rb") as src_fp, open(output, "wb") as dest_fp:
+        return copy_range(src_fp, dest_fp, item.offset, item.size)
+
+
+def fat_layout(slices: list[MachOSlice]) -> tuple[bytes, list[int]]:
+    """Fat header for slices and the offset each slice is written at.
+    FAT_MAGIC_64 is used only when an offset or size needs it."""
+    offsets: list[int] = []
+
+    def _place(header_size: int) -> int:
+        offsets.clear()
+        position = header_size
+        for item in slices:
+            alignment = 1 << item.align
+            position = (position + alignment - 1) // alignment * alignment
+            offsets.append(position)
+            position += item.size
+        return position
+
+    end = _place(_FAT_HEADER.size + _FAT_ARCH.size * len(slices))
+    magic = FAT_MAGIC
+    if end > 0xFFFFFFFF:
+        magic = FAT_MAGIC_64
+        _place(_FAT_HEADER.size + _FAT_ARCH_64.size * len(slices))
+    header = bytearray(_FAT_HEADER.pack(magic, len(slices)))
+    for item, offset in zip(slices, offsets):
+        if magic == FAT_MAGIC:
+            header += _FAT_ARCH.pack(item.cputype, item.cpusubtype, offset, item.size, item.align)
+        else:
+            header += _FAT_ARCH_64.pack(
+                item.cputype, item.cpusubtype, offset, item.size, item.align, 0)
+    return bytes(header), offsets
+
+
+def create(sources: list[tuple[str, MachOSlice]], output: str) -> int:
+    """Write a fat file holding each (path, slice) of sources, in order,
+    copying every slice straight from its source file. Returns the number of
+    slice bytes copied."""
+    slices = [item for _, item in sources]
+    seen: set[tuple[int, int]] = set()
+    for item in slices:
+        key = (item.cputype, item.cpusubtype & ~CPU_SUBTYPE_MASK)
+        if key in seen:
+            raise ValueError(f"mach-o: {item.arch} given more than once")
+        seen.add(key)
+    header, offsets = fat_layout(slices)
+    copied = 0
+    with open(output, "wb") as dest_fp:
+        dest_fp.write(header)
+        for (path, item), offset in zip(sources, offsets):
+            # zero filled alignment padding
+            dest_fp.write(b"\x00" * (offset - dest_fp.tell()))
+            with open(path, "rb") as src_fp:
+                copied += copy_range(src_fp, dest_fp, item.offset, item.size)
+    return copied
+
+
+def extract(path: str, archs: list[str], output: str) -> typing.Optional[int]:
+    """Write the archs slices of path to output: thin for one arch, fat
+    otherwise (lipo -extract). Returns the number of bytes copied, None when
+    path is not Mach-O or lacks one of archs."""
+    slices = read_slices(path)
+    if slices is None:
+        return None
+    chosen: list[MachOSlice] = []
+    for arch in archs:
+        item = find_slice(slices, arch)
+        if item is None:
+            return None
+        chosen.append(item)
+    if len(chosen) == 1:
+        return thin(path, archs[0], output)
+    return create([(path, item) for item in chosen], output)
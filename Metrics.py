@@ -0,0 +1,302 @@
+# -*- coding: utf-8 -*-
+"""每次运行的性能指标: 阶段耗时, 计数, 磁盘和内存峰值。
+输出 JSON 和 Prometheus textfile, setup() 之前模块函数什么都不做。
+"""
+import contextlib
+import json
+import os
+import shutil
+import sys
+import threading
+import time
+import typing
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+class StageRecord(object):
+    """One run of a stage for one version."""
+
+    def __init__(self, stage: str, version: str):
+        self.stage = stage
+        self.version = version
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.ok: typing.Optional[bool] = None
+        self.counters: dict[str, float] = dict()
+
+    def add(self, name: str, value: float):
+        self.counters[name] = self.counters.get(name, 0) + value
+
+    def to_dict(self) -> dict:
+        result = {
+            "stage": self.stage, "version": self.version, "ok": self.ok,
+            "wall_seconds": round(self.wall, 6), "cpu_seconds": round(self.cpu, 6),
+        }
+        result.update(self.counters)
+        for name in ("bytes_in", "bytes_out"):
+            if name in self.counters and self.wall > 0:
+                result[f"{name}_per_second"] = round(self.counters[name] / self.wall, 1)
+        return result
+
+
+def _max_rss_bytes(who: int) -> int:
+    if resource is None:
+        return 0
+    rss = resource.getrusage(who).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def _child_cpu_seconds() -> float:
+    if resource is None:
+        return 0.0
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class RunMetrics(object):
+
+    def __init__(self, disk_path: typing.Optional[str] = None, interval: float = 1.0):
+        self.started = time.time()
+        self.stages: list[StageRecord] = []
+        self.counters: dict[str, float] = dict()
+        self.gauges: dict[str, float] = dict()
+        self._wall = time.perf_counter()
+        self._cpu = time.process_time()
+        self._child_cpu = _child_cpu_seconds()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._disk_path = disk_path
+        self._disk_base: typing.Optional[int] = None
+        self.peak_disk_bytes = 0
+        self._stop = threading.Event()
+        self._sampler: typing.Optional[threading.Thread] = None
+        if disk_path is not None:
+            os.makedirs(disk_path, exist_ok=True)
+            self._disk_base = shutil.disk_usage(disk_path).used
+            self._sampler = threading.Thread(
+                target=self._sample, args=(interval,), name="metrics-sampler", daemon=True)
+            self._sampler.start()
+
+    def _sample(self, interval: float):
+        while True:
+            self.sample_disk()
+            if self._stop.wait(interval):
+                return
+
+    def sample_disk(self):
+        if self._disk_path is None or self._disk_base is None:
+            return
+        try:
+            used = shutil.disk_usage(self._disk_path).used - self._disk_base
+        except OSError:
+            return
+        with self._lock:
+            self.peak_disk_bytes = max(self.peak_disk_bytes, used)
+
+    @contextlib.contextmanager
+    def stage(self, stage: str, version: str = "") -> typing.Iterator[StageRecord]:
+        """Measure a block; add() calls made meanwhile on this thread are
+        charged to it."""
+        record = StageRecord(stage, version)
+        previous = getattr(self._local, "record", None)
+        self._local.record = record
+        wall = time.perf_counter()
+        cpu = time.thread_time()
+        try:
+            yield record
+        finally:
+            record.wall = time.perf_counter() - wall
+            record.cpu = time.thread_time() - cpu
+            self._local.record = previous
+            with self._lock:
+                self.stages.append(record)
+
+    def add(self, name: str, value: float):
+        """Add to a run counter and to the stage open on this thread."""
+        record = getattr(self._local, "record", None)
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+            if record is not None:
+                record.add(name, value)
+
+    def set_gauge(self, name: str, value: float):
+        with self._lock:
+            self.gauges[name] = value
+
+    def close(self):
+        self._stop.set()
+        if self._sampler is not None:
+            self._sampler.join()
+            self._sampler = None
+        self.sample_disk()
+
+    def to_dict(self) -> dict:
+        wall = time.perf_counter() - self._wall
+        with self._lock:
+            stages = [record.to_dict() for record in self.stages]
+            totals: dict[str, dict] = dict()
+            for record in self.stages:
+                total = totals.setdefault(record.stage, {
+                    "count": 0, "failed": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0})
+                total["count"] += 1
+                total["failed"] += 1 if record.ok is False else 0
+                total["wall_seconds"] += record.wall
+                total["cpu_seconds"] += record.cpu
+                for name, value in record.counters.items():
+                    total[name] = total.get(name, 0) + value
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+            peak_disk = self.peak_disk_bytes
+        for total in totals.values():
+            for name in ("bytes_in", "bytes_out"):
+                if name in total and total["wall_seconds"] > 0:
+                    total[f"{name}_per_second"] = round(total[name] / total["wall_seconds"], 1)
+        return {
+            "started": self.started,
+            "wall_seconds": round(wall, 6),
+            "cpu_seconds": round(time.process_time() - self._cpu, 6),
+            "child_cpu_seconds": round(_child_cpu_seconds() - self._child_cpu, 6),
+            "peak_rss_bytes": _max_rss_bytes(resource.RUSAGE_SELF) if resource else 0,
+            "peak_child_rss_bytes": _max_rss_bytes(resource.RUSAGE_CHILDREN) if resource else 0,
+            "peak_disk_bytes": peak_disk,
+            "counters": counters,
+            "gauges": gauges,
+            "stage_totals": totals,
+            "stages": stages,
+        }
+
+    def write_json(self, path: str, data: typing.Optional[dict] = None):
+        data = data if data is not None else self.to_dict()
+        _write_atomic(path, json.dumps(data, indent=1, sort_keys=True))
+
+    def write_prometheus(self, path: str, prefix: str = "run",
+                         data: typing.Optional[dict] = None):
+        data = data if data is not None else self.to_dict()
+        lines: list[str] = []
+
+        def _metric(name: str, help_text: str, samples: list[tuple[dict, float]]):
+            if len(samples) == 0:
+                return
+            full = f"{prefix}_{_metric_name(name)}"
+            lines.append(f"# HELP {full} {help_text}")
+            lines.append(f"# TYPE {full} gauge")
+            for labels, value in samples:
+                lines.append(f"{full}{_labels(labels)} {_number(value)}")
+
+        _metric("wall_seconds", "Wall time of the run.", [({}, data["wall_seconds"])])
+        _metric("cpu_seconds", "CPU time of the run process.", [({}, data["cpu_seconds"])])
+        _metric("child_cpu_seconds", "CPU time of worker processes.",
+                [({}, data["child_cpu_seconds"])])
+        _metric("peak_rss_bytes", "Peak resident set size.", [
+            ({"process": "main"}, data["peak_rss_bytes"]),
+            ({"process": "children"}, data["peak_child_rss_bytes"]),
+        ])
+        _metric("peak_disk_bytes", "Peak extra disk space used during the run.",
+                [({}, data["peak_disk_bytes"])])
+        for name, value in sorted(data["counters"].items()):
+            _metric(name, f"Run total of {name}.", [({}, value)])
+        for name, value in sorted(data["gauges"].items()):
+            _metric(name, f"{name} at the end of the run.", [({}, value)])
+        fields = sorted({key for total in data["stage_totals"].values() for key in total})
+        for field in fields:
+            _metric(f"stage_{field}", f"Stage {field} over all versions.", [
+                ({"stage": stage}, total[field])
+                for stage, total in sorted(data["stage_totals"].items()) if field in total
+            ])
+        for field in ("wall_seconds", "cpu_seconds", "bytes_in", "bytes_out"):
+            _metric(f"version_stage_{field}", f"Stage {field} per version.", [
+                ({"stage": record["stage"], "version": record["version"]}, record[field])
+                for record in data["stages"] if field in record
+            ])
+        _write_atomic(path, "\n".join(lines) + "\n")
+
+
+def _metric_name(name: str) -> str:
+    return "".join(c if c.isalnum() or c == "_" else "_" for c in name)
+
+
+def _labels(labels: dict) -> str:
+    if len(labels) == 0:
+        return ""
+    escaped = [
+        '{}="{}"'.format(key, str(value).replace("\\", "\\\\").replace('"', '\\"')
+                         .replace("\n", "\\n"))
+        for key, value in labels.items()
+    ]
+    return "{" + ",".join(escaped) + "}"
+
+
+def _number(value: float) -> str:
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _write_atomic(path: str, text: str):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    temp = f"{path}_temp"
+    with open(temp, "w") as fp:
+        fp.write(text)
+    os.replace(temp, path)
+
+
+_metrics: typing.Optional[RunMetrics] = None
+_output_path: typing.Optional[str] = None
+_prefix = "run"
+
+
+def setup(output_path: typing.Optional[str], disk_path: typing.Optional[str] = None,
+          prefix: str = "run") -> typing.Optional[RunMetrics]:
+    """Start collecting for this process. finish() writes
+    <output_path>.json and <output_path>.prom; an empty output_path turns
+    collection off."""
+    global _metrics, _output_path, _prefix
+    if output_path is None or len(output_path) == 0:
+        _metrics = None
+        return None
+    _metrics = RunMetrics(disk_path)
+    _output_path = output_path
+    _prefix = prefix
+    return _metrics
+
+
+def current() -> typing.Optional[RunMetrics]:
+    return _metrics
+
+
+def stage(name: str, version: str = "") -> typing.ContextManager[StageRecord]:
+    if _metrics is None:
+        return contextlib.nullcontext(StageRecord(name, version))
+    return _metrics.stage(name, version)
+
+
+def add(name: str, value: float):
+    if _metrics is not None:
+        _metrics.add(name, value)
+
+
+def set_gauge(name: str, value: float):
+    if _metrics is not None:
+        _metrics.set_gauge(name, value)
+
+
+def finish() -> typing.Optional[str]:
+    """Stop the sampler and write the run. Returns the JSON path."""
+    global _metrics
+    if _metrics is None or _output_path is None:
+        return None
+    metrics = _metrics
+    _metrics = None
+    metrics.close()
+    data = metrics.to_dict()
+    metrics.write_json(f"{_output_path}.json", data)
+    metrics.write_prometheus(f"{_output_path}.prom", _prefix, data)
+    print(f"metrics wall={data['wall_seconds']:.1f}s cpu={data['cpu_seconds']:.1f}s "
+          f"peak_rss={data['peak_rss_bytes']} peak_disk={data['peak_disk_bytes']} "
+          f"-> {_output_path}.json")
+    return f"{_output_path}.json"
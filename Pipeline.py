@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+import queue
+import threading
+import time
+import traceback
+import typing
+
+import Trace
+
+
+class PipelineStage(object):
+    """Pipeline 的一个阶段。func(item) 返回 True 时进入下一阶段;
+    resource (network|cpu|disk) 相同的阶段共用一个并发上限。
+    """
+
+    def __init__(self, name: str, func: typing.Callable[[typing.Any], bool],
+                 resource: str, workers: int = 0):
+        self.name = name
+        self.func = func
+        self.resource = resource
+        # 0 means "as many workers as the resource class allows"
+        self.workers = workers
+
+
+class _Envelope(object):
+
+    def __init__(self, index: int, item: typing.Any):
+        self.index = index
+        self.item = item
+        self.ok = True
+        self.failed_stage: typing.Optional[str] = None
+        self.error: typing.Optional[BaseException] = None
+
+
+_STOP = object()
+
+
+class Pipeline(object):
+    """每个阶段前有一个有界队列, 不同的 item 同时处于不同阶段,
+    sink 仍按提交顺序收到结果; 失败的 item 跳过后续阶段, 以 ok=False 交给 sink。
+    """
+
+    def __init__(self, stages: list[PipelineStage], resource_limits: dict[str, int],
+                 queue_size: int = 1):
+        self.stages = stages
+        self.resource_limits = resource_limits
+        self.queue_size = max(1, queue_size)
+        self._semaphores: dict[str, threading.BoundedSemaphore] = dict()
+        for stage in stages:
+            if stage.resource not in self._semaphores:
+                limit = max(1, resource_limits.get(stage.resource, 1))
+                self._semaphores[stage.resource] = threading.BoundedSemaphore(limit)
+
+    def _worker_count(self, stage: PipelineStage) -> int:
+        if stage.workers > 0:
+            return stage.workers
+        return max(1, self.resource_limits.get(stage.resource, 1))
+
+    def run(self, items: typing.Iterable[typing.Any],
+            sink: typing.Callable[[typing.Any, bool, typing.Optional[str]], None]) -> int:
+        """Push items through every stage, calling sink(item, ok, failed_stage)
+        in submission order from the calling thread. Returns the number of items
+        that passed every stage.
+        """
+        queues = [queue.Queue(self.queue_size) for _ in self.stages]
+        done_queue: queue.Queue = queue.Queue()
+        threads: list[threading.Thread] = []
+
+        def _feed():
+            index = 0
+            for item in items:
+                queues[0].put(_Envelope(index, item))
+                index += 1
+            for _ in range(self._worker_count(self.stages[0])):
+                queues[0].put(_STOP)
+
+        def _stage_loop(position: int, alive: list[int], lock: threading.Lock):
+            stage = self.stages[position]
+            input_queue = queues[position]
+            if position + 1 < len(self.stages):
+                output_queue = queues[position + 1]
+                next_workers = self._worker_count(self.stages[position + 1])
+            else:
+                output_queue = done_queue
+                next_workers = 1
+            try:
+                while True:
+                    envelope = input_queue.get()
+                    if envelope is _STOP:
+                        break
+                    try:
+                        if envelope.ok:
+                            with Trace.span(stage.name, "stage", item=repr(envelope.item)) as span:
+                                waited = time.perf_counter()
+                                with self._semaphores[stage.resource]:
+                                    span.set("wait", round(time.perf_counter() - waited, 3))
+                                    envelope.ok = bool(stage.func(envelope.item))
+                                span.set("ok", envelope.ok)
+                    except Exception as e:
+                        envelope.ok = False
+                        envelope.error = e
+                        print(f"pipeline stage {stage.name} exception {e}")
+                        traceback.print_exc()
+                    finally:
+                        if not envelope.ok and envelope.failed_stage is None:
+                            envelope.failed_stage = stage.name
+                        output_queue.put(envelope)
+            finally:
+                # even a dying worker must let the next stage shut down
+                with lock:
+                    alive[0] -= 1
+                    last = alive[0] == 0
+                if last:
+                    for _ in range(next_workers):
+                        output_queue.put(_STOP)
+
+        feeder = threading.Thread(target=_feed, name="pipeline-feed", daemon=True)
+        threads.append(feeder)
+        for position, stage in enumerate(self.stages):
+            count = self._worker_count(stage)
+            alive = [count]
+            lock = threading.Lock()
+            for number in range(count):
+                threads.append(threading.Thread(
+                    target=_stage_loop, args=(position, alive, lock),
+                    name=f"pipeline-{stage.name}-{number}", daemon=True))
+        for thread in threads:
+            thread.start()
+
+        # release results in submission order
+        pending: dict[int, _Envelope] = dict()
+        next_index = 0
+        passed = 0
+        while True:
+            envelope = done_queue.get()
+            if envelope is _STOP:
+                break
+            pending[envelope.index] = envelope
+            while next_index in pending:
+                ready = pending.pop(next_index)
+                next_index += 1
+                if ready.ok:
+                    passed += 1
+                sink(ready.item, ready.ok, ready.failed_stage)
+        for thread in threads:
+            thread.join()
+        return passed
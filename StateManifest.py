@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+"""多次运行之间保存的状态清单 (JSON)。
+记录每个上游版本的来源和校验信息, 发布的资源, 是否已经打 tag。
+"""
+import json
+import os
+import time
+import typing
+
+MANIFEST_FORMAT = 1
+# fields a version entry may carry
+FIELDS = ("source_url", "etag", "last_modified", "size", "asset_url", "sha256",
+          "tagged", "skipped", "republished")
+
+
+class StateManifest(object):
+
+    def __init__(self, data: typing.Optional[dict] = None):
+        data = data if data is not None else dict()
+        self.versions: dict[str, dict] = dict(data.get("versions", dict()))
+        self.index: dict[str, typing.Any] = dict(data.get("index", dict()))
+        self.updated: float = data.get("updated", 0.0)
+        # versions changed since the manifest was loaded
+        self.changed = False
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> typing.Optional["StateManifest"]:
+        """None when data is not a manifest of this format."""
+        try:
+            loaded = json.loads(data.decode("utf-8"))
+        except (ValueError, UnicodeDecodeError):
+            return None
+        if not isinstance(loaded, dict) or loaded.get("format") != MANIFEST_FORMAT:
+            return None
+        return cls(loaded)
+
+    @classmethod
+    def load(cls, path: str) -> typing.Optional["StateManifest"]:
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as fp:
+            return cls.from_bytes(fp.read())
+
+    def to_bytes(self) -> bytes:
+        return json.dumps({
+            "format": MANIFEST_FORMAT,
+            "updated": self.updated,
+            "index": self.index,
+            "versions": self.versions,
+        }, indent=1, sort_keys=True).encode("utf-8")
+
+    def save(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        temp = f"{path}_temp"
+        with open(temp, "wb") as fp:
+            fp.write(self.to_bytes())
+        os.replace(temp, path)
+
+    def get(self, version: str) -> typing.Optional[dict]:
+        return self.versions.get(version)
+
+    def update(self, version: str, **fields):
+        """Set fields of version; None values leave a field as it is."""
+        entry = self.versions.setdefault(version, dict())
+        changed = False
+        for key, value in fields.items():
+            if key not in FIELDS:
+                raise KeyError(f"state manifest: unknown field {key}")
+            if value is not None and entry.get(key) != value:
+                entry[key] = value
+                changed = True
+        if changed:
+            self.changed = True
+            self.updated = time.time()
+
+    def done(self, version: str, source_url: str) -> bool:
+        entry = self.versions.get(version)
+        if entry is None or entry.get("source_url") != source_url:
+            return False
+        return bool(entry.get("tagged")) or bool(entry.get("skipped"))
+
+    def pending(self, links: dict[str, str]) -> list[str]:
+        """Versions of links (version -> source URL) still to be handled."""
+        return [version for version, url in links.items() if not self.done(version, url)]
+
+    def links(self) -> dict[str, str]:
+        """version -> source URL of every recorded version."""
+        return {version: entry["source_url"] for version, entry in self.versions.items()
+                if "source_url" in entry}
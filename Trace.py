@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+"""span 计时, 输出 Chrome trace (JSON), 可用 chrome://tracing 或 Perfetto 打开。
+setup() 指定路径前不记录, traced 函数只多一次判断。
+"""
+import functools
+import json
+import os
+import random
+import sys
+import threading
+import time
+import typing
+
+
+class Span(object):
+    """An open span; use it as a context manager."""
+
+    __slots__ = ("_tracer", "name", "category", "attributes", "sampled", "_start")
+
+    def __init__(self, tracer: "Tracer", name: str, category: str,
+                 attributes: dict[str, typing.Any], sampled: bool):
+        self._tracer = tracer
+        self.name = name
+        self.category = category
+        self.attributes = attributes
+        self.sampled = sampled
+        self._start = 0.0
+
+    def set(self, key: str, value: typing.Any) -> "Span":
+        self.attributes[key] = value
+        return self
+
+    def add(self, key: str, amount: int = 1) -> "Span":
+        """Add to a counter attribute (bytes, files...)."""
+        self.attributes[key] = self.attributes.get(key, 0) + amount
+        return self
+
+    def __enter__(self) -> "Span":
+        self._tracer._push(self)
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        end = time.perf_counter()
+        if exc_type is not None:
+            self.attributes["error"] = exc_type.__name__
+        self._tracer._pop(self, self._start, end)
+        return False
+
+
+class _NullSpan(object):
+
+    __slots__ = ()
+
+    def set(self, key: str, value: typing.Any) -> "_NullSpan":
+        return self
+
+    def add(self, key: str, amount: int = 1) -> "_NullSpan":
+        return self
+
+    def __enter__(self) -> "_NullSpan":
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Tracer(object):
+    """Collects finished spans in memory; at most max_events are kept, the
+    rest only count towards the totals."""
+
+    def __init__(self, path: typing.Optional[str] = None, sample_rate: float = 1.0,
+                 max_events: int = 1000000):
+        self.path = path
+        self.sample_rate = sample_rate
+        self.enabled = path is not None and len(path) > 0 and sample_rate > 0
+        self.max_events = max_events
+        self.dropped = 0
+        # name -> [seconds, calls]
+        self.totals: dict[str, list] = dict()
+        self._events: list[dict] = []
+        self._threads: set[int] = set()
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+        self._pid = os.getpid()
+
+    def _stack(self) -> list[Span]:
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = []
+            self._local.stack = stack
+        return stack
+
+    def span(self, name: str, category: str = "function",
+             **attributes) -> typing.Union[Span, _NullSpan]:
+        if not self.enabled:
+            return _NULL_SPAN
+        stack = self._stack()
+        if len(stack) > 0:
+            sampled = stack[-1].sampled
+        else:
+            sampled = self.sample_rate >= 1 or random.random() < self.sample_rate
+        return Span(self, name, category, attributes, sampled)
+
+    def current(self) -> typing.Union[Span, _NullSpan]:
+        """Innermost open span of this thread."""
+        if not self.enabled:
+            return _NULL_SPAN
+        stack = self._stack()
+        return stack[-1] if len(stack) > 0 else _NULL_SPAN
+
+    def _push(self, span: Span):
+        self._stack().append(span)
+
+    def _pop(self, span: Span, start: float, end: float):
+        stack = self._stack()
+        if len(stack) > 0 and stack[-1] is span:
+            stack.pop()
+        with self._lock:
+            total = self.totals.get(span.name)
+            if total is None:
+                self.totals[span.name] = [end - start, 1]
+            else:
+                total[0] += end - start
+                total[1] += 1
+            if span.sampled:
+                self._append({
+                    "name": span.name, "cat": span.category, "ph": "X",
+                    "ts": round((start - self._origin) * 1e6, 1),
+                    "dur": round((end - start) * 1e6, 1),
+                    "pid": self._pid, "tid": threading.get_ident(),
+                    "args": span.attributes,
+                })
+
+    def _append(self, event: dict):
+        # called with the lock held
+        if len(self._events) >= self.max_events:
+            self.dropped += 1
+            return
+        tid = event["tid"]
+        if tid not in self._threads:
+            self._threads.add(tid)
+            self._events.append({
+                "name": "thread_name", "ph": "M", "pid": self._pid, "tid": tid,
+                "args": {"name": threading.current_thread().name},
+            })
+        self._events.append(event)
+
+    def mark(self, name: typing.Optional[str] = None, depth: int = 1, **attributes):
+        """Instant event; named after the calling function and line by default."""
+        if not self.enabled:
+            return
+        stack = self._stack()
+        if len(stack) > 0 and not stack[-1].sampled:
+            return
+        if name is None:
+            frame = sys._getframe(depth)
+            name = f"{frame.f_code.co_name}:{frame.f_lineno}"
+        with self._lock:
+            self._append({
+                "name": name, "cat": "mark", "ph": "i", "s": "t",
+                "ts": round((time.perf_counter() - self._origin) * 1e6, 1),
+                "pid": self._pid, "tid": threading.get_ident(), "args": attributes,
+            })
+
+    def report(self, limit: int = 15):
+        if not self.enabled:
+            return
+        with self._lock:
+            totals = sorted(self.totals.items(), key=lambda item: item[1][0], reverse=True)
+        for name, (seconds, calls) in totals[:limit]:
+            print(f"trace {name} calls={calls} total={seconds:.3f}s")
+
+    def write(self) -> typing.Optional[str]:
+        """Save the trace to path (atomically). Returns the path written."""
+        if not self.enabled:
+            return None
+        with self._lock:
+            data = {
+                "traceEvents": list(self._events),
+                "displayTimeUnit": "ms",
+                "otherData": {"sample_rate": self.sample_rate, "dropped": self.dropped},
+            }
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        temp = f"{self.path}_temp"
+        with open(temp, "w") as fp:
+            json.dump(data, fp, default=str, separators=(",", ":"))
+        os.replace(temp, self.path)
+        print(f"trace {len(data['traceEvents'])} events -> {self.path}")
+        return self.path
+
+
+_tracer = Tracer()
+
+
+def setup(path: typing.Optional[str], sample_rate: float = 1.0) -> Tracer:
+    """Replace the process wide tracer; an empty path turns tracing off."""
+    global _tracer
+    _tracer = Tracer(path, sample_rate)
+    return _tracer
+
+
+def tracer() -> Tracer:
+    return _tracer
+
+
+def span(name: str, category: str = "function", **attributes) -> typing.Union[Span, _NullSpan]:
+    return _tracer.span(name, category, **attributes)
+
+
+def annotate(**attributes):
+    """Set attributes on the innermost open span of this thread."""
+    if not _tracer.enabled:
+        return
+    current = _tracer.current()
+    for key, value in attributes.items():
+        current.set(key, value)
+
+
+def mark(name: typing.Optional[str] = None, **attributes):
+    _tracer.mark(name, 2, **attributes)
+
+
+def report():
+    _tracer.report()
+
+
+def write() -> typing.Optional[str]:
+    return _tracer.write()
+
+
+def traced(func):
+    """Run every call of func in a span named after it."""
+    name = func.__qualname__
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        current = _tracer
+        if not current.enabled:
+            return func(*args, **kwargs)
+        with current.span(name):
+            return func(*args, **kwargs)
+
+    return wrapper
@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+"""多 block 的 .xz 文件并行解码。
+每个 block 单独包成一个 xz 流, 交给进程池解码; 只导入标准库, 工作进程启动快。
+"""
+import bisect
+import collections
+import concurrent.futures
+import contextlib
+import io
+import json
+import lzma
+import os
+import struct
+import tarfile
+import typing
+import zlib
+
+XZ_HEADER_MAGIC = b"\xfd7zXZ\x00"
+XZ_FOOTER_MAGIC = b"YZ"
+XZ_HEADER_SIZE = 12
+XZ_FOOTER_SIZE = 12
+TAR_BLOCK_SIZE = 512
+INDEX_FORMAT = 2
+
+
+class XzBlock(typing.NamedTuple):
+    # position of the block in the .xz file
+    offset: int
+    unpadded_size: int
+    # position of the block's data in the decoded stream
+    uncompressed_offset: int
+    uncompressed_size: int
+    # header of the stream the block belongs to (carries the check type)
+    stream_header: bytes
+
+    @property
+    def padded_size(self) -> int:
+        return (self.unpadded_size + 3) & ~3
+
+
+def _read_vli(data: bytes, position: int) -> tuple[int, int]:
+    value = 0
+    for shift in range(0, 63, 7):
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if byte & 0x80 == 0:
+            return value, position
+    raise ValueError("xz: variable length integer too long")
+
+
+def _encode_vli(value: int) -> bytes:
+    out = bytearray()
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def read_xz_blocks(path: str) -> typing.Optional[list[XzBlock]]:
+    """List every block of every stream in path, in file order.
+    Returns None when the file is not a well formed .xz file."""
+    streams: list[list[tuple[int, int, int, bytes]]] = []
+    with open(path, "rb") as fp:
+        end = fp.seek(0, os.SEEK_END)
+        while end > 0:
+            # stream padding between concatenated streams
+            fp.seek(end - 4)
+            if fp.read(4) == b"\x00\x00\x00\x00":
+                end -= 4
+                continue
+            if end < XZ_HEADER_SIZE + XZ_FOOTER_SIZE:
+                return None
+            fp.seek(end - XZ_FOOTER_SIZE)
+            footer = fp.read(XZ_FOOTER_SIZE)
+            if footer[10:12] != XZ_FOOTER_MAGIC:
+                return None
+            backward_size = (struct.unpack("<I", footer[4:8])[0] + 1) * 4
+            index_offset = end - XZ_FOOTER_SIZE - backward_size
+            if index_offset < XZ_HEADER_SIZE:
+                return None
+            fp.seek(index_offset)
+            index = fp.read(backward_size)
+            if index[0] != 0 or zlib.crc32(index[:-4]) != struct.unpack("<I", index[-4:])[0]:
+                return None
+            count, position = _read_vli(index, 1)
+            records: list[tuple[int, int]] = []
+            for _ in range(count):
+                unpadded, position = _read_vli(index, position)
+                uncompressed, position = _read_vli(index, position)
+                records.append((unpadded, uncompressed))
+            blocks_size = sum((unpadded + 3) & ~3 for unpadded, _ in records)
+            stream_offset = index_offset - blocks_size - XZ_HEADER_SIZE
+            if stream_offset < 0:
+                return None
+            fp.seek(stream_offset)
+            header = fp.read(XZ_HEADER_SIZE)
+            if header[:6] != XZ_HEADER_MAGIC or header[6:8] != footer[8:10]:
+                return None
+            offset = stream_offset + XZ_HEADER_SIZE
+            stream: list[tuple[int, int, int, bytes]] = []
+            for unpadded, uncompressed in records:
+                stream.append((offset, unpadded, uncompressed, header))
+                offset += (unpadded + 3) & ~3
+            streams.append(stream)
+            end = stream_offset
+    blocks: list[XzBlock] = []
+    uncompressed_offset = 0
+    for stream in reversed(streams):
+        for offset, unpadded, uncompressed, header in stream:
+            blocks.append(XzBlock(offset, unpadded, uncompressed_offset, uncompressed, header))
+            uncompressed_offset += uncompressed
+    return blocks
+
+
+def _single_block_stream(block: XzBlock, data: bytes) -> bytes:
+    index = bytearray(b"\x00")
+    index += _encode_vli(1)
+    index += _encode_vli(block.unpadded_size)
+    index += _encode_vli(block.uncompressed_size)
+    while len(index) % 4 != 0:
+        index.append(0)
+    index += struct.pack("<I", zlib.crc32(index))
+    flags = block.stream_header[6:8]
+    backward = struct.pack("<I", len(index) // 4 - 1)
+    footer = struct.pack("<I", zlib.crc32(backward + flags)) + backward + flags + XZ_FOOTER_MAGIC
+    return block.stream_header + data + bytes(index) + footer
+
+
+def decode_block(path: str, block: XzBlock) -> bytes:
+    """Decode one block. Runs in pool workers."""
+    with open(path, "rb") as fp:
+        fp.seek(block.offset)
+        data = fp.read(block.padded_size)
+    decoded = lzma.decompress(_single_block_stream(block, data), format=lzma.FORMAT_XZ)
+    if len(decoded) != block.uncompressed_size:
+        raise lzma.LZMAError(f"xz: block at {block.offset} decoded to a wrong size")
+    return decoded
+
+
+class ParallelXzReader(io.RawIOBase):
+    """Sequential reader over the decoded stream of blocks. Blocks are decoded
+    ahead on the executor (at most window of them in flight) and handed out in
+    order. skip drops that many leading bytes of the first block."""
+
+    def __init__(self, path: str, blocks: list[XzBlock],
+                 executor: concurrent.futures.Executor, window: int, skip: int = 0):
+        super().__init__()
+        self._path = path
+        self._blocks = blocks
+        self._executor = executor
+        self._window = max(1, window)
+        self._pending: collections.deque = collections.deque()
+        self._next = 0
+        self._buffer = memoryview(b"")
+        self._skip = skip
+        self.decoded_blocks = 0
+        self._fill()
+
+    def _fill(self):
+        while len(self._pending) < self._window and self._next < len(self._blocks):
+            self._pending.append(
+                self._executor.submit(decode_block, self._path, self._blocks[self._next]))
+            self._next += 1
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while len(self._buffer) == 0:
+            if len(self._pending) == 0:
+                return 0
+            self._buffer = memoryview(self._pending.popleft().result())
+            self.decoded_blocks += 1
+            self._fill()
+            if self._skip > 0:
+                skipped = min(self._skip, len(self._buffer))
+                self._buffer = self._buffer[skipped:]
+                self._skip -= skipped
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+    def close(self):
+        for future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        super().close()
+
+
+@contextlib.contextmanager
+def open_tar(path: str, workers: int,
+             buffer_size: int = 1024 * 1024) -> typing.Iterator[tarfile.TarFile]:
+    """Stream mode (r|) TarFile over the .tar.xz path. Files with several
+    blocks are decoded on a pool of workers processes."""
+    blocks = read_xz_blocks(path) if workers > 1 else None
+    if blocks is None or len(blocks) < 2:
+        with tarfile.open(path, "r|xz", bufsize=buffer_size) as input_fp:
+            yield input_fp
+        return
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        reader = ParallelXzReader(path, blocks, executor, workers + 1)
+        try:
+            with tarfile.open(fileobj=reader, mode="r|", bufsize=buffer_size) as input_fp:
+                yield input_fp
+        finally:
+            reader.close()
+
+
+def _index_path(index_dir: str, path: str, blocks: list[XzBlock]) -> str:
+    # the block layout identifies the archive without hashing all of it
+    layout = json.dumps([[b.offset, b.unpadded_size, b.uncompressed_size] for b in blocks])
+    key = f"{os.path.getsize(path)}:{zlib.crc32(layout.encode('utf-8')):08x}:{len(blocks)}"
+    name = key.replace(":", "-")
+    return os.path.join(index_dir, f"{os.path.basename(path)}.{name}.json")
+
+
+def _member_end(offset_data: int, size: int) -> int:
+    return offset_data + (size + TAR_BLOCK_SIZE - 1) // TAR_BLOCK_SIZE * TAR_BLOCK_SIZE
+
+
+def extract_tar(
+    path: str,
+    dest_path: str,
+    match: typing.Callable[[tarfile.TarInfo], bool],
+    workers: int,
+    index_dir: typing.Optional[str] = None,
+    buffer_size: int = 1024 * 1024,
+) -> typing.Optional[bool]:
+    """Extract the members of the .tar.xz path accepted by match into dest_path.
+    Returns None when path has fewer than two blocks (nothing to gain, use a
+    plain streaming extraction), otherwise whether any member matched.
+    With index_dir, a member -> offset index is stored after the first full
+    pass; later calls use it to decode only the blocks holding matching
+    members."""
+    blocks = read_xz_blocks(path)
+    if blocks is None or len(blocks) < 2:
+        return None
+    index_file = _index_path(index_dir, path, blocks) if index_dir is not None else None
+    workers = max(1, workers)
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        if index_file is not None and os.path.exists(index_file):
+            with open(index_file) as fp:
+                index = json.load(fp)
+            if index.get("format") == INDEX_FORMAT:
+                return _extract_indexed(
+                    path, dest_path, match, blocks, index, executor, workers + 1, buffer_size
+                )
+        members: list[list] = []
+        found = False
+        reader = ParallelXzReader(path, blocks, executor, workers + 1)
+        try:
+            with tarfile.open(fileobj=reader, mode="r|", bufsize=buffer_size) as input_fp:
+                for member in input_fp:
+                    members.append([member.name, member.type.decode("latin-1"), member.offset,
+                                    member.offset_data, member.size])
+                    if match(member):
+                        if not found:
+                            os.makedirs(dest_path, exist_ok=True)
+                        input_fp.extract(member, dest_path)
+                        found = True
+        finally:
+            reader.close()
+    if index_file is not None:
+        os.makedirs(index_dir, exist_ok=True)
+        with open(f"{index_file}_temp", "w") as fp:
+            json.dump({"format": INDEX_FORMAT, "members": members}, fp)
+        os.replace(f"{index_file}_temp", index_file)
+    return found
+
+
+def _extract_indexed(
+    path: str,
+    dest_path: str,
+    match: typing.Callable[[tarfile.TarInfo], bool],
+    blocks: list[XzBlock],
+    index: dict,
+    executor: concurrent.futures.Executor,
+    window: int,
+    buffer_size: int,
+) -> bool:
+    wanted: list[tuple[int, int]] = []
+    for name, member_type, offset, offset_data, size in index["members"]:
+        # match may look at the type (directories), not only the name
+        info = tarfile.TarInfo(name)
+        info.type = member_type.encode("latin-1")
+        if match(info):
+            wanted.append((offset, _member_end(offset_data, size)))
+    if len(wanted) == 0:
+        return False
+    start = min(offset for offset, _ in wanted)
+    end = max(member_end for _, member_end in wanted)
+    starts = [block.uncompressed_offset for block in blocks]
+    first = bisect.bisect_right(starts, start) - 1
+    last = bisect.bisect_right(starts, end - 1) - 1
+    needed = blocks[first : last + 1]
+    reader = ParallelXzReader(
+        path, needed, executor, window, start - needed[0].uncompressed_offset
+    )
+    found = False
+    try:
+        # the stream starts at the first wanted member header, offsets are relative
+        with tarfile.open(fileobj=reader, mode="r|", bufsize=buffer_size) as input_fp:
+            for member in input_fp:
+                if member.offset + start >= end:
+                    break
+                if match(member):
+                    if not found:
+                        os.makedirs(dest_path, exist_ok=True)
+                    input_fp.extract(member, dest_path)
+                    found = True
+    finally:
+        reader.close()
+    print(f"xz index: decoded {reader.decoded_blocks}/{len(blocks)} blocks of {path}")
+    return found
@@ -0,0 +1,546 @@
+# -*- coding: utf-8 -*-
+"""在线程池中压缩成员的 zip 写入。
+只顺序写入, 可以写到不能 seek 的流; 需要时写 ZIP64, 符号链接按符号链接保存。
+"""
+import collections
+import concurrent.futures
+import copy
+import os
+import stat
+import struct
+import time
+import typing
+import zipfile
+import zlib
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+
+_LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+_CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+_END_RECORD = struct.Struct("<IHHHHIIH")
+_ZIP64_END_RECORD = struct.Struct("<IQHHIIQQQQ")
+_ZIP64_LOCATOR = struct.Struct("<IIQI")
+_ZIP32_LIMIT = 0xFFFFFFFF
+# deflate can grow incompressible data a little, stay well clear of 4 GiB
+_ZIP64_SIZE_HINT = 0xFFFFFFFF - 64 * 1024 * 1024
+_FLAG_DATA_DESCRIPTOR = 0x08
+_FLAG_UTF8 = 0x800
+_MADE_BY_UNIX = 3 << 8 | 45
+
+
+def dos_date_time(mtime: float) -> tuple[int, int]:
+    local = time.localtime(mtime)
+    if local.tm_year < 1980:
+        return 0, 0x21
+    return (
+        local.tm_hour << 11 | local.tm_min << 5 | local.tm_sec // 2,
+        (local.tm_year - 1980) << 9 | local.tm_mon << 5 | local.tm_mday,
+    )
+
+
+class ZipEntry(object):
+    """Central directory data of one member."""
+
+    def __init__(self, name: str, method: int, mode: int, mtime: float):
+        self.name = name
+        self.encoded_name = name.encode("utf-8")
+        self.method = method
+        self.mode = mode
+        self.mtime = mtime
+        self.flags = 0 if name.isascii() else _FLAG_UTF8
+        self.crc = 0
+        self.compress_size = 0
+        self.file_size = 0
+        self.header_offset = 0
+        self.zip64 = False
+
+    @property
+    def external_attr(self) -> int:
+        attr = (self.mode & 0xFFFF) << 16
+        if stat.S_ISDIR(self.mode):
+            attr |= 0x10
+        return attr
+
+
+def _compress_chunk(data: bytes, level: int, zdict: typing.Optional[bytes], last: bool) -> bytes:
+    if zdict:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15, zdict=zdict)
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    out = compressor.compress(data)
+    # sync flush keeps the block byte aligned so chunks can be concatenated
+    out += compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+    return out
+
+
+class _Pending(object):
+
+    def __init__(self, entry: ZipEntry, chunks: collections.deque, streamed: bool):
+        self.entry = entry
+        # futures (or ready bytes) of the compressed chunks, in order
+        self.chunks = chunks
+        self.streamed = streamed
+        self.finished = False
+        self.header_written = False
+        self.raw: typing.Optional[bytes] = None
+        # state of a member being streamed in
+        self.remaining = 0
+        self.crc = 0
+        self.previous = b""
+
+
+class ParallelZipWriter(object):
+    """Write a zip archive to fp (only write() is used).
+
+    Files are cut into chunk_size pieces that are deflated on a thread pool
+    (zlib releases the GIL), each piece primed with the 32 KiB preceding it so
+    the concatenated output is one regular deflate stream. Several members are
+    compressed ahead while earlier ones are written, bounded by max_pending
+    chunks in flight. level 0 stores everything.
+    """
+
+    def __init__(self, fp: typing.BinaryIO, level: int = 6, workers: int = 0,
+                 chunk_size: int = 1024 * 1024, max_pending: int = 0):
+        self._fp = fp
+        self.level = level
+        self.chunk_size = max(64 * 1024, chunk_size)
+        workers = workers if workers > 0 else (os.cpu_count() or 1)
+        self._executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self._max_pending = max_pending if max_pending > 0 else workers * 4
+        self._pending: collections.deque[_Pending] = collections.deque()
+        self._in_flight = 0
+        self.entries: list[ZipEntry] = []
+        self.offset = 0
+        self.bytes_in = 0
+        self._closed = False
+
+    def _write(self, data: bytes):
+        if len(data) > 0:
+            self._fp.write(data)
+            self.offset += len(data)
+
+    def _mode(self, mode: typing.Optional[int], kind: int, default: int) -> int:
+        if mode is None:
+            return kind | default
+        return kind | stat.S_IMODE(mode)
+
+    def add_directory(self, arcname: str, mode: typing.Optional[int] = None,
+                      mtime: typing.Optional[float] = None):
+        if not arcname.endswith("/"):
+            arcname += "/"
+        entry = ZipEntry(arcname, ZIP_STORED, self._mode(mode, stat.S_IFDIR, 0o755),
+                         time.time() if mtime is None else mtime)
+        self._queue_ready(entry, b"")
+
+    def add_symlink(self, arcname: str, target: str, mtime: typing.Optional[float] = None):
+        entry = ZipEntry(arcname, ZIP_STORED, stat.S_IFLNK | 0o777,
+                         time.time() if mtime is None else mtime)
+        self._queue_ready(entry, target.encode("utf-8"))
+
+    def add_bytes(self, arcname: str, data: bytes, mode: typing.Optional[int] = None,
+                  mtime: typing.Optional[float] = None):
+        entry = ZipEntry(arcname, ZIP_DEFLATED if self.level > 0 else ZIP_STORED,
+                         self._mode(mode, stat.S_IFREG, 0o644),
+                         time.time() if mtime is None else mtime)
+        self._queue_stream(entry, [data], len(data))
+
+    def add_file(self, path: str, arcname: str):
+        st = os.stat(path)
+        with open(path, "rb") as fp:
+            self.add_stream(arcname, fp, st.st_size, st.st_mode, st.st_mtime)
+
+    def add_stream(self, arcname: str, fp: typing.BinaryIO, size: int,
+                   mode: typing.Optional[int] = None, mtime: typing.Optional[float] = None):
+        entry = ZipEntry(arcname, ZIP_DEFLATED if self.level > 0 else ZIP_STORED,
+                         self._mode(mode, stat.S_IFREG, 0o644),
+                         time.time() if mtime is None else mtime)
+        self.add_fileobj(entry, fp, size)
+
+    def add_fileobj(self, entry: ZipEntry, fp: typing.BinaryIO, size: int):
+        """Add entry with size bytes read from fp (read sequentially)."""
+
+        def _chunks():
+            remaining = size
+            while remaining > 0:
+                data = fp.read(min(self.chunk_size, remaining))
+                if len(data) == 0:
+                    raise EOFError(f"zip: {entry.name} is shorter than {size} bytes")
+                remaining -= len(data)
+                yield data
+
+        self._queue_stream(entry, _chunks(), size)
+
+    def _queue_ready(self, entry: ZipEntry, data: bytes):
+        entry.crc = zlib.crc32(data)
+        entry.file_size = entry.compress_size = len(data)
+        pending = _Pending(entry, collections.deque([data]), False)
+        pending.finished = True
+        self._pending.append(pending)
+        self._drain(False)
+
+    def _queue_stream(self, entry: ZipEntry, chunks: typing.Iterable[bytes], size: int):
+        pending = self._begin_stream(entry, size)
+        for data in chunks:
+            self._feed(pending, data)
+        self._end_stream(pending, size)
+
+    def _begin_stream(self, entry: ZipEntry, size: int) -> _Pending:
+        # members that fit in one chunk are compressed before their header is
+        # written, bigger ones are streamed behind a data descriptor
+        entry.zip64 = size >= _ZIP64_SIZE_HINT
+        pending = _Pending(entry, collections.deque(), size > self.chunk_size)
+        pending.remaining = size
+        self._pending.append(pending)
+        return pending
+
+    def _feed(self, pending: _Pending, data: bytes,
+              future: typing.Optional[concurrent.futures.Future] = None
+              ) -> typing.Optional[concurrent.futures.Future]:
+        """Queue the next chunk of pending. future, when given, is the same
+        chunk already being compressed at this level (by another writer).
+        Returns the future of the compressed chunk, None when stored."""
+        entry = pending.entry
+        pending.remaining -= len(data)
+        pending.crc = zlib.crc32(data, pending.crc)
+        self.bytes_in += len(data)
+        if entry.method == ZIP_DEFLATED:
+            if future is None:
+                future = self._executor.submit(
+                    _compress_chunk, data, self.level, pending.previous[-32768:],
+                    pending.remaining <= 0)
+            pending.previous = data
+            pending.chunks.append(future)
+            self._in_flight += 1
+        else:
+            future = None
+            pending.chunks.append(data)
+        if not pending.streamed:
+            pending.raw = data
+        self._drain(False)
+        return future
+
+    def _end_stream(self, pending: _Pending, size: int):
+        pending.entry.crc = pending.crc
+        pending.entry.file_size = size
+        pending.finished = True
+        self._drain(False)
+
+    def _drain(self, everything: bool):
+        while len(self._pending) > 0:
+            head = self._pending[0]
+            if head.streamed:
+                if not head.header_written:
+                    self._write_local_header(head.entry, True)
+                    head.header_written = True
+                while len(head.chunks) > 0:
+                    chunk = head.chunks[0]
+                    if not everything and self._in_flight < self._max_pending \
+                            and not (isinstance(chunk, bytes) or chunk.done()):
+                        return
+                    head.chunks.popleft()
+                    self._write_chunk(head.entry, chunk)
+                if not head.finished:
+                    return
+                self._write_data_descriptor(head.entry)
+                self._pending.popleft()
+                continue
+            if not head.finished:
+                return
+            if not everything and self._in_flight < self._max_pending \
+                    and not all(isinstance(c, bytes) or c.done() for c in head.chunks):
+                return
+            self._write_whole(head)
+            self._pending.popleft()
+
+    def _resolve(self, chunk) -> bytes:
+        if isinstance(chunk, bytes):
+            return chunk
+        self._in_flight -= 1
+        return chunk.result()
+
+    def _write_chunk(self, entry: ZipEntry, chunk):
+        data = self._resolve(chunk)
+        entry.compress_size += len(data)
+        self._write(data)
+
+    def _write_whole(self, pending: _Pending):
+        entry = pending.entry
+        data = b"".join(self._resolve(chunk) for chunk in pending.chunks)
+        if entry.method == ZIP_DEFLATED and len(data) >= entry.file_size and pending.raw is not None:
+            # incompressible, store it instead
+            entry.method = ZIP_STORED
+            data = pending.raw
+        elif entry.method == ZIP_DEFLATED and entry.file_size == 0:
+            entry.method = ZIP_STORED
+            data = b""
+        entry.compress_size = len(data)
+        self._write_local_header(entry, False)
+        self._write(data)
+
+    def _extra_zip64_local(self, entry: ZipEntry) -> bytes:
+        if entry.flags & _FLAG_DATA_DESCRIPTOR:
+            return struct.pack("<HHQQ", 1, 16, 0, 0)
+        return struct.pack("<HHQQ", 1, 16, entry.file_size, entry.compress_size)
+
+    def _write_local_header(self, entry: ZipEntry, streamed: bool):
+        entry.header_offset = self.offset
+        self.entries.append(entry)
+        if streamed:
+            entry.flags |= _FLAG_DATA_DESCRIPTOR
+            crc, compress_size, file_size = 0, 0, 0
+        else:
+            entry.zip64 = entry.zip64 or entry.file_size > _ZIP32_LIMIT \
+                or entry.compress_size > _ZIP32_LIMIT
+            crc, compress_size, file_size = entry.crc, entry.compress_size, entry.file_size
+        extra = b""
+        if entry.zip64:
+            extra = self._extra_zip64_local(entry)
+            compress_size = file_size = _ZIP32_LIMIT
+        dos_time, dos_date = dos_date_time(entry.mtime)
+        self._write(_LOCAL_HEADER.pack(
+            0x04034B50, 45 if entry.zip64 else 20, entry.flags, entry.method,
+            dos_time, dos_date, crc, compress_size, file_size,
+            len(entry.encoded_name), len(extra)))
+        self._write(entry.encoded_name)
+        self._write(extra)
+
+    def _write_data_descriptor(self, entry: ZipEntry):
+        if entry.zip64:
+            self._write(struct.pack("<IIQQ", 0x08074B50, entry.crc,
+                                    entry.compress_size, entry.file_size))
+        else:
+            if entry.compress_size > _ZIP32_LIMIT or entry.file_size > _ZIP32_LIMIT:
+                raise ValueError(f"zip: {entry.name} outgrew its 32 bit data descriptor")
+            self._write(struct.pack("<IIII", 0x08074B50, entry.crc,
+                                    entry.compress_size, entry.file_size))
+
+    def add_raw(self, entry: ZipEntry, chunks: typing.Iterable[bytes]):
+        """Append an already compressed member; entry must carry crc, sizes
+        and method."""
+        self._begin_raw(entry)
+        written = 0
+        for data in chunks:
+            written += len(data)
+            self._write(data)
+        self._end_raw(entry, written)
+
+    def _begin_raw(self, entry: ZipEntry):
+        self._drain(True)
+        entry.zip64 = entry.file_size > _ZIP32_LIMIT or entry.compress_size > _ZIP32_LIMIT
+        self._write_local_header(entry, False)
+
+    def _end_raw(self, entry: ZipEntry, written: int):
+        self.bytes_in += entry.file_size
+        if written != entry.compress_size:
+            raise ValueError(f"zip: {entry.name} raw data is {written} bytes, "
+                             f"expected {entry.compress_size}")
+
+    def close(self):
+        if self._closed:
+            return
+        self._drain(True)
+        self._executor.shutdown()
+        central_offset = self.offset
+        for entry in self.entries:
+            self._write_central_header(entry)
+        central_size = self.offset - central_offset
+        count = len(self.entries)
+        if count >= 0xFFFF or central_offset > _ZIP32_LIMIT or central_size > _ZIP32_LIMIT:
+            zip64_offset = self.offset
+            self._write(_ZIP64_END_RECORD.pack(
+                0x06064B50, _ZIP64_END_RECORD.size - 12, _MADE_BY_UNIX, 45, 0, 0,
+                count, count, central_size, central_offset))
+            self._write(_ZIP64_LOCATOR.pack(0x07064B50, 0, zip64_offset, 1))
+            self._write(_END_RECORD.pack(
+                0x06054B50, 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+                min(central_size, _ZIP32_LIMIT), min(central_offset, _ZIP32_LIMIT), 0))
+        else:
+            self._write(_END_RECORD.pack(
+                0x06054B50, 0, 0, count, count, central_size, central_offset, 0))
+        self._closed = True
+
+    def _write_central_header(self, entry: ZipEntry):
+        extra_fields: list[int] = []
+        file_size, compress_size, offset = entry.file_size, entry.compress_size, entry.header_offset
+        if file_size >= _ZIP32_LIMIT:
+            extra_fields.append(file_size)
+            file_size = _ZIP32_LIMIT
+        if compress_size >= _ZIP32_LIMIT:
+            extra_fields.append(compress_size)
+            compress_size = _ZIP32_LIMIT
+        if offset >= _ZIP32_LIMIT:
+            extra_fields.append(offset)
+            offset = _ZIP32_LIMIT
+        extra = b""
+        if len(extra_fields) > 0:
+            extra = struct.pack(f"<HH{len(extra_fields)}Q", 1, 8 * len(extra_fields), *extra_fields)
+        dos_time, dos_date = dos_date_time(entry.mtime)
+        needed = 45 if entry.zip64 or len(extra_fields) > 0 else 20
+        self._write(_CENTRAL_HEADER.pack(
+            0x02014B50, _MADE_BY_UNIX, needed, entry.flags, entry.method,
+            dos_time, dos_date, entry.crc, compress_size, file_size,
+            len(entry.encoded_name), len(extra), 0, 0, 0, entry.external_attr, offset))
+        self._write(entry.encoded_name)
+        self._write(extra)
+
+    def abort(self):
+        self._executor.shutdown(cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+class ZipFanout(object):
+    """Write each member once into every writer that accepts it.
+
+    accepts(index, arcname, is_dir) tells whether writers[index] takes a
+    member. Stream data is read once and fed to all of its writers, and
+    writers sharing a compression level share the compressed chunks too, so a
+    member common to every archive is read and compressed a single time.
+    Members no writer accepts are not read at all.
+    """
+
+    def __init__(self, writers: list[ParallelZipWriter],
+                 accepts: typing.Callable[[int, str, bool], bool]):
+        self.writers = writers
+        self._accepts = accepts
+
+    def targets(self, arcname: str, is_dir: bool = False) -> list[int]:
+        return [index for index in range(len(self.writers))
+                if self._accepts(index, arcname, is_dir)]
+
+    def wants(self, arcname: str, is_dir: bool = False) -> bool:
+        return len(self.targets(arcname, is_dir)) > 0
+
+    def add_directory(self, arcname: str, mode: typing.Optional[int] = None,
+                      mtime: typing.Optional[float] = None):
+        for index in self.targets(arcname, True):
+            self.writers[index].add_directory(arcname, mode, mtime)
+
+    def add_symlink(self, arcname: str, target: str, mtime: typing.Optional[float] = None):
+        for index in self.targets(arcname):
+            self.writers[index].add_symlink(arcname, target, mtime)
+
+    def add_bytes(self, arcname: str, data: bytes, mode: typing.Optional[int] = None,
+                  mtime: typing.Optional[float] = None):
+        for index in self.targets(arcname):
+            self.writers[index].add_bytes(arcname, data, mode, mtime)
+
+    def add_file(self, path: str, arcname: str):
+        if not self.wants(arcname):
+            return
+        st = os.stat(path)
+        with open(path, "rb") as fp:
+            self.add_stream(arcname, fp, st.st_size, st.st_mode, st.st_mtime)
+
+    def add_stream(self, arcname: str, fp: typing.BinaryIO, size: int,
+                   mode: typing.Optional[int] = None, mtime: typing.Optional[float] = None):
+        writers = [self.writers[index] for index in self.targets(arcname)]
+        if len(writers) == 0:
+            return
+        if len(writers) == 1:
+            writers[0].add_stream(arcname, fp, size, mode, mtime)
+            return
+        chunk_size = writers[0].chunk_size
+        if any(writer.chunk_size != chunk_size for writer in writers):
+            raise ValueError("zip: fanned out writers need the same chunk size")
+        mtime = time.time() if mtime is None else mtime
+        pending = [
+            writer._begin_stream(ZipEntry(
+                arcname, ZIP_DEFLATED if writer.level > 0 else ZIP_STORED,
+                writer._mode(mode, stat.S_IFREG, 0o644), mtime), size)
+            for writer in writers
+        ]
+        for data in _read_exactly(fp, size, chunk_size):
+            # level -> future of this chunk compressed at that level
+            shared: dict[int, concurrent.futures.Future] = {}
+            for writer, item in zip(writers, pending):
+                future = writer._feed(item, data, shared.get(writer.level))
+                if future is not None:
+                    shared[writer.level] = future
+        for writer, item in zip(writers, pending):
+            writer._end_stream(item, size)
+
+    def add_raw(self, entry: ZipEntry, chunks: typing.Iterable[bytes]):
+        writers = [self.writers[index]
+                   for index in self.targets(entry.name, entry.name.endswith("/"))]
+        if len(writers) == 0:
+            return
+        # every archive has its own header offset
+        entries = [copy.copy(entry) for _ in writers]
+        for writer, item in zip(writers, entries):
+            writer._begin_raw(item)
+        written = 0
+        for data in chunks:
+            written += len(data)
+            for writer in writers:
+                writer._write(data)
+        for writer, item in zip(writers, entries):
+            writer._end_raw(item, written)
+
+    def close(self):
+        for writer in self.writers:
+            writer.close()
+
+    def abort(self):
+        for writer in self.writers:
+            writer.abort()
+
+
+def _read_exactly(fp: typing.BinaryIO, size: int, block_size: int = 1024 * 1024):
+    while size > 0:
+        data = fp.read(min(block_size, size))
+        if len(data) == 0:
+            raise EOFError("zip: member data is truncated")
+        size -= len(data)
+        yield data
+
+
+def _info_mode(info: zipfile.ZipInfo) -> int:
+    mode = info.external_attr >> 16
+    if info.create_system == 3 and stat.S_IFMT(mode) != 0:
+        return mode
+    if info.is_dir():
+        return stat.S_IFDIR | 0o755
+    return stat.S_IFREG | 0o644
+
+
+def copy_zip_members(writer: typing.Union[ParallelZipWriter, ZipFanout], src_path: str,
+                     rename: typing.Callable[[str], typing.Optional[str]]) -> int:
+    """Copy the members of the zip file src_path for which rename returns a
+    name into writer, moving the compressed data as is. Only the local and
+    central headers are rewritten. Raises ValueError before writing anything
+    when a selected member is encrypted or uses a method other than stored or
+    deflated. Returns the number of copied members."""
+    selected: list[tuple[zipfile.ZipInfo, str]] = []
+    with zipfile.ZipFile(src_path) as input_fp:
+        for info in input_fp.infolist():
+            name = rename(info.filename)
+            if name is None:
+                continue
+            if info.flag_bits & 0x1:
+                raise ValueError(f"zip: {info.filename} is encrypted")
+            if info.compress_type not in (ZIP_STORED, ZIP_DEFLATED):
+                raise ValueError(f"zip: {info.filename} uses method {info.compress_type}")
+            selected.append((info, name))
+    with open(src_path, "rb") as fp:
+        for info, name in selected:
+            fp.seek(info.header_offset)
+            header = _LOCAL_HEADER.unpack(fp.read(_LOCAL_HEADER.size))
+            if header[0] != 0x04034B50:
+                raise ValueError(f"zip: bad local header for {info.filename}")
+            fp.seek(info.header_offset + _LOCAL_HEADER.size + header[9] + header[10])
+            entry = ZipEntry(name, info.compress_type, _info_mode(info),
+                             time.mktime(info.date_time + (0, 0, -1)))
+            entry.crc = info.CRC
+            entry.compress_size = info.compress_size
+            entry.file_size = info.file_size
+            writer.add_raw(entry, _read_exactly(fp, info.compress_size))
+    return len(selected)